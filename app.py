@@ -1,8 +1,19 @@
 import os
+import atexit
 import datetime
+import functools
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from html import unescape
+from typing import TYPE_CHECKING
+from markupsafe import Markup, escape
 from flask import (
     Flask,
+    Response,
     render_template,
     request,
     redirect,
@@ -10,18 +21,27 @@ from flask import (
     send_from_directory,
     send_file,
     flash,
+    jsonify,
+    make_response,
+    session,
 )
+from werkzeug.security import safe_join
 import re
-from bs4 import BeautifulSoup
-from docx import Document
-import bleach
-from docx.shared import Inches
+import docx_ir
+import sanitizer
+from chapter_store import BLOCKS_DIR, HTML_FILE, MANIFEST_FILE, BlockStore, split_blocks
+from compression import GzipRequests, compress_response
+from metrics import Metrics
+from storage import FileLock, Journal
+
+if TYPE_CHECKING:
+    from docx.document import Document
 
 app = Flask(__name__)
 app.secret_key = 'change-this'
 
 # Application version
-VERSION = "0.8.2"
+VERSION = "0.9.18"
 app.jinja_env.globals['app_version'] = VERSION
 
 DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.getcwd(), 'data'))
@@ -34,52 +54,318 @@ OPEN_BOOKS_FILE = os.path.join(DATA_DIR, 'open_books.json')
 CLOSED_FOLDERS_FILE = os.path.join(DATA_DIR, 'closed_folders.json')
 CLOSED_CHAPTERS_FILE = os.path.join(DATA_DIR, 'closed_chapters.json')
 
+# Derived files that can be rebuilt at any time. Hidden directories are
+# skipped by the sidebar listings, and the cache is left out of exports.
+CACHE_DIR = os.path.join(DATA_DIR, '.cache')
+DOCX_CACHE_DIR = os.path.join(CACHE_DIR, 'docx')
+DOCX_CACHE_LIMIT = int(os.environ.get('DOCX_CACHE_LIMIT', 200))
+# Parsed chapters reused by combined exports, and the worker processes that
+# parse them (0 parses in the request thread).
+DOCX_IR_CACHE_LIMIT = int(os.environ.get('DOCX_IR_CACHE_LIMIT', 2000))
+DOCX_WORKERS = int(os.environ.get('DOCX_WORKERS', min(4, os.cpu_count() or 1)))
+_docx_pool = None
+
+# Images pulled out of chapter HTML, named by the hash of their content.
+# Unlike the cache this is part of the library and is exported with it.
+ASSETS_DIR = os.path.join(DATA_DIR, '.assets')
+ASSET_TYPES = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif', 'image/webp': 'webp'}
+_DATA_IMAGE_RE = re.compile(
+    r'(<img\b[^>]*?\bsrc\s*=\s*)(["\'])data:(image/[\w.+-]+);base64,([A-Za-z0-9+/=\s]*)\2',
+    re.IGNORECASE,
+)
+
+# Chapter HTML sanitizer: "fast" handles editor markup in one pass and defers
+# to bleach for anything else; "bleach" always uses bleach.
+SANITIZER = os.environ.get('SANITIZER', 'fast')
+_sanitize = sanitizer.get_sanitizer(SANITIZER)
+
+# Full-text search index, created on first use. Falls back to scanning the
+# data directory when SQLite lacks FTS5.
+SEARCH_DB = os.path.join(CACHE_DIR, 'search.db')
+_search_index = None
+
+# Word-count ledger and rollups behind the stats page. This is history rather
+# than derived data, so it lives next to the library and is exported with it.
+WORDCOUNT_DB = os.path.join(DATA_DIR, 'wordcounts.db')
+_wordcount_ledger = None
+
+# Chapter revision history, recorded on every save. Saves within
+# REVISION_INTERVAL seconds of each other are kept as one revision.
+REVISIONS_DB = os.path.join(DATA_DIR, 'revisions.db')
+REVISION_INTERVAL = int(os.environ.get('REVISION_INTERVAL', 60))
+_revision_store = None
+
+# Log of structural changes (folders and chapters created, renamed, deleted,
+# closed, opened or reordered) that open pages follow through /changes to
+# update their sidebar and tabs in place. It is derived data, so it lives in
+# the cache. Each event-stream response lasts at most CHANGE_STREAM_SECONDS;
+# browsers then reconnect and carry on from the last change they saw.
+# Waiting for changes holds a worker thread, so each process keeps at most
+# CHANGE_STREAM_LIMIT streams and long polls open (default: half of
+# WEB_THREADS). Beyond that /changes answers at once, and browsers poll
+# every CHANGE_POLL_SECONDS instead.
+CHANGES_DB = os.path.join(CACHE_DIR, 'changes.db')
+CHANGE_STREAM_SECONDS = int(os.environ.get('CHANGE_STREAM_SECONDS', 25))
+CHANGE_STREAM_LIMIT = int(os.environ.get(
+    'CHANGE_STREAM_LIMIT', max(1, int(os.environ.get('WEB_THREADS', 8)) // 2)
+))
+CHANGE_POLL_SECONDS = int(os.environ.get('CHANGE_POLL_SECONDS', 10))
+_change_waiters = threading.BoundedSemaphore(CHANGE_STREAM_LIMIT)
+_change_feed = None
+
+# Recent editor uploads keyed by revision. Delta autosaves are applied to one
+# of these; once a base is evicted the editor falls back to a full upload.
+AUTOSAVE_BASE_BYTES = int(os.environ.get('AUTOSAVE_BASE_BYTES', 32 * 1024 * 1024))
+_autosave_bases = OrderedDict()
+
+# Limits applied to uploaded .calwdb archives before anything is written:
+# total uncompressed size, number of entries and overall compression ratio.
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 4 * 1024 ** 3))
+IMPORT_MAX_ENTRIES = int(os.environ.get('IMPORT_MAX_ENTRIES', 100000))
+IMPORT_MAX_RATIO = int(os.environ.get('IMPORT_MAX_RATIO', 200))
+
+# Write-ahead journal for chapter, notes and state files. Saves are journaled
+# and fsynced together before the files are replaced, and anything a crash
+# left half-written is restored from the journal on the next start, unless
+# another process (a running server, for a flask command) has it open. The
+# journal is emptied once it reaches JOURNAL_CHECKPOINT_BYTES.
+JOURNAL_DIR = os.path.join(DATA_DIR, '.journal')
+JOURNAL_CHECKPOINT_BYTES = int(os.environ.get('JOURNAL_CHECKPOINT_BYTES', 8 * 1024 * 1024))
+journal = Journal(JOURNAL_DIR, DATA_DIR, JOURNAL_CHECKPOINT_BYTES)
+journal.recover()
+atexit.register(journal.checkpoint)
+
+# Advisory locks held around every load/modify/save of shared library state,
+# so concurrent requests in other threads or worker processes are not lost.
+# They are always taken in this order; open_books comes last because
+# load_open_books may take it while others are held.
+LOCK_DIR = os.path.join(DATA_DIR, '.locks')
+STATE_LOCKS = {
+    name: FileLock(os.path.join(LOCK_DIR, name + '.lock'))
+    for name in ('settings', 'order', 'closed_folders', 'closed_chapters', 'open_books')
+}
+
+# How chapters are stored: "file" keeps each chapter in one chapter.html;
+# "blocks" splits it into blocks under .blocks/ listed by chapter.json, so a
+# save writes only the blocks that changed. Chapters are converted to the
+# configured layout when they are next saved, or all at once with
+# "flask convert-chapters".
+CHAPTER_STORAGE = os.environ.get('CHAPTER_STORAGE', 'file')
+# Plain text of recently used blocks, for search.
+BLOCK_TEXT_CACHE_LIMIT = int(os.environ.get('BLOCK_TEXT_CACHE_LIMIT', 20000))
+_block_texts = OrderedDict()
+
+# Request metrics served at /metrics: latency per endpoint and the
+# filesystem calls, JSON loads, HTML parses, sanitizer runs and DOCX builds
+# behind it. METRICS=0 turns them off; SERVER_TIMING=1 adds each request's
+# breakdown as a Server-Timing header. Worker processes share their totals
+# through files in METRICS_DIR.
+METRICS = os.environ.get('METRICS', '1') != '0'
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+METRICS_DIR = os.path.join(CACHE_DIR, 'metrics')
+metrics = Metrics(METRICS_DIR, enabled=METRICS)
+load_json = metrics.measure('json')(json.load)
+
+# Request bodies sent with Content-Encoding: gzip are inflated up to
+# GZIP_MAX_REQUEST_BYTES. HTML, JSON and text responses of at least
+# GZIP_MIN_BYTES are gzipped for clients that accept it.
+GZIP_MAX_REQUEST_BYTES = int(os.environ.get('GZIP_MAX_REQUEST_BYTES', 64 * 1024 * 1024))
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+app.wsgi_app = GzipRequests(app.wsgi_app, GZIP_MAX_REQUEST_BYTES)
+
+# python-docx, BeautifulSoup and bleach are imported by the code that needs
+# them, which keeps startup and CLI commands fast. PREWARM=1 loads them, the
+# templates and the databases at startup instead; with Gunicorn's
+# preload_app this happens once in the master and is shared by the workers.
+PREWARM = os.environ.get('PREWARM', '0') == '1'
+
+# Library metadata (ordering, open/closed lists and book attributes) lives in
+# small files by default. Set METADATA_BACKEND=sqlite to keep it in a single
+# database instead; existing files are migrated on first start.
+METADATA_BACKEND = os.environ.get('METADATA_BACKEND', 'files')
+METADATA_DB = os.path.join(DATA_DIR, 'metadata.db')
+metadata_store = None
+if METADATA_BACKEND == 'sqlite':
+    from metadata_store import MetadataStore
+    metadata_store = MetadataStore(METADATA_DB)
+    metadata_store.migrate_from_files(DATA_DIR)
+
+# Process-wide caches for the library tree and small state files. Entries are
+# keyed on file/directory mtimes so edits made outside this process are still
+# picked up, and the mutating routes drop them explicitly as well.
+_cache_lock = threading.Lock()
+_tree_cache = {}
+_file_cache = {}
+# Content hashes of chapter and notes files, used as save revisions (ETags).
+_content_hashes = {}
+
+
+def _file_signature(path: str):
+    """Return a cheap change marker for a file or directory."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _load_cached(path: str, default, loader=load_json):
+    """Load a file, reusing the parsed data while the file is unchanged.
+
+    Returns ``default`` when the file is missing or invalid. Callers get a
+    reference to the cached object and must not modify it.
+    """
+    sig = _file_signature(path)
+    if sig is None:
+        return default
+    with _cache_lock:
+        cached = _file_cache.get(path)
+    if cached and cached[0] == sig:
+        return cached[1]
+    try:
+        with open(path) as f:
+            data = loader(f)
+    except (OSError, ValueError):
+        return default
+    with _cache_lock:
+        _file_cache[path] = (sig, data)
+    return data
+
+
+def _forget_file(path: str) -> None:
+    with _cache_lock:
+        _file_cache.pop(path, None)
+
+
+def invalidate_tree(folder: str = None) -> None:
+    """Drop cached listings for a folder and everything below it.
+
+    Without a folder the whole tree index is cleared.
+    """
+    with _cache_lock:
+        if folder is None:
+            _tree_cache.clear()
+            _file_cache.clear()
+            return
+        folder = sanitize_path(folder)
+        parent = os.path.dirname(folder)
+        for key in list(_tree_cache):
+            if key in (folder, parent) or key.startswith(folder + os.sep):
+                del _tree_cache[key]
+        prefix = os.path.join(DATA_DIR, folder)
+        for key in list(_file_cache):
+            if key.startswith(prefix + os.sep):
+                del _file_cache[key]
+
+
+def rename_path(old_path: str, new_path: str) -> None:
+    """Move a folder or chapter directory within the data directory."""
+    # Recovery skips records whose folder is gone, so whatever was journaled
+    # under the old name has to be on disk before it moves.
+    journal.checkpoint()
+    os.rename(old_path, new_path)
+
+
+def path_renamed(old: str, new: str) -> None:
+    """Update cached and stored metadata after a folder or chapter moved."""
+    invalidate_tree(old)
+    invalidate_tree(new)
+    if metadata_store:
+        metadata_store.rename_prefix(sanitize_path(old), sanitize_path(new))
+    index = get_search_index()
+    if index:
+        index.rename_prefix(sanitize_path(old), sanitize_path(new))
+    get_wordcount_ledger().rename_prefix(sanitize_path(old), sanitize_path(new))
+    get_revision_store().rename_prefix(sanitize_path(old), sanitize_path(new))
+
+
+def path_deleted(path: str) -> None:
+    """Forget cached and stored metadata for a removed folder or chapter."""
+    journal.checkpoint()
+    invalidate_tree(path)
+    if metadata_store:
+        metadata_store.delete_prefix(sanitize_path(path))
+    index = get_search_index()
+    if index:
+        index.delete_prefix(sanitize_path(path))
+    get_wordcount_ledger().delete_prefix(sanitize_path(path))
+    get_revision_store().delete_prefix(sanitize_path(path))
+
+
+@contextmanager
+def state_lock(*names):
+    """Hold the locks for the named pieces of library state."""
+    with ExitStack() as stack:
+        for name, lock in STATE_LOCKS.items():
+            if name in names:
+                stack.enter_context(lock)
+        yield
+
+
+def locks_state(*names):
+    """Run a view while holding ``state_lock(*names)``."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with state_lock(*names):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_text(path: str, text: str) -> None:
+    """Replace a file in the data directory through the journal."""
+    journal.write(path, text.encode('utf-8'))
+
 
 def load_open_books():
-    if os.path.isfile(OPEN_BOOKS_FILE):
-        try:
-            with open(OPEN_BOOKS_FILE) as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            pass
-    books = list_all_books()
-    save_open_books(books)
+    if metadata_store:
+        books = metadata_store.get_list('open_books')
+    else:
+        books = _load_cached(OPEN_BOOKS_FILE, None)
+    if books is not None:
+        return list(books)
+    with state_lock('open_books'):
+        books = list_all_books()
+        save_open_books(books)
     return books
 
 
 def save_open_books(books: list) -> None:
-    with open(OPEN_BOOKS_FILE, 'w') as f:
-        json.dump(books, f)
+    if metadata_store:
+        metadata_store.set_list('open_books', books)
+        return
+    write_text(OPEN_BOOKS_FILE, json.dumps(books))
+    _forget_file(OPEN_BOOKS_FILE)
 
 
 def load_closed_folders() -> list:
-    if os.path.isfile(CLOSED_FOLDERS_FILE):
-        try:
-            with open(CLOSED_FOLDERS_FILE) as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            pass
-    return []
+    if metadata_store:
+        return metadata_store.get_list('closed_folders') or []
+    return list(_load_cached(CLOSED_FOLDERS_FILE, []))
 
 
 def save_closed_folders(folders: list) -> None:
-    with open(CLOSED_FOLDERS_FILE, 'w') as f:
-        json.dump(folders, f)
+    if metadata_store:
+        metadata_store.set_list('closed_folders', folders)
+        return
+    write_text(CLOSED_FOLDERS_FILE, json.dumps(folders))
+    _forget_file(CLOSED_FOLDERS_FILE)
 
 
 def load_closed_chapters() -> list:
-    if os.path.isfile(CLOSED_CHAPTERS_FILE):
-        try:
-            with open(CLOSED_CHAPTERS_FILE) as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            pass
-    return []
+    if metadata_store:
+        return metadata_store.get_list('closed_chapters') or []
+    return list(_load_cached(CLOSED_CHAPTERS_FILE, []))
 
 
 def save_closed_chapters(chapters: list) -> None:
-    with open(CLOSED_CHAPTERS_FILE, 'w') as f:
-        json.dump(chapters, f)
+    if metadata_store:
+        metadata_store.set_list('closed_chapters', chapters)
+        return
+    write_text(CLOSED_CHAPTERS_FILE, json.dumps(chapters))
+    _forget_file(CLOSED_CHAPTERS_FILE)
 
 
 def load_settings():
@@ -94,7 +380,7 @@ def load_settings():
     if os.path.isfile(SETTINGS_FILE):
         with open(SETTINGS_FILE) as f:
             try:
-                data = json.load(f)
+                data = load_json(f)
                 defaults.update(data)
                 return defaults
             except json.JSONDecodeError:
@@ -103,8 +389,7 @@ def load_settings():
 
 
 def save_settings(data: dict) -> None:
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(data, f)
+    write_text(SETTINGS_FILE, json.dumps(data))
 
 
 def safe_name(name: str) -> str:
@@ -113,125 +398,78 @@ def safe_name(name: str) -> str:
     return ''.join(c for c in name if c.isalnum() or c in allowed).rstrip()
 
 
+@metrics.measure('html')
 def html_to_text(html: str) -> str:
     """Convert HTML to plain text."""
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html, "html.parser")
     return soup.get_text(separator="\n")
 
 
+_TAG_RE = re.compile(r'<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+
+
+def count_words(html: str) -> int:
+    """Count the words in chapter HTML without building a parse tree."""
+    return len(unescape(_TAG_RE.sub(' ', html)).split())
+
+
+def store_asset(data: bytes, ext: str) -> str:
+    """Save ``data`` in the asset store and return its file name."""
+    name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    path = os.path.join(ASSETS_DIR, name)
+    if not os.path.isfile(path):
+        journal.write(path, data)
+    return name
+
+
+def store_inline_images(html: str) -> str:
+    """Move base64 ``data:`` images into the asset store.
+
+    Each image is replaced by a link to its stored copy, so identical images
+    are kept once. Unsupported or malformed images are left for the
+    sanitizer to drop.
+    """
+    if 'data:' not in html:
+        return html
+    import base64
+    import binascii
+
+    def replace(match):
+        ext = ASSET_TYPES.get(match.group(3).lower())
+        if not ext:
+            return match.group(0)
+        try:
+            data = base64.b64decode(match.group(4))
+        except binascii.Error:
+            return match.group(0)
+        url = url_for('media_file', name=store_asset(data, ext))
+        return f'{match.group(1)}{match.group(2)}{url}{match.group(2)}'
+
+    return _DATA_IMAGE_RE.sub(replace, html)
+
+
+@metrics.measure('sanitize')
 def sanitize_html(html: str) -> str:
     """Strip unwanted tags to prevent script injection."""
-    allowed_tags = [
-        "b", "strong", "i", "em", "u", "p", "br", "div", "ul", "ol", "li", "hr",
-        "span", "img"
-    ]
-    allowed_attrs = {
-        "*": ["class", "style"],
-        "img": ["src", "alt", "width", "height", "style"]
-    }
-    return bleach.clean(html, tags=allowed_tags, attributes=allowed_attrs, strip=True)
+    return _sanitize(html)
 
 
-def html_to_docx(html: str, path: str) -> None:
-    """Save limited HTML content to a DOCX file."""
-    doc = Document()
-    soup = BeautifulSoup(html, "html.parser")
+parse_docx_blocks = metrics.measure('html')(docx_ir.parse_html)
 
-    def process(elem, paragraph, formatting=None):
-        if formatting is None:
-            formatting = {}
-        if isinstance(elem, str):
-            run = paragraph.add_run(elem)
-            run.bold = formatting.get("bold", False)
-            run.italic = formatting.get("italic", False)
-            run.underline = formatting.get("underline", False)
-            return
-        tag = elem.name
-        fmt = formatting.copy()
-        if tag in ("strong", "b"):
-            fmt["bold"] = True
-        if tag in ("em", "i"):
-            fmt["italic"] = True
-        if tag == "u":
-            fmt["underline"] = True
-        if tag == "img":
-            src = elem.get("src", "")
-            if src.startswith("data:image/"):
-                import base64
-                from io import BytesIO
-                header, b64 = src.split(",", 1)
-                data = base64.b64decode(b64)
-                bio = BytesIO(data)
-                width = elem.get("width")
-                height = elem.get("height")
-                w = Inches(int(width)/96) if width and width.isdigit() else None
-                h = Inches(int(height)/96) if height and height.isdigit() else None
-                doc.add_picture(bio, width=w, height=h)
-            return
-        if tag in ("p", "div", "br"):
-            p = doc.add_paragraph()
-            p.paragraph_format.first_line_indent = Inches(0.5)
-            for child in elem.children:
-                process(child, p, fmt)
-            return
-        for child in elem.children:
-            process(child, paragraph, fmt)
 
-    p = doc.add_paragraph()
-    p.paragraph_format.first_line_indent = Inches(0.5)
-    for child in soup.children:
-        process(child, p)
-    doc.save(path)
+def html_to_docx(html: str, path: str) -> None:
+    """Save limited HTML content to a DOCX file."""
+    blocks = parse_docx_blocks(html)
+    with metrics.timed('docx'):
+        docx_ir.render(blocks, asset_dir=ASSETS_DIR).save(path)
 
 
-def append_html_to_docx(doc: Document, html: str) -> None:
+def append_html_to_docx(doc: 'Document', html: str) -> None:
     """Append HTML content to an existing DOCX document."""
-    soup = BeautifulSoup(html, "html.parser")
-
-    def process(elem, paragraph, formatting=None):
-        if formatting is None:
-            formatting = {}
-        if isinstance(elem, str):
-            run = paragraph.add_run(elem)
-            run.bold = formatting.get("bold", False)
-            run.italic = formatting.get("italic", False)
-            run.underline = formatting.get("underline", False)
-            return
-        tag = elem.name
-        fmt = formatting.copy()
-        if tag in ("strong", "b"):
-            fmt["bold"] = True
-        if tag in ("em", "i"):
-            fmt["italic"] = True
-        if tag == "u":
-            fmt["underline"] = True
-        if tag == "img":
-            src = elem.get("src", "")
-            if src.startswith("data:image/"):
-                import base64
-                from io import BytesIO
-                header, b64 = src.split(",", 1)
-                data = base64.b64decode(b64)
-                bio = BytesIO(data)
-                width = elem.get("width")
-                height = elem.get("height")
-                w = Inches(int(width)/96) if width and width.isdigit() else None
-                h = Inches(int(height)/96) if height and height.isdigit() else None
-                doc.add_picture(bio, width=w, height=h)
-            return
-        if tag in ("p", "div", "br"):
-            p = doc.add_paragraph()
-            p.paragraph_format.first_line_indent = Inches(0.5)
-            for child in elem.children:
-                process(child, p, fmt)
-            return
-        for child in elem.children:
-            process(child, paragraph, fmt)
-
-    p = doc.add_paragraph()
-    p.paragraph_format.first_line_indent = Inches(0.5)
-    for child in soup.children:
-        process(child, p)
+    blocks = parse_docx_blocks(html)
+    with metrics.timed('docx'):
+        docx_ir.render(blocks, doc, ASSETS_DIR)
 
 
 def sanitize_path(folder: str) -> str:
@@ -241,45 +479,88 @@ def sanitize_path(folder: str) -> str:
 
 def load_order(folder: str) -> dict:
     """Load ordering info for a folder."""
+    if metadata_store:
+        return metadata_store.get_order(sanitize_path(folder))
     order_file = os.path.join(DATA_DIR, sanitize_path(folder), 'order.json')
-    if os.path.isfile(order_file):
-        try:
-            with open(order_file) as f:
-                data = json.load(f)
-                if 'folders' not in data:
-                    data['folders'] = []
-                if 'chapters' not in data:
-                    data['chapters'] = []
-                return data
-        except json.JSONDecodeError:
-            pass
-    return {'folders': [], 'chapters': []}
+    data = _load_cached(order_file, {})
+    if not isinstance(data, dict):
+        data = {}
+    data = dict(data)
+    data['folders'] = list(data.get('folders', []))
+    data['chapters'] = list(data.get('chapters', []))
+    return data
 
 
 def save_order(folder: str, order: dict) -> None:
-    os.makedirs(os.path.join(DATA_DIR, sanitize_path(folder)), exist_ok=True)
-    order_file = os.path.join(DATA_DIR, sanitize_path(folder), 'order.json')
-    with open(order_file, 'w') as f:
-        json.dump(order, f)
+    if metadata_store:
+        metadata_store.set_order(sanitize_path(folder), order)
+    else:
+        order_file = os.path.join(DATA_DIR, sanitize_path(folder), 'order.json')
+        write_text(order_file, json.dumps(order))
+        _forget_file(order_file)
+    with _cache_lock:
+        _tree_cache.pop(sanitize_path(folder), None)
+
+
+def _apply_order(names: list, order: list, ctimes: dict) -> list:
+    present = set(names)
+    ordered = [n for n in order if n in present]
+    seen = set(ordered)
+    remaining = sorted((n for n in names if n not in seen), key=ctimes.get)
+    return ordered + remaining
+
+
+def _scan_folder(folder: str):
+    """Return ``(dirs, subfolders, chapters)`` for a folder in display order.
+
+    Results come from the tree index while the directory and its
+    ``order.json`` are unchanged; otherwise the folder is rescanned.
+    """
+    folder = sanitize_path(folder)
+    path = os.path.join(DATA_DIR, folder)
+    if metadata_store:
+        order_sig = metadata_store.generation()
+    else:
+        order_sig = _file_signature(os.path.join(path, 'order.json'))
+    sig = (_file_signature(path), order_sig)
+    if sig[0] is None:
+        return [], [], []
+    with _cache_lock:
+        cached = _tree_cache.get(folder)
+    if cached and cached[0] == sig:
+        return cached[1]
+    dirs = []
+    chapters = set()
+    ctimes = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            dirs.append(entry.name)
+            ctimes[entry.name] = entry.stat().st_ctime
+            if is_chapter_dir(entry.path):
+                chapters.add(entry.name)
+    order = load_order(folder)
+    result = (
+        _apply_order(dirs, order['folders'], ctimes),
+        _apply_order([d for d in dirs if d not in chapters], order['folders'], ctimes),
+        _apply_order([d for d in dirs if d in chapters], order['chapters'], ctimes),
+    )
+    with _cache_lock:
+        _tree_cache[folder] = (sig, result)
+    return result
+
+
+def _closed_set(name: str, path: str) -> set:
+    if metadata_store:
+        return set(metadata_store.get_list(name) or [])
+    return set(_load_cached(path, []))
 
 
 def list_chapters(folder: str, include_closed: bool = False):
-    path = os.path.join(DATA_DIR, sanitize_path(folder))
-    if not os.path.isdir(path):
-        return []
-    chapters = [
-        c
-        for c in os.listdir(path)
-        if os.path.isdir(os.path.join(path, c))
-        and os.path.isfile(os.path.join(path, c, 'chapter.html'))
-    ]
-    order = load_order(folder).get('chapters', [])
-    ordered = [c for c in order if c in chapters]
-    remaining = [c for c in chapters if c not in ordered]
-    remaining.sort(key=lambda n: os.path.getctime(os.path.join(path, n)))
-    chapters = ordered + remaining
+    chapters = list(_scan_folder(folder)[2])
     if not include_closed:
-        closed = load_closed_chapters()
+        closed = _closed_set('closed_chapters', CLOSED_CHAPTERS_FILE)
         prefix = sanitize_path(folder)
         chapters = [c for c in chapters if f"{prefix}/{c}" not in closed]
     return chapters
@@ -287,40 +568,21 @@ def list_chapters(folder: str, include_closed: bool = False):
 
 
 def list_subfolders(folder: str, include_closed: bool = False):
-    path = os.path.join(DATA_DIR, sanitize_path(folder))
-    if not os.path.isdir(path):
-        return []
-    subs = [
-        c
-        for c in os.listdir(path)
-        if os.path.isdir(os.path.join(path, c))
-        and not os.path.isfile(os.path.join(path, c, 'chapter.html'))
-    ]
-    order = load_order(folder).get('folders', [])
-    ordered = [s for s in order if s in subs]
-    remaining = [s for s in subs if s not in ordered]
-    remaining.sort(key=lambda n: os.path.getctime(os.path.join(path, n)))
-    subs = ordered + remaining
+    subs = list(_scan_folder(folder)[1])
     if not include_closed:
-        closed = load_closed_folders()
+        closed = _closed_set('closed_folders', CLOSED_FOLDERS_FILE)
         prefix = sanitize_path(folder)
         subs = [s for s in subs if os.path.join(prefix, s) not in closed]
     return subs
 
 
 def list_all_books():
-    path = DATA_DIR
-    books = [f for f in os.listdir(path) if os.path.isdir(os.path.join(path, f))]
-    order = load_order('').get('folders', [])
-    ordered = [b for b in order if b in books]
-    remaining = [b for b in books if b not in ordered]
-    remaining.sort(key=lambda n: os.path.getctime(os.path.join(path, n)))
-    return ordered + remaining
+    return list(_scan_folder('')[0])
 
 
 def list_books():
     all_books = list_all_books()
-    open_books = load_open_books()
+    open_books = set(load_open_books())
     return [b for b in all_books if b in open_books]
 
 
@@ -339,6 +601,563 @@ def list_notes(folder: str, chapter: str):
     return []
 
 
+def content_hash(text: str) -> str:
+    """Return the revision of ``text`` as it reads back from disk."""
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()[:32]
+
+
+block_store = BlockStore(journal, LOCK_DIR, content_hash)
+
+
+def chapter_lock(path: str) -> FileLock:
+    """Return the lock held from checking a chapter's revision to saving it."""
+    return block_store.lock(path)
+
+
+def has_chapter_file(files) -> bool:
+    """Return True if a directory holding ``files`` is a chapter."""
+    return HTML_FILE in files or MANIFEST_FILE in files
+
+
+def is_chapter_dir(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, HTML_FILE)) or os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def chapter_manifest(path: str):
+    """Return the block manifest of the chapter at ``path``, or None if it is one file.
+
+    A chapter with both layouts (a conversion was interrupted) is read in
+    the configured one.
+    """
+    manifest = _load_cached(os.path.join(path, MANIFEST_FILE), None)
+    if manifest is None:
+        return None
+    if CHAPTER_STORAGE != 'blocks' and os.path.isfile(os.path.join(path, HTML_FILE)):
+        return None
+    return manifest
+
+
+def chapter_modified(path: str) -> float:
+    """Return the modification time of the chapter at ``path``."""
+    name = MANIFEST_FILE if chapter_manifest(path) is not None else HTML_FILE
+    return os.path.getmtime(os.path.join(path, name))
+
+
+def read_chapter_html(path: str) -> str:
+    """Return the stored HTML for the chapter directory ``path``."""
+    manifest = chapter_manifest(path)
+    if manifest is not None:
+        return block_store.read(path, manifest)
+    chapter_file = os.path.join(path, HTML_FILE)
+    if os.path.isfile(chapter_file):
+        with open(chapter_file) as f:
+            return f.read()
+    return ''
+
+
+def write_chapter_html(path: str, html: str, revision: str = None) -> None:
+    """Save chapter HTML in the CHAPTER_STORAGE layout, converting the chapter if needed."""
+    chapter_file = os.path.join(path, HTML_FILE)
+    manifest_file = os.path.join(path, MANIFEST_FILE)
+    if CHAPTER_STORAGE == 'blocks':
+        block_store.write(path, html, revision or content_hash(html), count_words)
+        _forget_file(manifest_file)
+        converted = os.path.isfile(chapter_file)
+    else:
+        write_text(chapter_file, html)
+        converted = os.path.isfile(manifest_file)
+    if not converted:
+        return
+    with block_store.lock(path):
+        # Make sure recovery cannot bring back the layout being removed.
+        journal.checkpoint()
+        if CHAPTER_STORAGE == 'blocks':
+            if os.path.isfile(chapter_file):
+                os.remove(chapter_file)
+        elif os.path.isfile(manifest_file):
+            import shutil
+            os.remove(manifest_file)
+            shutil.rmtree(os.path.join(path, BLOCKS_DIR), ignore_errors=True)
+            _forget_file(manifest_file)
+
+
+def chapter_revision(path: str) -> str:
+    """Return the revision of the chapter at ``path`` (see ``file_revision``)."""
+    manifest = chapter_manifest(path)
+    if manifest is not None:
+        return manifest['revision']
+    return file_revision(os.path.join(path, HTML_FILE))
+
+
+def chapter_word_count(path: str) -> int:
+    manifest = chapter_manifest(path)
+    if manifest is not None:
+        return sum(entry['words'] for entry in manifest['blocks'])
+    return count_words(read_chapter_html(path))
+
+
+def block_text(path: str, block_hash: str) -> str:
+    """Return the plain text of a stored block, cached by its hash."""
+    with _cache_lock:
+        text = _block_texts.get(block_hash)
+        if text is not None:
+            _block_texts.move_to_end(block_hash)
+            return text
+    text = html_to_text(block_store.read_block(path, block_hash))
+    with _cache_lock:
+        _block_texts[block_hash] = text
+        while len(_block_texts) > BLOCK_TEXT_CACHE_LIMIT:
+            _block_texts.popitem(last=False)
+    return text
+
+
+def chapter_text(path: str) -> str:
+    """Return the plain text of the chapter at ``path``.
+
+    In the block layout only blocks not seen before are parsed.
+    """
+    manifest = chapter_manifest(path)
+    if manifest is not None:
+        try:
+            return '\n'.join(block_text(path, entry['hash']) for entry in manifest['blocks'])
+        except FileNotFoundError:
+            # Saved again since the manifest was read.
+            pass
+    return html_to_text(read_chapter_html(path))
+
+
+def sanitize_chapter_html(path: str, html: str) -> str:
+    """Sanitize HTML about to be saved as the chapter at ``path``.
+
+    In the block layout, blocks the chapter already stores were sanitized
+    when they were saved, so only the others are sanitized again.
+    """
+    manifest = chapter_manifest(path) if CHAPTER_STORAGE == 'blocks' else None
+    if not manifest:
+        return sanitize_html(html)
+    stored = {entry['hash'] for entry in manifest['blocks']}
+    html = html.replace('\r\n', '\n').replace('\r', '\n')
+    return ''.join(
+        block if content_hash(block) in stored else sanitize_html(block)
+        for block in split_blocks(html)
+    )
+
+
+def file_revision(path: str) -> str:
+    """Return the content hash of a text file; a missing file counts as empty.
+
+    Hashes are cached while the file's mtime and size are unchanged.
+    """
+    signature = _file_signature(path)
+    if signature is None:
+        return content_hash('')
+    with _cache_lock:
+        cached = _content_hashes.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with open(path) as f:
+        revision = content_hash(f.read())
+    with _cache_lock:
+        _content_hashes[path] = (signature, revision)
+    return revision
+
+
+def remember_revision(path: str, revision: str) -> None:
+    """Record the hash of text just written to ``path``."""
+    signature = _file_signature(path)
+    with _cache_lock:
+        if signature:
+            _content_hashes[path] = (signature, revision)
+        else:
+            _content_hashes.pop(path, None)
+
+
+def revision_conflict(current: str) -> bool:
+    """Return True if the request expects a revision other than ``current``.
+
+    The expected revision comes from ``If-Match`` or a ``revision`` form
+    field; requests carrying neither are never treated as stale.
+    """
+    if request.if_match:
+        return not request.if_match.contains(current)
+    expected = request.form.get('revision')
+    return bool(expected) and expected != current
+
+
+def revision_response(body, status: int, revision: str):
+    """Build a save response carrying ``revision`` as its ETag."""
+    response = app.make_response((body, status))
+    response.set_etag(revision)
+    return response
+
+
+def not_modified(etag: str):
+    """Return a 304 response if the client already holds ``etag``, else ``None``.
+
+    Lets routes skip building a response the client has cached.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+    return None
+
+
+def remember_autosave_base(text: str) -> str:
+    """Keep ``text`` as a delta base and return its revision id."""
+    revision = hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()[:32]
+    with _cache_lock:
+        _autosave_bases.pop(revision, None)
+        _autosave_bases[revision] = text
+        total = sum(len(t) for t in _autosave_bases.values())
+        while total > AUTOSAVE_BASE_BYTES and len(_autosave_bases) > 1:
+            _, old = _autosave_bases.popitem(last=False)
+            total -= len(old)
+    return revision
+
+
+def autosave_base(revision: str):
+    """Return the text stored for ``revision`` or ``None`` if unknown."""
+    with _cache_lock:
+        text = _autosave_bases.get(revision)
+        if text is not None:
+            _autosave_bases.move_to_end(revision)
+        return text
+
+
+def apply_text_delta(base: str, ops: list) -> str:
+    """Apply ``[start, end, text]`` splices to ``base``.
+
+    Offsets count UTF-16 code units, as JavaScript strings do, and refer to
+    the unmodified base. Splices must be sorted and must not overlap.
+    Raises ``ValueError`` for malformed deltas.
+    """
+    data = base.encode('utf-16-le', 'surrogatepass')
+    length = len(data) // 2
+    parts = []
+    pos = 0
+    for op in ops:
+        if not isinstance(op, list) or len(op) != 3:
+            raise ValueError('invalid delta operation')
+        start, end, text = op
+        if not (isinstance(start, int) and isinstance(end, int) and isinstance(text, str)):
+            raise ValueError('invalid delta operation')
+        if not pos <= start <= end <= length:
+            raise ValueError('delta out of range')
+        parts.append(data[pos * 2:start * 2])
+        parts.append(text.encode('utf-16-le', 'surrogatepass'))
+        pos = end
+    parts.append(data[pos * 2:])
+    result = b''.join(parts).decode('utf-16-le', 'surrogatepass')
+    result.encode('utf-8')
+    return result
+
+
+def chapter_docx(html: str) -> str:
+    """Return the path of a DOCX built from ``html``.
+
+    Documents are cached under a hash of the HTML, so a chapter is only
+    converted again after its content changes.
+    """
+    digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+    path = os.path.join(DOCX_CACHE_DIR, digest + '.docx')
+    if os.path.isfile(path):
+        os.utime(path)
+        return path
+    os.makedirs(DOCX_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    html_to_docx(html, tmp_path)
+    os.replace(tmp_path, path)
+    _prune_docx_cache('.docx', DOCX_CACHE_LIMIT)
+    return path
+
+
+def _prune_docx_cache(suffix: str, limit: int) -> None:
+    """Remove the least recently used ``suffix`` files beyond ``limit``."""
+    try:
+        entries = [e for e in os.scandir(DOCX_CACHE_DIR) if e.name.endswith(suffix)]
+    except OSError:
+        return
+    if len(entries) <= limit:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - limit]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def get_docx_pool():
+    """Return the process pool for chapter conversion, or ``None`` if disabled."""
+    global _docx_pool
+    if _docx_pool is None and DOCX_WORKERS > 0:
+        from concurrent.futures import ProcessPoolExecutor
+        with _cache_lock:
+            if _docx_pool is None:
+                _docx_pool = ProcessPoolExecutor(max_workers=DOCX_WORKERS)
+    return _docx_pool
+
+
+def chapter_blocks(htmls: list) -> list:
+    """Return the parsed DOCX blocks of each chapter in ``htmls``.
+
+    Results are cached under a hash of the HTML. Chapters that changed are
+    parsed in the worker pool when there is more than one of them.
+    """
+    global _docx_pool
+    import pickle
+
+    digests = [hashlib.sha256(html.encode('utf-8')).hexdigest() for html in htmls]
+    results = [None] * len(htmls)
+    missing = []
+    for i, digest in enumerate(digests):
+        path = os.path.join(DOCX_CACHE_DIR, digest + '.ir')
+        try:
+            with open(path, 'rb') as f:
+                results[i] = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            missing.append(i)
+    if not missing:
+        return results
+
+    todo = [htmls[i] for i in missing]
+    converted = None
+    pool = get_docx_pool() if len(todo) > 1 else None
+    if pool:
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            with metrics.timed('html', len(todo)):
+                converted = list(pool.map(docx_ir.parse_html, todo))
+        except BrokenProcessPool:
+            app.logger.warning('DOCX worker pool failed; converting in process')
+            _docx_pool = None
+    if converted is None:
+        converted = [parse_docx_blocks(html) for html in todo]
+
+    os.makedirs(DOCX_CACHE_DIR, exist_ok=True)
+    for i, blocks in zip(missing, converted):
+        results[i] = blocks
+        path = os.path.join(DOCX_CACHE_DIR, digests[i] + '.ir')
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(blocks, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    _prune_docx_cache('.ir', DOCX_IR_CACHE_LIMIT)
+    return results
+
+
+def get_search_index():
+    """Return the search index, or ``None`` when FTS5 is unavailable."""
+    global _search_index
+    if _search_index is None:
+        from search_index import SearchIndex, fts_available
+        with _cache_lock:
+            if _search_index is None:
+                if fts_available():
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+                    _search_index = SearchIndex(SEARCH_DB)
+                else:
+                    _search_index = False
+    return _search_index or None
+
+
+def mark_search_dirty(folder: str, chapter: str, kind: str) -> None:
+    index = get_search_index()
+    if index:
+        index.mark_dirty(sanitize_path(folder), chapter, kind)
+
+
+def read_search_document(folder: str, chapter: str, kind: str):
+    """Return the current text of an indexed document, or ``None`` if gone."""
+    if kind in ('description', 'author'):
+        if not os.path.isdir(os.path.join(DATA_DIR, folder)):
+            return None
+        text = read_description(folder) if kind == 'description' else read_author(folder)
+        return text or None
+    path = os.path.join(DATA_DIR, folder, chapter)
+    if kind == 'notes':
+        note_path = os.path.join(path, note_filename(chapter))
+        if not os.path.isfile(note_path):
+            return None
+        with open(note_path) as f:
+            return f.read()
+    if not is_chapter_dir(path):
+        return None
+    return chapter_text(path)
+
+
+def iter_search_documents():
+    """Yield ``(folder, chapter, kind, text)`` for everything searchable."""
+    for root, dirs, files in os.walk(DATA_DIR):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        rel = os.path.relpath(root, DATA_DIR)
+        if rel == '.':
+            continue
+        parent, name = os.path.split(rel)
+        if has_chapter_file(files):
+            yield parent, name, 'chapter', read_search_document(parent, name, 'chapter')
+            if note_filename(name) in files:
+                yield parent, name, 'notes', read_search_document(parent, name, 'notes')
+            continue
+        for kind in ('description', 'author'):
+            text = read_search_document(rel, '', kind)
+            if text:
+                yield rel, '', kind, text
+
+
+def rebuild_search_index() -> int:
+    index = get_search_index()
+    if not index:
+        return 0
+    return index.rebuild(iter_search_documents())
+
+
+def refresh_search_index() -> None:
+    """Bring the index up to date with saves made since the last search."""
+    index = get_search_index()
+    if not index.is_built():
+        rebuild_search_index()
+        return
+    for folder, chapter, kind in index.dirty():
+        index.update(folder, chapter, kind, read_search_document(folder, chapter, kind))
+
+
+def iter_chapter_word_counts():
+    """Yield ``(path, words, modified)`` for every chapter in the library."""
+    for root, dirs, files in os.walk(DATA_DIR):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if has_chapter_file(files):
+            yield (
+                os.path.relpath(root, DATA_DIR),
+                chapter_word_count(root),
+                datetime.datetime.fromtimestamp(chapter_modified(root)),
+            )
+
+
+def get_wordcount_ledger():
+    """Return the word-count ledger, recording a baseline on first use.
+
+    Chapters written before the ledger existed are credited to the day they
+    were last modified.
+    """
+    global _wordcount_ledger
+    if _wordcount_ledger is None:
+        from wordcount_ledger import WordCountLedger
+        ledger = WordCountLedger(WORDCOUNT_DB)
+        # Seeding reads chapters through the file caches, so it cannot run
+        # under _cache_lock. Seeds skip chapters already recorded, which
+        # makes a concurrent one harmless, as with worker processes.
+        if not ledger.is_seeded():
+            ledger.seed(iter_chapter_word_counts())
+        with _cache_lock:
+            if _wordcount_ledger is None:
+                _wordcount_ledger = ledger
+    return _wordcount_ledger
+
+
+def record_word_count(folder: str, chapter: str, html: str) -> None:
+    path = os.path.join(sanitize_path(folder), chapter)
+    get_wordcount_ledger().record(path, count_words(html))
+
+
+def get_revision_store():
+    """Return the chapter revision history."""
+    global _revision_store
+    if _revision_store is None:
+        from revision_store import RevisionStore
+        with _cache_lock:
+            if _revision_store is None:
+                _revision_store = RevisionStore(REVISIONS_DB, REVISION_INTERVAL)
+    return _revision_store
+
+
+def record_revision(folder: str, chapter: str, html: str, revision: str) -> None:
+    """Add chapter HTML that is about to be saved to the chapter's history.
+
+    A chapter saved for the first time since history was enabled gets its
+    current text recorded first, dated by its modification time.
+    """
+    path = os.path.join(sanitize_path(folder), chapter)
+    store = get_revision_store()
+    first = not store.has_history(path)
+    if first:
+        chapter_dir = os.path.join(DATA_DIR, path)
+        previous = read_chapter_html(chapter_dir)
+        if previous:
+            modified = chapter_modified(chapter_dir)
+            store.record(
+                path, previous, content_hash(previous), count_words(previous),
+                datetime.datetime.fromtimestamp(modified),
+            )
+    store.record(path, html, revision, count_words(html), replace=not first)
+
+
+def get_change_feed():
+    """Return the library change feed."""
+    global _change_feed
+    if _change_feed is None:
+        from change_feed import ChangeFeed
+        with _cache_lock:
+            if _change_feed is None:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                _change_feed = ChangeFeed(CHANGES_DB)
+    return _change_feed
+
+
+def publish_change(action: str, kind: str, path: str, **data) -> None:
+    """Record a library change for open pages to pick up.
+
+    ``kind`` is "folder", "chapter" or "library"; for "reordered" ``path``
+    is the folder whose contents moved ('' for the books). Called once the
+    change is complete, so pages that fetch the affected listings straight
+    away see the final state.
+    """
+    get_change_feed().publish(action, sanitize_path(path), type=kind, **data)
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the full-text search index from the data directory."""
+    import click
+    click.echo(f'Indexed {rebuild_search_index()} documents')
+
+
+@app.cli.command('extract-images')
+def extract_images_command():
+    """Move inline images in existing chapters into the asset store."""
+    import click
+    changed = 0
+    with app.test_request_context():
+        for root, dirs, files in os.walk(DATA_DIR):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            if has_chapter_file(files):
+                html = read_chapter_html(root)
+                stored = store_inline_images(html)
+                if stored != html:
+                    write_chapter_html(root, stored)
+                    changed += 1
+    click.echo(f'Updated {changed} chapters')
+
+
+@app.cli.command('convert-chapters')
+def convert_chapters_command():
+    """Store every chapter in the layout set by CHAPTER_STORAGE."""
+    import click
+    name = MANIFEST_FILE if CHAPTER_STORAGE == 'blocks' else HTML_FILE
+    converted = 0
+    for root, dirs, files in os.walk(DATA_DIR):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if has_chapter_file(files) and (name not in files or {HTML_FILE, MANIFEST_FILE} <= set(files)):
+            html = read_chapter_html(root)
+            write_chapter_html(root, html)
+            converted += 1
+    click.echo(f'Converted {converted} chapters')
+
+
 app.jinja_env.globals['list_chapters'] = list_chapters
 app.jinja_env.globals['list_notes'] = list_notes
 app.jinja_env.globals['list_subfolders'] = list_subfolders
@@ -346,14 +1165,47 @@ app.jinja_env.globals['list_books'] = list_books
 app.jinja_env.globals['list_all_books'] = list_all_books
 
 
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    timing = metrics.finish_request(request.endpoint or 'unmatched', request.method,
+                                    response.status_code)
+    if timing and SERVER_TIMING:
+        response.headers['Server-Timing'] = metrics.server_timing(*timing)
+    return response
+
+
+# Registered after the metrics hook so it runs first and is timed with the
+# request.
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings, GZIP_MIN_BYTES, GZIP_LEVEL)
+
+
+def book_colors() -> dict:
+    if metadata_store:
+        stored = metadata_store.get_attrs('color')
+        return {b: stored.get(b, '') for b in list_all_books()}
+    return {b: read_color(b) for b in list_all_books()}
+
+
 @app.context_processor
 def inject_app_settings():
-    colors = {b: read_color(b) for b in list_all_books()}
-    return {'app_settings': load_settings(), 'book_colors': colors}
+    return {
+        'app_settings': load_settings(),
+        'book_colors': book_colors(),
+        'change_seq': get_change_feed().latest(),
+    }
 
 
 def read_description(folder: str) -> str:
     """Return description text for a folder if present."""
+    if metadata_store:
+        return metadata_store.get_attr(sanitize_path(folder), 'description')
     path = os.path.join(DATA_DIR, sanitize_path(folder), 'description.txt')
     if os.path.isfile(path):
         with open(path) as f:
@@ -362,13 +1214,16 @@ def read_description(folder: str) -> str:
 
 
 def write_description(folder: str, text: str) -> None:
-    os.makedirs(os.path.join(DATA_DIR, sanitize_path(folder)), exist_ok=True)
+    if metadata_store:
+        metadata_store.set_attr(sanitize_path(folder), 'description', text)
+        return
     path = os.path.join(DATA_DIR, sanitize_path(folder), 'description.txt')
-    with open(path, 'w') as f:
-        f.write(text)
+    write_text(path, text)
 
 def read_author(folder: str) -> str:
     """Return author text for a folder if present."""
+    if metadata_store:
+        return metadata_store.get_attr(sanitize_path(folder), 'author')
     path = os.path.join(DATA_DIR, sanitize_path(folder), 'author.txt')
     if os.path.isfile(path):
         with open(path) as f:
@@ -376,25 +1231,27 @@ def read_author(folder: str) -> str:
     return ''
 
 def write_author(folder: str, text: str) -> None:
-    os.makedirs(os.path.join(DATA_DIR, sanitize_path(folder)), exist_ok=True)
+    if metadata_store:
+        metadata_store.set_attr(sanitize_path(folder), 'author', text)
+        return
     path = os.path.join(DATA_DIR, sanitize_path(folder), 'author.txt')
-    with open(path, 'w') as f:
-        f.write(text)
+    write_text(path, text)
 
 def read_color(folder: str) -> str:
     """Return stored color for a book if set."""
+    if metadata_store:
+        return metadata_store.get_attr(sanitize_path(folder), 'color')
     path = os.path.join(DATA_DIR, sanitize_path(folder), 'color.txt')
-    if os.path.isfile(path):
-        with open(path) as f:
-            return f.read().strip()
-    return ''
+    return _load_cached(path, '', lambda f: f.read().strip())
 
 
 def write_color(folder: str, color: str) -> None:
-    os.makedirs(os.path.join(DATA_DIR, sanitize_path(folder)), exist_ok=True)
+    if metadata_store:
+        metadata_store.set_attr(sanitize_path(folder), 'color', color)
+        return
     path = os.path.join(DATA_DIR, sanitize_path(folder), 'color.txt')
-    with open(path, 'w') as f:
-        f.write(color)
+    write_text(path, color)
+    _forget_file(path)
 
 
 @app.route('/')
@@ -411,6 +1268,7 @@ def index():
 
 
 @app.route('/settings', methods=['GET', 'POST'])
+@locks_state('settings')
 def app_settings_page():
     settings = load_settings()
     if request.method == 'POST':
@@ -438,6 +1296,7 @@ def app_settings_page():
 
 
 @app.route('/folder/create', methods=['POST'])
+@locks_state('order', 'open_books')
 def create_folder():
     name = safe_name(request.form.get('name', ''))
     if not name:
@@ -445,6 +1304,7 @@ def create_folder():
         return redirect(url_for('index'))
     path = os.path.join(DATA_DIR, name)
     os.makedirs(path, exist_ok=True)
+    invalidate_tree(name)
     order = load_order('')
     if name not in order.get('folders', []):
         order.setdefault('folders', []).append(name)
@@ -453,10 +1313,12 @@ def create_folder():
     if name not in open_books:
         open_books.append(name)
         save_open_books(open_books)
+    publish_change('created', 'folder', name)
     return redirect(url_for('view_folder', folder=name))
 
 
 @app.route('/wizard/book', methods=['GET', 'POST'])
+@locks_state('order', 'open_books')
 def book_wizard():
     """Simple wizard to create a book with common sub-folders."""
     if request.method == 'POST':
@@ -472,6 +1334,7 @@ def book_wizard():
         os.makedirs(path, exist_ok=True)
         if author_text:
             write_author(title, author_text)
+            mark_search_dirty(title, '', 'author')
         if color_value:
             write_color(title, color_value)
         created = []
@@ -492,6 +1355,7 @@ def book_wizard():
             if sub_name:
                 os.makedirs(os.path.join(path, sub_name), exist_ok=True)
                 created.append(sub_name)
+        invalidate_tree(title)
         root_order = load_order('')
         if title not in root_order.get('folders', []):
             root_order.setdefault('folders', []).append(title)
@@ -506,19 +1370,23 @@ def book_wizard():
         if title not in open_books:
             open_books.append(title)
             save_open_books(open_books)
+        publish_change('created', 'folder', title)
         return redirect(url_for('view_folder', folder=title))
     folders = list_books()
     return render_template('book_wizard.html', folders=folders)
 
 
 @app.route('/folder/<path:folder>/delete', methods=['POST'])
+@locks_state('order', 'open_books')
 def delete_folder(folder):
     folder_name = sanitize_path(folder)
     path = os.path.join(DATA_DIR, folder_name)
     parent = os.path.dirname(folder_name)
-    if os.path.isdir(path):
+    deleted = os.path.isdir(path)
+    if deleted:
         import shutil
         shutil.rmtree(path)
+        path_deleted(folder_name)
         flash('Book deleted')
         if parent:
             order = load_order(parent)
@@ -528,6 +1396,8 @@ def delete_folder(folder):
     else:
         flash('Book not found')
     if parent:
+        if deleted:
+            publish_change('deleted', 'folder', folder_name)
         return redirect(url_for('view_folder', folder=parent))
     else:
         order = load_order('')
@@ -539,10 +1409,13 @@ def delete_folder(folder):
         if bname in open_books:
             open_books.remove(bname)
             save_open_books(open_books)
+    if deleted:
+        publish_change('deleted', 'folder', folder_name)
     return redirect(url_for('index'))
 
 
 @app.route('/folder/<path:folder>/close', methods=['POST'])
+@locks_state('closed_folders', 'open_books')
 def close_folder(folder):
     """Hide a book or sub-folder from the sidebar."""
     folder_name = sanitize_path(folder)
@@ -552,6 +1425,7 @@ def close_folder(folder):
         if folder_name not in closed:
             closed.append(folder_name)
             save_closed_folders(closed)
+            publish_change('closed', 'folder', folder_name)
         flash('Sub-folder closed')
         return redirect(url_for('view_folder', folder=parent))
     else:
@@ -559,11 +1433,13 @@ def close_folder(folder):
         if folder_name in open_books:
             open_books.remove(folder_name)
             save_open_books(open_books)
+            publish_change('closed', 'folder', folder_name)
         flash('Book closed')
         return redirect(url_for('index'))
 
 
 @app.route('/folder/<path:folder>/open', methods=['POST'])
+@locks_state('closed_folders', 'open_books')
 def open_folder(folder):
     """Show a previously closed book or sub-folder in the sidebar."""
     folder_name = sanitize_path(folder)
@@ -573,6 +1449,7 @@ def open_folder(folder):
         if folder_name in closed:
             closed.remove(folder_name)
             save_closed_folders(closed)
+            publish_change('opened', 'folder', folder_name)
         flash('Sub-folder opened')
         return redirect(url_for('view_folder', folder=parent))
     else:
@@ -580,11 +1457,13 @@ def open_folder(folder):
         if folder_name not in open_books:
             open_books.append(folder_name)
             save_open_books(open_books)
+            publish_change('opened', 'folder', folder_name)
         flash('Book opened')
         return redirect(url_for('view_folder', folder=folder_name))
 
 
 @app.route('/books/reorder', methods=['POST'])
+@locks_state('order')
 def reorder_books():
     """Reorder top level books."""
     order = load_order('')
@@ -592,6 +1471,7 @@ def reorder_books():
         items = request.json.get('order', [])
         order['folders'] = items
         save_order('', order)
+        publish_change('reordered', 'folder', '')
         return ('', 204)
     name = request.form.get('item_name')
     direction = request.form.get('direction')
@@ -604,10 +1484,12 @@ def reorder_books():
             items[idx], items[idx+1] = items[idx+1], items[idx]
         order['folders'] = items
         save_order('', order)
+        publish_change('reordered', 'folder', '')
     return redirect(url_for('index'))
 
 
 @app.route('/folder/<path:folder>/settings', methods=['GET', 'POST'])
+@locks_state('order', 'open_books')
 def folder_settings(folder):
     folder_name = sanitize_path(folder)
     path = os.path.join(DATA_DIR, folder_name)
@@ -633,6 +1515,7 @@ def folder_settings(folder):
                     items[idx], items[idx+1] = items[idx+1], items[idx]
                 order[f'{typ}s'] = items
                 save_order(folder_name, order)
+                publish_change('reordered', 'folder', folder_name)
             return redirect(url_for('folder_settings', folder=folder_name))
         new_name = safe_name(request.form.get('name', folder_name.split('/')[-1]))
         desc = request.form.get('description', '')
@@ -643,7 +1526,8 @@ def folder_settings(folder):
             if os.path.exists(new_path):
                 flash('Name already exists')
             else:
-                os.rename(path, new_path)
+                rename_path(path, new_path)
+                path_renamed(folder_name, os.path.join(os.path.dirname(folder_name), new_name))
                 parent = os.path.dirname(folder_name)
                 if parent:
                     parent_order = load_order(parent)
@@ -663,11 +1547,15 @@ def folder_settings(folder):
                     if old in open_books:
                         open_books[open_books.index(old)] = new_name
                         save_open_books(open_books)
-                folder_name = os.path.join(os.path.dirname(folder_name), new_name).strip('/')
+                renamed = os.path.join(os.path.dirname(folder_name), new_name).strip('/')
+                publish_change('renamed', 'folder', folder_name, to=renamed)
+                folder_name = renamed
                 path = new_path
                 flash('Book renamed')
         write_description(folder_name, desc)
         write_author(folder_name, author_text)
+        mark_search_dirty(folder_name, '', 'description')
+        mark_search_dirty(folder_name, '', 'author')
         if not parent:
             write_color(folder_name, color_value)
         return redirect(url_for('view_folder', folder=folder_name))
@@ -688,6 +1576,7 @@ def folder_settings(folder):
 
 
 @app.route('/folder/<path:folder>/reorder', methods=['POST'])
+@locks_state('order')
 def reorder_folder(folder):
     folder_name = sanitize_path(folder)
     order = load_order(folder_name)
@@ -697,6 +1586,7 @@ def reorder_folder(folder):
         if typ in ('folder', 'chapter'):
             order[f'{typ}s'] = items
             save_order(folder_name, order)
+            publish_change('reordered', 'folder', folder_name)
         return ('', 204)
     return redirect(url_for('folder_settings', folder=folder_name))
 
@@ -710,8 +1600,10 @@ def view_folder(folder):
         return redirect(url_for('index'))
     chapters = list_chapters(folder_name, include_closed=True)
     subfolders = list_subfolders(folder_name, include_closed=True)
-    closed_chapters = [c for c in chapters if f"{folder_name}/{c}" in load_closed_chapters()]
-    closed_subfolders = [s for s in subfolders if os.path.join(folder_name, s) in load_closed_folders()]
+    closed_chapter_keys = set(load_closed_chapters())
+    closed_folder_keys = set(load_closed_folders())
+    closed_chapters = [c for c in chapters if f"{folder_name}/{c}" in closed_chapter_keys]
+    closed_subfolders = [s for s in subfolders if os.path.join(folder_name, s) in closed_folder_keys]
     open_chapters = [c for c in chapters if c not in closed_chapters]
     open_subfolders = [s for s in subfolders if s not in closed_subfolders]
     chapters = open_chapters
@@ -722,7 +1614,123 @@ def view_folder(folder):
     return render_template('folder.html', folder=folder_name, chapters=chapters, subfolders=subfolders, folders=folders, description=description, author=author, closed_chapters=closed_chapters, closed_subfolders=closed_subfolders)
 
 
+def tree_level(folder_name: str) -> dict:
+    """Return one level of the sidebar tree ('' for the books).
+
+    Sub-folders and chapters are listed in display order, closed ones
+    included and flagged. ``children`` tells whether a sub-folder has
+    anything open to expand. Books that are not open count as closed.
+    """
+    if folder_name:
+        closed_folders = _closed_set('closed_folders', CLOSED_FOLDERS_FILE)
+    else:
+        closed_folders = set(list_all_books()) - set(load_open_books())
+    closed_chapters = _closed_set('closed_chapters', CLOSED_CHAPTERS_FILE)
+    folders = []
+    for name in list_subfolders(folder_name, include_closed=True):
+        sub = f"{folder_name}/{name}".lstrip('/')
+        folders.append({
+            'name': name,
+            'closed': sub in closed_folders,
+            'children': bool(list_subfolders(sub) or list_chapters(sub)),
+        })
+    chapters = [
+        {'name': name, 'closed': f"{folder_name}/{name}" in closed_chapters}
+        for name in list_chapters(folder_name, include_closed=True)
+    ]
+    return {'path': folder_name, 'folders': folders, 'chapters': chapters}
+
+
+@app.route('/books/children', defaults={'folder': ''})
+@app.route('/folder/<path:folder>/children')
+def folder_children(folder):
+    """Return one level of the sidebar tree as JSON (see ``tree_level``).
+
+    Responses carry an ETag, so the sidebar can revalidate its cached copy
+    cheaply.
+    """
+    folder_name = sanitize_path(folder)
+    if folder and (not folder_name or not os.path.isdir(os.path.join(DATA_DIR, folder_name))):
+        return jsonify({'error': 'not found'}), 404
+    response = jsonify(tree_level(folder_name))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def stream_changes(feed, since: int, seconds: float, retry: float):
+    """Yield server-sent events for the changes after ``since``.
+
+    The stream ends after ``seconds``, or once pending changes are sent
+    when that is 0; browsers reconnect ``retry`` seconds later.
+    """
+    yield f'retry: {int(retry * 1000)}\n\n'
+    deadline = time.monotonic() + seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        changes = feed.wait(since, min(max(remaining, 0), 15))
+        if changes is None:
+            since = feed.latest()
+            yield f'id: {since}\nevent: reset\ndata: {{}}\n\n'
+        elif not changes and remaining > 0:
+            # A comment keeps proxies from closing an idle connection.
+            yield ': keep-alive\n\n'
+        for change in changes or ():
+            since = change['seq']
+            yield f'id: {since}\ndata: {json.dumps(change)}\n\n'
+        if time.monotonic() >= deadline:
+            return
+
+
+@app.route('/changes')
+def changes():
+    """Send the library changes made after a sequence number.
+
+    ``since`` (or the ``Last-Event-ID`` header of a reconnecting
+    EventSource) is the last change the client has seen; pages get the
+    current one as ``data-change-seq``. Clients accepting
+    ``text/event-stream`` get server-sent events for up to
+    CHANGE_STREAM_SECONDS. Others get ``{"seq": ..., "changes": [...]}``
+    as soon as there is a change, or empty after ``timeout`` seconds (at
+    most 30). ``reset`` means the client missed changes and has to reload
+    what it shows. When CHANGE_STREAM_LIMIT requests are already waiting,
+    both kinds return pending changes without waiting.
+    """
+    feed = get_change_feed()
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args['since'])
+    except (KeyError, ValueError):
+        since = feed.latest()
+    waiting = _change_waiters.acquire(blocking=False)
+    if request.accept_mimetypes.best == 'text/event-stream':
+        if waiting:
+            events = stream_changes(feed, since, CHANGE_STREAM_SECONDS, 2)
+        else:
+            events = stream_changes(feed, since, 0, CHANGE_POLL_SECONDS)
+        response = Response(
+            events,
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+        if waiting:
+            response.call_on_close(_change_waiters.release)
+        return response
+    try:
+        timeout = min(max(float(request.args.get('timeout', 25)), 0), 30)
+    except ValueError:
+        timeout = 25
+    try:
+        changes = feed.wait(since, timeout if waiting else 0)
+    finally:
+        if waiting:
+            _change_waiters.release()
+    if changes is None:
+        return jsonify({'seq': feed.latest(), 'reset': True, 'changes': []})
+    return jsonify({'seq': changes[-1]['seq'] if changes else since, 'changes': changes})
+
+
 @app.route('/folder/<path:folder>/chapter/create', methods=['POST'])
+@locks_state('order')
 def create_chapter(folder):
     folder_name = sanitize_path(folder)
     chapter = safe_name(request.form.get('name', ''))
@@ -732,10 +1740,12 @@ def create_chapter(folder):
     path = os.path.join(DATA_DIR, folder_name, chapter)
     os.makedirs(path, exist_ok=True)
     open(os.path.join(path, 'chapter.html'), 'a').close()
+    invalidate_tree(os.path.join(folder_name, chapter))
     order = load_order(folder_name)
     if chapter not in order.get('chapters', []):
         order.setdefault('chapters', []).append(chapter)
         save_order(folder_name, order)
+    publish_change('created', 'chapter', f"{folder_name}/{chapter}")
     return redirect(url_for('view_chapter', folder=folder_name, chapter=chapter))
 
 
@@ -749,13 +1759,20 @@ def view_chapter(folder, chapter):
     if not os.path.isdir(path):
         flash('Chapter not found')
         return redirect(url_for('view_folder', folder=folder_name))
-    chapter_file = os.path.join(path, 'chapter.html')
-    chapter_html = ''
-    if os.path.isfile(chapter_file):
-        with open(chapter_file) as f:
-            chapter_html = f.read()
-
     notes_file = os.path.join(path, note_filename(chapter_name))
+    # The sidebar is left out: a page shown from the browser cache catches
+    # up with library changes through /changes. Pending flash messages have
+    # to be rendered, so they skip the shortcut.
+    etag = content_hash('\0'.join([
+        VERSION, chapter_revision(path), file_revision(notes_file),
+        json.dumps([load_settings(), {b: c for b, c in book_colors().items() if c}], sort_keys=True),
+    ]))
+    if '_flashes' not in session:
+        cached = not_modified(etag)
+        if cached:
+            return cached
+    chapter_html = read_chapter_html(path)
+
     notes_text = ''
     if os.path.isfile(notes_file):
         with open(notes_file) as f:
@@ -763,15 +1780,20 @@ def view_chapter(folder, chapter):
 
     folders = list_books()
     chapters = list_chapters(folder_name, include_closed=True)
-    return render_template(
+    response = make_response(render_template(
         'chapter.html',
         folder=folder_name,
         chapter=chapter_name,
         notes_text=notes_text,
         folders=folders,
         chapters=chapters,
-        chapter_html=chapter_html
-    )
+        chapter_html=chapter_html,
+        chapter_revision=content_hash(chapter_html),
+        notes_revision=content_hash(notes_text),
+    ))
+    response.cache_control.no_cache = True
+    response.set_etag(etag)
+    return response
 
 
 
@@ -783,46 +1805,206 @@ def save_notes(folder, chapter):
     chapter_name = safe_name(chapter)
     text = request.form.get('notes', '')
     path = os.path.join(DATA_DIR, folder_name, chapter_name)
-    os.makedirs(path, exist_ok=True)
     note_path = os.path.join(path, note_filename(chapter_name))
-    with open(note_path, 'w') as f:
-        f.write(text)
-    return ('', 204)
+    revision = content_hash(text)
+    with chapter_lock(path):
+        current = file_revision(note_path)
+        if revision == current:
+            return revision_response('', 204, current)
+        if revision_conflict(current):
+            return revision_response(jsonify(error='conflict'), 409, current)
+        write_text(note_path, text)
+        remember_revision(note_path, revision)
+    mark_search_dirty(folder_name, chapter_name, 'notes')
+    return revision_response('', 204, revision)
 
 
 @app.route('/folder/<path:folder>/chapter/<chapter>/save', methods=['POST'])
 def save_chapter(folder, chapter):
     folder_name = sanitize_path(folder)
     chapter_name = safe_name(chapter)
-    text = request.form.get('text', '')
-    text = sanitize_html(text)
     path = os.path.join(DATA_DIR, folder_name, chapter_name)
-    os.makedirs(path, exist_ok=True)
-    html_path = os.path.join(path, 'chapter.html')
-    with open(html_path, 'w') as f:
-        f.write(text)
-    docx_path = os.path.join(path, 'chapter.docx')
-    html_to_docx(text, docx_path)
+    text = sanitize_chapter_html(path, store_inline_images(request.form.get('text', '')))
+    result = save_chapter_revision(folder_name, chapter_name, path, text)
+    if result is None:
+        flash('This chapter was changed in another window; your save was not applied')
     return redirect(url_for('view_chapter', folder=folder_name, chapter=chapter_name))
 
 
+def save_chapter_revision(folder_name: str, chapter_name: str, path: str, text: str):
+    """Store sanitized chapter HTML unless it is unchanged or the editor is stale.
+
+    Returns the new revision, or ``None`` when the request's revision no
+    longer matches the stored chapter.
+    """
+    revision = content_hash(text)
+    with chapter_lock(path):
+        current = chapter_revision(path)
+        if revision == current:
+            return current
+        if revision_conflict(current):
+            return None
+        record_revision(folder_name, chapter_name, text, revision)
+        write_chapter_html(path, text, revision)
+        remember_revision(os.path.join(path, HTML_FILE), revision)
+    mark_search_dirty(folder_name, chapter_name, 'chapter')
+    record_word_count(folder_name, chapter_name, text)
+    return revision
+
+
 @app.route('/folder/<path:folder>/chapter/<chapter>/autosave', methods=['POST'])
 def autosave_chapter(folder, chapter):
     folder_name = sanitize_path(folder)
     chapter_name = safe_name(chapter)
-    text = request.form.get('text', '')
-    text = sanitize_html(text)
     path = os.path.join(DATA_DIR, folder_name, chapter_name)
-    os.makedirs(path, exist_ok=True)
-    html_path = os.path.join(path, 'chapter.html')
-    with open(html_path, 'w') as f:
-        f.write(text)
-    docx_path = os.path.join(path, 'chapter.docx')
-    html_to_docx(text, docx_path)
-    return ('', 204)
+    text = sanitize_chapter_html(path, store_inline_images(request.form.get('text', '')))
+    revision = save_chapter_revision(folder_name, chapter_name, path, text)
+    if revision is None:
+        return revision_response(jsonify(error='conflict'), 409, chapter_revision(path))
+    return revision_response('', 204, revision)
+
+
+@app.route('/folder/<path:folder>/chapter/<chapter>/autosave/delta', methods=['POST'])
+def autosave_chapter_delta(folder, chapter):
+    """Autosave from a diff against an earlier upload.
+
+    The JSON body holds either ``text`` (a full upload) or ``base`` and
+    ``ops`` (splices against the text of revision ``base``). Responds with
+    the new revision, or 409 when the base is unknown and the editor has
+    to send the full text. A stale ``If-Match`` gets a 409 ``conflict``.
+    """
+    folder_name = sanitize_path(folder)
+    chapter_name = safe_name(chapter)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    if isinstance(data.get('text'), str):
+        text = data['text']
+    else:
+        base = autosave_base(str(data.get('base', '')))
+        if base is None:
+            return jsonify(error='base_mismatch'), 409
+        try:
+            text = apply_text_delta(base, data.get('ops') or [])
+        except ValueError:
+            return jsonify(error='invalid_delta'), 400
+    path = os.path.join(DATA_DIR, folder_name, chapter_name)
+    saved = save_chapter_revision(
+        folder_name, chapter_name, path, sanitize_chapter_html(path, store_inline_images(text))
+    )
+    if saved is None:
+        return revision_response(jsonify(error='conflict'), 409, chapter_revision(path))
+    return revision_response(jsonify(revision=remember_autosave_base(text)), 200, saved)
+
+
+@app.route('/media/<name>')
+def media_file(name):
+    """Serve a stored image; names are content hashes, so they never change."""
+    if not re.fullmatch(r'[0-9a-f]{64}\.(?:png|jpg|gif|webp)', name):
+        return ('', 404)
+    response = send_from_directory(ASSETS_DIR, name, max_age=365 * 24 * 3600)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def revision_diff(old_html: str, new_html: str, old_label: str, new_label: str) -> list:
+    """Return a unified diff of the text of two chapter versions."""
+    import difflib
+    return list(difflib.unified_diff(
+        html_to_text(old_html).splitlines(),
+        html_to_text(new_html).splitlines(),
+        old_label, new_label, lineterm='',
+    ))
+
+
+def revision_info(row) -> dict:
+    rev_id, ts, revision, words, size = row
+    return {'id': rev_id, 'time': ts, 'revision': revision, 'words': words, 'size': size}
+
+
+@app.route('/folder/<path:folder>/chapter/<chapter>/revisions')
+def list_revisions(folder, chapter):
+    """Return the chapter's saved revisions, newest first."""
+    path = os.path.join(sanitize_path(folder), safe_name(chapter))
+    return jsonify(revisions=[revision_info(row) for row in get_revision_store().list(path)])
+
+
+@app.route('/folder/<path:folder>/chapter/<chapter>/revisions/<int:rev_id>')
+def get_revision(folder, chapter, rev_id):
+    """Return the HTML of one revision."""
+    path = os.path.join(sanitize_path(folder), safe_name(chapter))
+    html = get_revision_store().get(path, rev_id)
+    if html is None:
+        return jsonify(error='not_found'), 404
+    return jsonify(id=rev_id, html=html)
+
+
+@app.route('/folder/<path:folder>/chapter/<chapter>/revisions/<int:rev_id>/diff')
+def diff_revision(folder, chapter, rev_id):
+    """Diff a revision against ``against`` (a revision id) or the current chapter."""
+    folder_name = sanitize_path(folder)
+    chapter_name = safe_name(chapter)
+    path = os.path.join(folder_name, chapter_name)
+    store = get_revision_store()
+    html = store.get(path, rev_id)
+    against = request.args.get('against', type=int)
+    if against is None:
+        other = read_chapter_html(os.path.join(DATA_DIR, path))
+        label = 'current'
+    else:
+        other = store.get(path, against)
+        label = f'revision {against}'
+    if html is None or other is None:
+        return jsonify(error='not_found'), 404
+    return jsonify(diff=revision_diff(html, other, f'revision {rev_id}', label))
+
+
+@app.route('/folder/<path:folder>/chapter/<chapter>/revisions/<int:rev_id>/restore', methods=['POST'])
+def restore_revision(folder, chapter, rev_id):
+    """Save an earlier revision as the chapter's current text."""
+    folder_name = sanitize_path(folder)
+    chapter_name = safe_name(chapter)
+    html = get_revision_store().get(os.path.join(folder_name, chapter_name), rev_id)
+    if html is None:
+        flash('Revision not found')
+    else:
+        path = os.path.join(DATA_DIR, folder_name, chapter_name)
+        if save_chapter_revision(folder_name, chapter_name, path, html) is None:
+            flash('This chapter was changed in another window; the revision was not restored')
+        else:
+            flash('Revision restored')
+    return redirect(url_for('view_chapter', folder=folder_name, chapter=chapter_name))
+
+
+@app.route('/folder/<path:folder>/chapter/<chapter>/history')
+def chapter_history(folder, chapter):
+    """List a chapter's revisions and show the diff of one against the current text."""
+    folder_name = sanitize_path(folder)
+    chapter_name = safe_name(chapter)
+    path = os.path.join(folder_name, chapter_name)
+    store = get_revision_store()
+    revisions = [revision_info(row) for row in store.list(path)]
+    selected = request.args.get('rev', type=int)
+    diff = []
+    if selected is not None:
+        html = store.get(path, selected)
+        if html is not None:
+            current = read_chapter_html(os.path.join(DATA_DIR, path))
+            diff = revision_diff(html, current, f'revision {selected}', 'current')
+    return render_template(
+        'history.html',
+        folder=folder_name,
+        chapter=chapter_name,
+        folders=list_books(),
+        revisions=revisions,
+        selected=selected,
+        diff=diff,
+    )
 
 
 @app.route('/folder/<path:folder>/chapter/<chapter>/delete', methods=['POST'])
+@locks_state('order')
 def delete_chapter(folder, chapter):
     folder_name = sanitize_path(folder)
     chapter_name = safe_name(chapter)
@@ -830,17 +2012,20 @@ def delete_chapter(folder, chapter):
     if os.path.isdir(path):
         import shutil
         shutil.rmtree(path)
+        path_deleted(os.path.join(folder_name, chapter_name))
         flash('Chapter deleted')
         order = load_order(folder_name)
         if chapter_name in order.get('chapters', []):
             order['chapters'].remove(chapter_name)
             save_order(folder_name, order)
+        publish_change('deleted', 'chapter', f"{folder_name}/{chapter_name}")
     else:
         flash('Chapter not found')
     return redirect(url_for('view_folder', folder=folder_name))
 
 
 @app.route('/folder/<path:folder>/chapter/<chapter>/close', methods=['POST'])
+@locks_state('closed_chapters')
 def close_chapter(folder, chapter):
     """Hide a chapter from the sidebar."""
     folder_name = sanitize_path(folder)
@@ -850,11 +2035,13 @@ def close_chapter(folder, chapter):
     if key not in closed:
         closed.append(key)
         save_closed_chapters(closed)
+        publish_change('closed', 'chapter', key)
     flash('Chapter closed')
     return redirect(url_for('view_folder', folder=folder_name))
 
 
 @app.route('/folder/<path:folder>/chapter/<chapter>/open', methods=['POST'])
+@locks_state('closed_chapters')
 def open_chapter(folder, chapter):
     """Show a previously closed chapter."""
     folder_name = sanitize_path(folder)
@@ -864,11 +2051,13 @@ def open_chapter(folder, chapter):
     if key in closed:
         closed.remove(key)
         save_closed_chapters(closed)
+        publish_change('opened', 'chapter', key)
     flash('Chapter opened')
     return redirect(url_for('view_folder', folder=folder_name))
 
 
 @app.route('/folder/<path:folder>/chapter/<chapter>/rename', methods=['POST'])
+@locks_state('order')
 def rename_chapter(folder, chapter):
     folder_name = sanitize_path(folder)
     chapter_name = safe_name(chapter)
@@ -881,12 +2070,14 @@ def rename_chapter(folder, chapter):
     if os.path.exists(new_path):
         flash('Name already exists')
     else:
-        os.rename(old_path, new_path)
+        rename_path(old_path, new_path)
+        path_renamed(os.path.join(folder_name, chapter_name), os.path.join(folder_name, new_name))
         order = load_order(folder_name)
         if chapter_name in order.get('chapters', []):
             idx = order['chapters'].index(chapter_name)
             order['chapters'][idx] = new_name
             save_order(folder_name, order)
+        publish_change('renamed', 'chapter', f"{folder_name}/{chapter_name}", to=f"{folder_name}/{new_name}")
         flash('Chapter renamed')
     return redirect(url_for('folder_settings', folder=folder_name))
 
@@ -897,7 +2088,11 @@ def download_note(folder, chapter):
     chapter_name = safe_name(chapter)
     path = os.path.join(DATA_DIR, folder_name, chapter_name)
     note_name = note_filename(chapter_name)
-    return send_from_directory(path, note_name, as_attachment=True, download_name=note_name)
+    # The ETag is the note's save revision rather than its mtime.
+    etag = file_revision(os.path.join(path, note_name))
+    return not_modified(etag) or send_from_directory(
+        path, note_name, as_attachment=True, download_name=note_name, etag=etag
+    )
 
 
 @app.route('/folder/<path:folder>/chapter/<chapter>/chapter.docx')
@@ -905,6 +2100,9 @@ def download_chapter_docx(folder, chapter):
     folder_name = sanitize_path(folder)
     chapter_name = safe_name(chapter)
     path = os.path.join(DATA_DIR, folder_name, chapter_name)
+    if not os.path.isdir(path):
+        flash('Chapter not found')
+        return redirect(url_for('view_folder', folder=folder_name))
     book = folder_name.split('/')[0]
     author = read_author(book)
     parts = [book]
@@ -912,11 +2110,16 @@ def download_chapter_docx(folder, chapter):
         parts.append(author)
     parts.append(chapter_name)
     filename = " - ".join(parts) + ".docx"
-    return send_from_directory(
-        path,
-        'chapter.docx',
+    etag = content_hash('\0'.join([VERSION, filename, chapter_revision(path)]))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    docx_path = chapter_docx(read_chapter_html(path))
+    return send_file(
+        docx_path,
         as_attachment=True,
         download_name=filename,
+        etag=etag,
     )
 
 
@@ -934,34 +2137,44 @@ def download_combined_docx(folder):
     if not chapters:
         flash('No chapters to combine')
         return redirect(url_for('view_folder', folder=folder_name))
-    doc = Document()
-    for idx, chap in enumerate(chapters):
-        doc.add_heading(chap, level=1)
-        html_file = os.path.join(path, chap, 'chapter.html')
-        if os.path.isfile(html_file):
-            with open(html_file) as f:
-                append_html_to_docx(doc, f.read())
-        if idx < len(chapters) - 1:
-            doc.add_page_break()
-    from io import BytesIO
-    bio = BytesIO()
-    doc.save(bio)
-    bio.seek(0)
     book = folder_name.split('/')[0]
     author = read_author(book)
     parts = [book]
     if author:
         parts.append(author)
     filename = " - ".join(parts) + ".docx"
+    etag = content_hash('\0'.join([VERSION, filename] + [
+        chap + '\0' + chapter_revision(os.path.join(path, chap)) for chap in chapters
+    ]))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    htmls = [read_chapter_html(os.path.join(path, chap)) for chap in chapters]
+    parsed = chapter_blocks(htmls)
+    from io import BytesIO
+    from docx import Document
+    bio = BytesIO()
+    with metrics.timed('docx'):
+        doc = Document()
+        for idx, (chap, html, blocks) in enumerate(zip(chapters, htmls, parsed)):
+            doc.add_heading(chap, level=1)
+            if html:
+                docx_ir.render(blocks, doc, ASSETS_DIR)
+            if idx < len(chapters) - 1:
+                doc.add_page_break()
+        doc.save(bio)
+    bio.seek(0)
     return send_file(
         bio,
         as_attachment=True,
         download_name=filename,
+        etag=etag,
         mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
     )
 
 
 @app.route('/folder/<path:folder>/folder/create', methods=['POST'])
+@locks_state('order')
 def create_subfolder(folder):
     folder_name = sanitize_path(folder)
     name = safe_name(request.form.get('name', ''))
@@ -970,14 +2183,17 @@ def create_subfolder(folder):
         return redirect(url_for('view_folder', folder=folder_name))
     path = os.path.join(DATA_DIR, folder_name, name)
     os.makedirs(path, exist_ok=True)
+    invalidate_tree(os.path.join(folder_name, name))
     order = load_order(folder_name)
     if name not in order.get('folders', []):
         order.setdefault('folders', []).append(name)
         save_order(folder_name, order)
+    publish_change('created', 'folder', f"{folder_name}/{name}")
     return redirect(url_for('view_folder', folder=f"{folder_name}/{name}"))
 
 
 @app.route('/folder/<path:folder>/rename_subfolder/<sub>', methods=['POST'])
+@locks_state('order')
 def rename_subfolder(folder, sub):
     folder_name = sanitize_path(folder)
     sub_name = safe_name(sub)
@@ -990,37 +2206,434 @@ def rename_subfolder(folder, sub):
     if os.path.exists(new_path):
         flash('Name already exists')
     else:
-        os.rename(old_path, new_path)
+        rename_path(old_path, new_path)
+        path_renamed(os.path.join(folder_name, sub_name), os.path.join(folder_name, new_name))
         order = load_order(folder_name)
         if sub_name in order.get('folders', []):
             idx = order['folders'].index(sub_name)
             order['folders'][idx] = new_name
             save_order(folder_name, order)
+        publish_change('renamed', 'folder', f"{folder_name}/{sub_name}", to=f"{folder_name}/{new_name}")
         flash('Sub-folder renamed')
     return redirect(url_for('folder_settings', folder=folder_name))
 
 
+BATCH_OPERATIONS = (
+    'create_folder', 'create_chapter', 'rename_folder', 'rename_chapter', 'move_chapter',
+    'delete_folder', 'delete_chapter', 'close_folder', 'open_folder', 'close_chapter',
+    'open_chapter', 'reorder',
+)
+BATCH_MAX_OPERATIONS = 1000
+
+
+def _moved_path(path: str, old: str, new: str):
+    """Return ``path`` with the prefix ``old`` replaced by ``new``.
+
+    Returns None when ``path`` is neither ``old`` nor below it.
+    """
+    if path == old:
+        return new
+    if path.startswith(old + '/'):
+        return new + path[len(old):]
+    return None
+
+
+def _below(path: str, prefix: str) -> bool:
+    return _moved_path(path, prefix, '') is not None
+
+
+class BatchError(Exception):
+    """An operation in a batch that cannot be applied."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class BatchPlan:
+    """Structural changes checked against an in-memory copy of the library.
+
+    Each operation is validated against the state left by the ones before
+    it, and updates the copied folder listings, closed lists and open books.
+    Nothing is written until ``commit``, which performs the filesystem steps
+    (undoing them all if one fails) and then saves each changed order and
+    list once.
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.library_names = {}
+        self.created = set()
+        self.renames = []
+        self.dirty = set()
+        self.steps = []
+        self.changes = []
+        self.closed_folders = load_closed_folders()
+        self.closed_chapters = load_closed_chapters()
+        self.open_books = load_open_books()
+        self._saved_lists = (list(self.closed_folders), list(self.closed_chapters), list(self.open_books))
+
+    # Validation helpers
+
+    @staticmethod
+    def _name(op: dict, key: str = 'name') -> str:
+        name = safe_name(str(op.get(key) or ''))
+        if not name or name.startswith('.'):
+            raise BatchError(400, f'invalid {key}')
+        return name
+
+    @staticmethod
+    def _folder(op: dict, key: str = 'folder') -> str:
+        folder = sanitize_path(str(op.get(key) or ''))
+        if any(part.startswith('.') for part in folder.split('/')):
+            raise BatchError(400, f'invalid {key}')
+        return folder
+
+    def _origin(self, path: str) -> str:
+        """Return where ``path`` is on disk before the batch."""
+        for old, new in reversed(self.renames):
+            moved = _moved_path(path, new, old)
+            if moved is not None:
+                path = moved
+        return path
+
+    def listing(self, folder: str) -> dict:
+        if folder not in self.listings:
+            origin = self._origin(folder)
+            listing = {
+                'folders': list_subfolders(origin, include_closed=True),
+                'chapters': list_chapters(origin, include_closed=True),
+            }
+            self.listings[folder] = listing
+            self.library_names[folder] = set(listing['folders']) | set(listing['chapters'])
+        return self.listings[folder]
+
+    def folder_exists(self, folder: str) -> bool:
+        if not folder:
+            return True
+        parent, name = os.path.split(folder)
+        return self.folder_exists(parent) and name in self.listing(parent)['folders']
+
+    def _require(self, folder: str, name: str, kind: str) -> str:
+        path = f"{folder}/{name}".lstrip('/')
+        if not self.folder_exists(folder) or name not in self.listing(folder)[kind]:
+            raise BatchError(404, f'{path} not found')
+        return path
+
+    def _require_folder(self, folder: str, allow_root: bool = True) -> None:
+        if (not folder and not allow_root) or not self.folder_exists(folder):
+            raise BatchError(404, f'{folder or "/"} not found')
+
+    def _require_free(self, folder: str, name: str) -> str:
+        path = f"{folder}/{name}".lstrip('/')
+        listing = self.listing(folder)
+        taken = name in listing['folders'] or name in listing['chapters']
+        if not taken and folder not in self.created and name not in self.library_names[folder]:
+            # Files and directories that are not part of the library.
+            taken = os.path.lexists(os.path.join(DATA_DIR, self._origin(folder), name))
+        if taken:
+            raise BatchError(409, f'{path} already exists')
+        return path
+
+    # Bookkeeping
+
+    def _moved(self, old: str, new: str) -> None:
+        """Re-key everything recorded below ``old`` after a rename or move."""
+        def rekey(path):
+            moved = _moved_path(path, old, new)
+            return path if moved is None else moved
+
+        self.renames.append((old, new))
+        for key in [key for key in self.listings if _below(key, old)]:
+            self.listings[rekey(key)] = self.listings.pop(key)
+            self.library_names[rekey(key)] = self.library_names.pop(key)
+        self.created = {rekey(key) for key in self.created}
+        self.dirty = {rekey(key) for key in self.dirty}
+        for paths in (self.closed_folders, self.closed_chapters, self.open_books):
+            paths[:] = [rekey(p) for p in paths]
+        self.steps.append(('rename', old, new))
+
+    def _removed(self, path: str) -> None:
+        for key in [key for key in self.listings if _below(key, path)]:
+            del self.listings[key]
+            del self.library_names[key]
+        self.created = {key for key in self.created if not _below(key, path)}
+        self.dirty = {key for key in self.dirty if not _below(key, path)}
+        for paths in (self.closed_folders, self.closed_chapters, self.open_books):
+            paths[:] = [p for p in paths if not _below(p, path)]
+        self.steps.append(('delete', path))
+
+    # Operations
+
+    def apply(self, op) -> None:
+        if not isinstance(op, dict) or op.get('op') not in BATCH_OPERATIONS:
+            raise BatchError(400, 'unknown operation')
+        getattr(self, op['op'])(op)
+
+    def create_folder(self, op: dict) -> None:
+        folder, name = self._folder(op), self._name(op)
+        self._require_folder(folder)
+        path = self._require_free(folder, name)
+        self.listing(folder)['folders'].append(name)
+        self.listings[path] = {'folders': [], 'chapters': []}
+        self.library_names[path] = set()
+        self.created.add(path)
+        self.dirty.add(folder)
+        if not folder:
+            self.open_books.append(name)
+        self.steps.append(('mkdir', path, False))
+        self.changes.append(('created', 'folder', path, {}))
+
+    def create_chapter(self, op: dict) -> None:
+        folder, name = self._folder(op), self._name(op)
+        self._require_folder(folder, allow_root=False)
+        path = self._require_free(folder, name)
+        self.listing(folder)['chapters'].append(name)
+        self.dirty.add(folder)
+        self.steps.append(('mkdir', path, True))
+        self.changes.append(('created', 'chapter', path, {}))
+
+    def _rename(self, op: dict, kind: str) -> None:
+        folder, name, new_name = self._folder(op), self._name(op), self._name(op, 'new_name')
+        path = self._require(folder, name, kind + 's')
+        if new_name == name:
+            return
+        new_path = self._require_free(folder, new_name)
+        names = self.listing(folder)[kind + 's']
+        names[names.index(name)] = new_name
+        self.dirty.add(folder)
+        self._moved(path, new_path)
+        self.changes.append(('renamed', kind, path, {'to': new_path}))
+
+    def rename_folder(self, op: dict) -> None:
+        self._rename(op, 'folder')
+
+    def rename_chapter(self, op: dict) -> None:
+        self._rename(op, 'chapter')
+
+    def move_chapter(self, op: dict) -> None:
+        folder, name, target = self._folder(op), self._name(op), self._folder(op, 'to')
+        path = self._require(folder, name, 'chapters')
+        self._require_folder(target, allow_root=False)
+        index = op.get('index')
+        if index is not None and not isinstance(index, int):
+            raise BatchError(400, 'invalid index')
+        new_path = path if target == folder else self._require_free(target, name)
+        self.listing(folder)['chapters'].remove(name)
+        names = self.listing(target)['chapters']
+        names.insert(len(names) if index is None else index, name)
+        self.dirty.update((folder, target))
+        if new_path == path:
+            self.changes.append(('reordered', 'folder', folder, {}))
+        else:
+            self._moved(path, new_path)
+            self.changes.append(('moved', 'chapter', path, {'to': new_path}))
+
+    def _delete(self, op: dict, kind: str) -> None:
+        folder, name = self._folder(op), self._name(op)
+        path = self._require(folder, name, kind + 's')
+        self.listing(folder)[kind + 's'].remove(name)
+        self.dirty.add(folder)
+        self._removed(path)
+        self.changes.append(('deleted', kind, path, {}))
+
+    def delete_folder(self, op: dict) -> None:
+        self._delete(op, 'folder')
+
+    def delete_chapter(self, op: dict) -> None:
+        self._delete(op, 'chapter')
+
+    def _set_closed(self, op: dict, kind: str, closed: bool) -> None:
+        folder, name = self._folder(op), self._name(op)
+        path = self._require(folder, name, kind + 's')
+        if kind == 'folder' and not folder:
+            # Books are closed by leaving the list of open books.
+            paths, listed = self.open_books, not closed
+        else:
+            paths = self.closed_folders if kind == 'folder' else self.closed_chapters
+            listed = closed
+        if (path in paths) == listed:
+            return
+        if listed:
+            paths.append(path)
+        else:
+            paths.remove(path)
+        self.changes.append(('closed' if closed else 'opened', kind, path, {}))
+
+    def close_folder(self, op: dict) -> None:
+        self._set_closed(op, 'folder', True)
+
+    def open_folder(self, op: dict) -> None:
+        self._set_closed(op, 'folder', False)
+
+    def close_chapter(self, op: dict) -> None:
+        self._set_closed(op, 'chapter', True)
+
+    def open_chapter(self, op: dict) -> None:
+        self._set_closed(op, 'chapter', False)
+
+    def reorder(self, op: dict) -> None:
+        folder = self._folder(op)
+        self._require_folder(folder)
+        listing = self.listing(folder)
+        for kind in ('folders', 'chapters'):
+            names = op.get(kind)
+            if names is None:
+                continue
+            if not isinstance(names, list):
+                raise BatchError(400, f'invalid {kind}')
+            current = listing[kind]
+            given = [n for n in dict.fromkeys(names) if n in current]
+            listing[kind] = given + [n for n in current if n not in given]
+        self.dirty.add(folder)
+        self.changes.append(('reordered', 'folder', folder, {}))
+
+    # Writing
+
+    def affected(self) -> list:
+        """Return the existing folders whose listings the batch changed."""
+        folders = set(self.dirty)
+        for action, kind, path, extra in self.changes:
+            folders.add(path if action == 'reordered' else os.path.dirname(path))
+            if 'to' in extra:
+                folders.add(os.path.dirname(extra['to']))
+        return sorted(f for f in folders if self.folder_exists(f))
+
+    def commit(self) -> None:
+        """Apply the plan: filesystem first, then each changed order and list once."""
+        import shutil
+        import tempfile
+        journal.checkpoint()
+        undo = []
+        trash = None
+        try:
+            for step in self.steps:
+                path = os.path.join(DATA_DIR, step[1])
+                if step[0] == 'mkdir':
+                    os.mkdir(path)
+                    undo.append(functools.partial(shutil.rmtree, path))
+                    if step[2]:
+                        open(os.path.join(path, 'chapter.html'), 'a').close()
+                elif step[0] == 'rename':
+                    new_path = os.path.join(DATA_DIR, step[2])
+                    if os.path.lexists(new_path):
+                        raise FileExistsError(new_path)
+                    os.rename(path, new_path)
+                    undo.append(functools.partial(os.rename, new_path, path))
+                else:
+                    # Deleted items wait in the cache until everything succeeded.
+                    if trash is None:
+                        os.makedirs(CACHE_DIR, exist_ok=True)
+                        trash = tempfile.mkdtemp(prefix='trash-', dir=CACHE_DIR)
+                    kept = os.path.join(trash, str(len(undo)))
+                    os.rename(path, kept)
+                    undo.append(functools.partial(os.rename, kept, path))
+        except OSError:
+            for action in reversed(undo):
+                try:
+                    action()
+                except OSError:
+                    app.logger.exception('Could not undo a batch step')
+            invalidate_tree()
+            raise
+        finally:
+            if trash:
+                shutil.rmtree(trash, ignore_errors=True)
+
+        for step in self.steps:
+            if step[0] == 'mkdir':
+                invalidate_tree(step[1])
+            elif step[0] == 'rename':
+                path_renamed(step[1], step[2])
+            else:
+                path_deleted(step[1])
+        for folder in self.dirty:
+            if self.folder_exists(folder):
+                order = load_order(folder)
+                order['folders'] = self.listings[folder]['folders']
+                order['chapters'] = self.listings[folder]['chapters']
+                save_order(folder, order)
+        saved_folders, saved_chapters, saved_books = self._saved_lists
+        if self.closed_folders != saved_folders:
+            save_closed_folders(self.closed_folders)
+        if self.closed_chapters != saved_chapters:
+            save_closed_chapters(self.closed_chapters)
+        if self.open_books != saved_books:
+            save_open_books(self.open_books)
+        for action, kind, path, extra in self.changes:
+            publish_change(action, kind, path, **extra)
+
+
+@app.route('/batch', methods=['POST'])
+@locks_state('order', 'closed_folders', 'closed_chapters', 'open_books')
+def batch():
+    """Apply a list of structural changes as one.
+
+    Takes ``{"operations": [...]}``, where each operation has an ``op`` and
+    its arguments (``folder`` is the containing folder, '' for books):
+
+    - ``create_folder``, ``create_chapter``: ``folder``, ``name``
+    - ``rename_folder``, ``rename_chapter``: ``folder``, ``name``, ``new_name``
+    - ``move_chapter``: ``folder``, ``name``, ``to``, optional ``index``
+    - ``delete_folder``, ``delete_chapter``, ``close_folder``,
+      ``open_folder``, ``close_chapter``, ``open_chapter``: ``folder``, ``name``
+    - ``reorder``: ``folder``, and ``folders`` and/or ``chapters`` in their
+      new order
+
+    Either every operation is applied or none is: an invalid one gets
+    ``{"error", "index"}`` with status 400, 404 or 409 before anything is
+    written. On success the response holds the change feed position and the
+    new listing of each affected folder (as ``/folder/<path>/children``).
+    """
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list):
+        return jsonify({'error': 'expected {"operations": [...]}'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'at most {BATCH_MAX_OPERATIONS} operations'}), 400
+    plan = BatchPlan()
+    for index, op in enumerate(operations):
+        try:
+            plan.apply(op)
+        except BatchError as e:
+            return jsonify({'error': str(e), 'index': index}), e.status
+    try:
+        plan.commit()
+    except OSError as e:
+        app.logger.warning('Batch of %d operations failed: %s', len(operations), e)
+        return jsonify({'error': 'the changes could not be written'}), 500
+    return jsonify({
+        'seq': get_change_feed().latest(),
+        'folders': {folder: tree_level(folder) for folder in plan.affected()},
+    })
+
+
 @app.route('/folder/<path:folder>/stats')
 def folder_stats(folder):
+    """Show the folder's word count and words written per day, week or month.
+
+    ``days`` is the number of periods to show; 0 shows the whole history.
+    """
+    from wordcount_ledger import PERIODS, bucket
     folder_name = sanitize_path(folder)
-    path = os.path.join(DATA_DIR, folder_name)
     days = int(request.args.get('days', 7))
-    total_words = 0
-    words_per_day = {}
-    for root, dirs, files in os.walk(path):
-        if 'chapter.html' in files:
-            html_path = os.path.join(root, 'chapter.html')
-            with open(html_path) as f:
-                text = html_to_text(f.read())
-            count = len(text.split())
-            total_words += count
-            day = datetime.date.fromtimestamp(os.path.getmtime(html_path)).isoformat()
-            words_per_day[day] = words_per_day.get(day, 0) + count
-    sorted_days = sorted(words_per_day.keys())
+    period = request.args.get('period', 'day')
+    if period not in PERIODS:
+        period = 'day'
+    since = ''
     if days > 0:
-        cutoff = (datetime.date.today() - datetime.timedelta(days=days-1)).isoformat()
-        sorted_days = [d for d in sorted_days if d >= cutoff]
-    chart_labels = sorted(sorted_days)
+        today = datetime.date.today()
+        if period == 'month':
+            months = today.year * 12 + today.month - days
+            cutoff = datetime.date(months // 12, months % 12 + 1, 1)
+        else:
+            step = 7 if period == 'week' else 1
+            cutoff = today - datetime.timedelta(days=step * (days - 1))
+        since = bucket(period, cutoff)
+    ledger = get_wordcount_ledger()
+    total_words = ledger.total(folder_name)
+    words_per_day = ledger.series(period, folder_name, since)
+    chart_labels = list(words_per_day)
     chart_data = [words_per_day[d] for d in chart_labels]
     folders = list_books()
     return render_template(
@@ -1032,6 +2645,7 @@ def folder_stats(folder):
         chart_labels=chart_labels,
         chart_data=chart_data,
         days=days,
+        period=period,
     )
 
 
@@ -1049,27 +2663,95 @@ def changelog_page():
 
 @app.route('/search')
 def search():
+    """Search chapters, notes, descriptions and authors.
+
+    Quoted text matches a phrase and ``book`` limits results to one book.
+    """
     query = request.args.get('q', '').strip()
+    book = safe_name(request.args.get('book', ''))
     results = []
-    if query:
+    index = get_search_index()
+    if query and index:
+        from search_index import MATCH_START, MATCH_END
+        refresh_search_index()
+        results = index.search(query, book=book)
+        for r in results:
+            r['snippet'] = Markup(
+                escape(r['snippet'])
+                .replace(MATCH_START, Markup('<mark>'))
+                .replace(MATCH_END, Markup('</mark>'))
+            )
+    elif query:
         qlower = query.lower()
-        for root, dirs, files in os.walk(DATA_DIR):
+        for root, dirs, files in os.walk(os.path.join(DATA_DIR, book)):
             rel = os.path.relpath(root, DATA_DIR)
-            if 'chapter.html' in files:
+            if has_chapter_file(files):
                 chap = os.path.basename(root)
-                with open(os.path.join(root, 'chapter.html')) as f:
-                    text = html_to_text(f.read())
+                text = chapter_text(root)
                 if qlower in text.lower():
-                    results.append({'folder': rel, 'chapter': chap, 'type': 'chapter'})
+                    results.append({'folder': os.path.dirname(rel), 'chapter': chap, 'type': 'chapter'})
             for fn in files:
                 if fn.endswith('_notes.txt'):
                     chap = os.path.basename(root)
                     with open(os.path.join(root, fn)) as nf:
                         text = nf.read()
                     if qlower in text.lower():
-                        results.append({'folder': rel, 'chapter': chap, 'type': 'notes'})
+                        results.append({'folder': os.path.dirname(rel), 'chapter': chap, 'type': 'notes'})
     folders = list_books()
-    return render_template('search.html', q=query, results=results, folders=folders)
+    return render_template(
+        'search.html',
+        q=query,
+        book=book,
+        all_books=list_all_books(),
+        results=results,
+        folders=folders,
+    )
+
+
+# Static files are linked with a hash of their content (?v=...), and
+# responses for the current hash may be cached for a year.
+STATIC_MAX_AGE = 365 * 24 * 3600
+_fingerprints = {}
+
+
+def static_fingerprint(endpoint: str, filename: str):
+    """Return a short content hash of a static or bundled asset file."""
+    folder = app.static_folder if endpoint == 'static' else os.path.join(app.root_path, 'assets')
+    path = safe_join(folder, filename)
+    signature = _file_signature(path) if path else None
+    if signature is None:
+        return None
+    with _cache_lock:
+        cached = _fingerprints.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with open(path, 'rb') as f:
+        fingerprint = hashlib.sha256(f.read()).hexdigest()[:12]
+    with _cache_lock:
+        _fingerprints[path] = (signature, fingerprint)
+    return fingerprint
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint in ('static', 'asset_file') and 'filename' in values and 'v' not in values:
+        fingerprint = static_fingerprint(endpoint, values['filename'])
+        if fingerprint:
+            values['v'] = fingerprint
+
+
+@app.after_request
+def cache_fingerprinted_files(response):
+    if request.endpoint not in ('static', 'asset_file') or response.status_code not in (200, 304):
+        return response
+    version = request.args.get('v')
+    if version and version == static_fingerprint(request.endpoint, request.view_args['filename']):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+        response.expires = None
+    return response
 
 
 @app.route('/assets/<path:filename>')
@@ -1079,6 +2761,14 @@ def asset_file(filename):
     return send_from_directory(path, filename)
 
 
+@app.route('/metrics')
+def metrics_page():
+    """Serve request metrics in the Prometheus text format."""
+    if not METRICS:
+        return 'Metrics are disabled', 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/help')
 def help_page():
     """Display a basic help page."""
@@ -1086,51 +2776,150 @@ def help_page():
     return render_template('help.html', folders=folders)
 
 
-@app.route('/download_database')
-def download_database():
-    """Download the entire data directory as a zip file."""
-    from io import BytesIO
+def checkpoint_databases() -> None:
+    """Flush SQLite write-ahead logs so the database files are complete."""
+    if metadata_store:
+        metadata_store.checkpoint()
+    get_wordcount_ledger().checkpoint()
+    get_revision_store().checkpoint()
+
+
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+
+class _ArchiveBuffer:
+    """Write-only sink that hands zip output to a streaming response."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_data_archive(extra_files: dict = None):
+    """Yield a zip archive of the data directory chunk by chunk.
+
+    Files are read and compressed ``ARCHIVE_CHUNK_SIZE`` bytes at a time,
+    so memory stays flat however large the library is. ``extra_files`` maps
+    archive names to contents added at the end.
+    """
     import zipfile
 
-    mem = BytesIO()
-    with zipfile.ZipFile(mem, 'w', zipfile.ZIP_DEFLATED) as zf:
+    out = _ArchiveBuffer()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
         for root, dirs, files in os.walk(DATA_DIR):
+            if root == DATA_DIR:
+                dirs[:] = [
+                    d for d in dirs if os.path.join(root, d) not in (CACHE_DIR, JOURNAL_DIR, LOCK_DIR)
+                ]
             for fname in files:
+                if fname.endswith(('.db-wal', '.db-shm')):
+                    continue
                 path = os.path.join(root, fname)
                 rel = os.path.relpath(path, DATA_DIR)
-                zf.write(path, rel)
-    mem.seek(0)
-    return send_file(mem, as_attachment=True, download_name='calwriter_data.zip', mimetype='application/zip')
+                try:
+                    info = zipfile.ZipInfo.from_file(path, rel, strict_timestamps=False)
+                    src = open(path, 'rb')
+                except FileNotFoundError:
+                    continue
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with src, zf.open(info, 'w') as dest:
+                    while chunk := src.read(ARCHIVE_CHUNK_SIZE):
+                        dest.write(chunk)
+                        if out.chunks:
+                            yield out.drain()
+                if out.chunks:
+                    yield out.drain()
+        for name, data in (extra_files or {}).items():
+            zf.writestr(name, data)
+    yield out.drain()
+
+
+def archive_response(filename: str, mimetype: str, extra_files: dict = None):
+    """Return a streaming download of the data directory."""
+    checkpoint_databases()
+    response = Response(iter_data_archive(extra_files), mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/download_database')
+def download_database():
+    """Download the entire data directory as a zip file."""
+    return archive_response('calwriter_data.zip', 'application/zip')
 
 
 @app.route('/export_db')
 def export_db():
     """Export the database as a .calwdb archive."""
-    from io import BytesIO
-    import zipfile
-
-    mem = BytesIO()
-    with zipfile.ZipFile(mem, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(DATA_DIR):
-            for fname in files:
-                path = os.path.join(root, fname)
-                rel = os.path.relpath(path, DATA_DIR)
-                zf.write(path, rel)
-        metadata_path = os.path.join(DATA_DIR, 'metadata.json')
-        if not os.path.isfile(metadata_path):
-            zf.writestr('metadata.json', json.dumps({'version': VERSION}))
-    mem.seek(0)
+    extra = {}
+    if not os.path.isfile(os.path.join(DATA_DIR, 'metadata.json')):
+        extra['metadata.json'] = json.dumps({'version': VERSION})
     timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
     filename = f"calwriter - {timestamp}.calwdb"
-    return send_file(
-        mem,
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/x-calwriter-db',
-    )
+    return archive_response(filename, 'application/x-calwriter-db', extra)
+
+
+def check_import_archive(infos: list):
+    """Return an error message if an archive breaks the import limits."""
+    names = {info.filename for info in infos}
+    missing = [r for r in ('metadata.json', 'settings.json') if r not in names]
+    if missing:
+        return 'Archive is missing: ' + ', '.join(missing)
+    for info in infos:
+        name = info.filename
+        if name.startswith('/') or '\\' in name or '..' in name.split('/'):
+            return 'Invalid path in archive'
+    if len(infos) > IMPORT_MAX_ENTRIES:
+        return f'Archive has too many entries (limit {IMPORT_MAX_ENTRIES})'
+    total = sum(info.file_size for info in infos)
+    if total > IMPORT_MAX_BYTES:
+        return f'Archive is too large (limit {IMPORT_MAX_BYTES // 1024 ** 2} MB)'
+    compressed = sum(info.compress_size for info in infos)
+    if total > 1024 ** 2 and total > compressed * IMPORT_MAX_RATIO:
+        return 'Archive compression ratio is suspiciously high'
+    return None
+
+
+def extract_import_entry(zf, info, dest: str) -> int:
+    """Stream one archive entry to ``dest`` through a temporary file.
+
+    The entry only replaces ``dest`` once it has been read completely and
+    its checksum verified. Returns the number of bytes written.
+    """
+    import tempfile
+
+    folder = os.path.dirname(dest)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.import-')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as out, zf.open(info) as src:
+            while chunk := src.read(ARCHIVE_CHUNK_SIZE):
+                written += len(chunk)
+                if written > info.file_size:
+                    raise ValueError(f'{info.filename} is larger than declared')
+                out.write(chunk)
+        os.replace(tmp, dest)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return written
 
 
 @app.route('/import_db', methods=['POST'])
+@locks_state(*STATE_LOCKS)
 def import_db():
     """Import a .calwdb archive into the data directory."""
     file = request.files.get('file')
@@ -1138,35 +2927,65 @@ def import_db():
         flash('Invalid file')
         return redirect(url_for('index'))
     import zipfile
-    import tempfile
-    import shutil
+    import zlib
 
+    # Live database files are never replaced; their rows are merged instead.
+    stores = {
+        'metadata.db': metadata_store,
+        'wordcounts.db': get_wordcount_ledger(),
+        'revisions.db': get_revision_store(),
+    }
+    merged = {name for name, store in stores.items() if store}
+    skipped = {name + suffix for name in merged for suffix in ('-wal', '-shm')}
+    journal.checkpoint()
     try:
         with zipfile.ZipFile(file) as zf:
-            names = zf.namelist()
-            required = {'metadata.json', 'settings.json'}
-            missing = [r for r in required if r not in names]
-            if missing:
-                flash('Archive is missing: ' + ', '.join(missing))
+            infos = zf.infolist()
+            error = check_import_archive(infos)
+            if error:
+                flash(error)
                 return redirect(url_for('index'))
-            for name in names:
-                if name.startswith('/') or '..' in name.split('/'):
-                    flash('Invalid path in archive')
-                    return redirect(url_for('index'))
-            temp_dir = tempfile.mkdtemp()
-            zf.extractall(temp_dir)
-    except zipfile.BadZipFile:
+            total = sum(info.file_size for info in infos) or 1
+            done = 0
+            reported = 0
+            for info in infos:
+                if info.is_dir():
+                    os.makedirs(os.path.join(DATA_DIR, info.filename), exist_ok=True)
+                    continue
+                if info.filename in skipped or info.filename.startswith(('.journal/', '.locks/')):
+                    continue
+                if info.filename in merged:
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+                    incoming = os.path.join(CACHE_DIR, 'import-' + info.filename)
+                    done += extract_import_entry(zf, info, incoming)
+                    try:
+                        stores[info.filename].merge_database(incoming)
+                    finally:
+                        for suffix in ('', '-wal', '-shm'):
+                            if os.path.exists(incoming + suffix):
+                                os.remove(incoming + suffix)
+                else:
+                    dest = os.path.join(DATA_DIR, *info.filename.split('/'))
+                    done += extract_import_entry(zf, info, dest)
+                if done * 10 // total > reported:
+                    reported = done * 10 // total
+                    app.logger.info('Importing %s: %d%% (%d bytes)', file.filename, reported * 10, done)
+    except (zipfile.BadZipFile, zlib.error, ValueError) as e:
+        app.logger.warning('Import of %s failed: %s', file.filename, e)
         flash('File is not a valid archive')
         return redirect(url_for('index'))
-
-    for root, dirs, files in os.walk(temp_dir):
-        rel = os.path.relpath(root, temp_dir)
-        dest = os.path.join(DATA_DIR, rel) if rel != '.' else DATA_DIR
-        os.makedirs(dest, exist_ok=True)
-        for fname in files:
-            shutil.move(os.path.join(root, fname), os.path.join(dest, fname))
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    flash('Database imported')
+    finally:
+        invalidate_tree()
+
+    names = {info.filename for info in infos}
+    if metadata_store and 'metadata.db' not in names:
+        metadata_store.migrate_from_files(DATA_DIR, force=True, only=names)
+    index = get_search_index()
+    if index:
+        index.invalidate()
+    get_wordcount_ledger().seed(iter_chapter_word_counts())
+    publish_change('imported', 'library', '')
+    flash(f'Database imported ({len(infos)} files, {done / 1024 ** 2:.1f} MB)')
     return redirect(url_for('index'))
 
 
@@ -1177,5 +2996,34 @@ def about_page():
     return render_template('about.html', folders=folders)
 
 
+def prewarm() -> None:
+    """Do the loading that would otherwise slow the first requests."""
+    html_to_text('<p></p>')
+    sanitizer.clean_bleach('<p></p>')
+    docx_ir.render(docx_ir.parse_html('<p>CalWriter</p>'))
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    get_search_index()
+    get_wordcount_ledger()
+    get_revision_store()
+    get_change_feed()
+
+
+def close_databases() -> None:
+    """Close the connections this thread has open to the SQLite stores."""
+    for store in (metadata_store, _search_index, _wordcount_ledger, _revision_store, _change_feed):
+        if store:
+            store.close()
+
+
+if PREWARM:
+    prewarm()
+# Under Gunicorn's preload_app, workers are forked from the process that
+# imported the app. A SQLite connection must not be shared across a fork:
+# a child closing its inherited copy would release locks the parent holds.
+# The stores reopen their connections on first use in each process.
+close_databases()
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,139 @@
+"""Generate a deterministic synthetic CalWriter library.
+
+Usage: python benchmarks/corpus.py DATA_DIR [--books N] [--depth D]
+       [--subfolders S] [--chapters M] [--paragraphs P] [--images] [--notes]
+
+Each book gets ``subfolders`` sub-folders per level, ``depth`` levels deep,
+and every folder at the deepest level holds ``chapters`` chapters of about
+``paragraphs`` paragraphs. The same options and seed always produce the
+same files, so benchmark runs on different commits see identical input.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import struct
+import zlib
+
+WORDS = (
+    'the of and a to in was he she it that with for as his her on at by had '
+    'river lantern harbour whisper stone morning letter window silver crow '
+    'forgotten quietly against beneath thunder garden captain promise'
+).split()
+
+
+def png(width: int, height: int, seed: int) -> bytes:
+    """Return a small solid-colour PNG."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    pixel = bytes(((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+    rows = b''.join(b'\x00' + pixel * width for _ in range(height))
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(rows))
+        + chunk(b'IEND', b'')
+    )
+
+
+def sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + '.'
+
+
+def chapter_html(rng: random.Random, paragraphs: int, images: bool) -> str:
+    """Return editor-style chapter HTML."""
+    parts = []
+    for i in range(paragraphs):
+        text = ' '.join(sentence(rng) for _ in range(rng.randint(2, 6)))
+        words = text.split(' ')
+        if rng.random() < 0.3:
+            k = rng.randrange(len(words))
+            words[k] = f'<b>{words[k]}</b>'
+        if rng.random() < 0.2:
+            k = rng.randrange(len(words))
+            words[k] = f'<i>{words[k]}</i>'
+        parts.append(f'<p>{" ".join(words)}</p>')
+        if images and i % 50 == 25:
+            data = base64.b64encode(png(16, 12, rng.randrange(1000))).decode()
+            parts.append(f'<p><img src="data:image/png;base64,{data}" width="160" height="120"></p>')
+    return ''.join(parts)
+
+
+def generate(data_dir: str, books: int = 3, depth: int = 1, subfolders: int = 2,
+             chapters: int = 10, paragraphs: int = 40, images: bool = False,
+             notes: bool = False, seed: int = 1) -> dict:
+    """Write the library into ``data_dir`` and return a summary of it."""
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    summary = {'books': [], 'folders': [], 'chapters': 0, 'bytes': 0}
+
+    def write(path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+        summary['bytes'] += len(text.encode('utf-8'))
+
+    def folder(rel: str, level: int):
+        path = os.path.join(data_dir, rel)
+        os.makedirs(path, exist_ok=True)
+        if level == depth:
+            names = [f'Chapter {i + 1:03d}' for i in range(chapters)]
+            for name in names:
+                os.makedirs(os.path.join(path, name), exist_ok=True)
+                write(os.path.join(path, name, 'chapter.html'), chapter_html(rng, paragraphs, images))
+                if notes:
+                    note = name.replace(' ', '_') + '_notes.txt'
+                    write(os.path.join(path, name, note), '\n'.join(sentence(rng) for _ in range(5)))
+            summary['chapters'] += len(names)
+            summary['folders'].append(rel)
+            write(os.path.join(path, 'order.json'), json.dumps({'folders': [], 'chapters': names}))
+            return
+        names = [f'Part {i + 1}' for i in range(subfolders)]
+        for name in names:
+            folder(f'{rel}/{name}', level + 1)
+        write(os.path.join(path, 'order.json'), json.dumps({'folders': names, 'chapters': []}))
+
+    titles = [f'Book {i + 1}' for i in range(books)]
+    for title in titles:
+        folder(title, 0)
+        write(os.path.join(data_dir, title, 'author.txt'), 'A. Writer')
+        write(os.path.join(data_dir, title, 'description.txt'), sentence(rng))
+        summary['books'].append(title)
+    write(os.path.join(data_dir, 'order.json'), json.dumps({'folders': titles, 'chapters': []}))
+    write(os.path.join(data_dir, 'open_books.json'), json.dumps(titles))
+    write(os.path.join(data_dir, 'settings.json'), json.dumps({}))
+    return summary
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--books', type=int, default=3)
+    parser.add_argument('--depth', type=int, default=1, help='sub-folder levels per book')
+    parser.add_argument('--subfolders', type=int, default=2, help='sub-folders per level')
+    parser.add_argument('--chapters', type=int, default=10, help='chapters per deepest folder')
+    parser.add_argument('--paragraphs', type=int, default=40, help='paragraphs per chapter')
+    parser.add_argument('--images', action='store_true', help='add inline images to chapters')
+    parser.add_argument('--notes', action='store_true', help='add a notes file to every chapter')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def corpus_options(args: argparse.Namespace) -> dict:
+    return {
+        name: getattr(args, name)
+        for name in ('books', 'depth', 'subfolders', 'chapters', 'paragraphs', 'images', 'notes', 'seed')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_dir')
+    add_arguments(parser)
+    args = parser.parse_args()
+    summary = generate(args.data_dir, **corpus_options(args))
+    print(f"{len(summary['books'])} books, {len(summary['folders'])} chapter folders, "
+          f"{summary['chapters']} chapters, {summary['bytes'] / 1024 ** 2:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Compare the DOCX conversion engine with the original BeautifulSoup walker.
+
+Usage: python benchmarks/docx_conversion.py [paragraphs] [repeat]
+
+Generates a large chapter, checks that both converters produce the same
+text, formatting and images (the engine writes fewer, merged runs) and prints the best time of each over ``repeat`` runs.
+"""
+import base64
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bs4 import BeautifulSoup  # noqa: E402
+from docx import Document  # noqa: E402
+from docx.shared import Inches  # noqa: E402
+
+import docx_ir  # noqa: E402
+
+
+def _png_pixel() -> str:
+    """Return a base64 1x1 PNG."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    png = (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 6, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(b'\x00\x00\x00\x00\x00'))
+        + chunk(b'IEND', b'')
+    )
+    return base64.b64encode(png).decode()
+
+
+PIXEL = _png_pixel()
+WORDS = 'the quick brown fox jumps over a lazy dog while rain falls softly on old roofs'.split()
+
+
+def legacy_append(doc, html):
+    """The walker used before the conversion engine, kept for reference."""
+    soup = BeautifulSoup(html, "html.parser")
+
+    def process(elem, paragraph, formatting=None):
+        if formatting is None:
+            formatting = {}
+        if isinstance(elem, str):
+            run = paragraph.add_run(elem)
+            run.bold = formatting.get("bold", False)
+            run.italic = formatting.get("italic", False)
+            run.underline = formatting.get("underline", False)
+            return
+        tag = elem.name
+        fmt = formatting.copy()
+        if tag in ("strong", "b"):
+            fmt["bold"] = True
+        if tag in ("em", "i"):
+            fmt["italic"] = True
+        if tag == "u":
+            fmt["underline"] = True
+        if tag == "img":
+            src = elem.get("src", "")
+            if src.startswith("data:image/"):
+                header, b64 = src.split(",", 1)
+                data = base64.b64decode(b64)
+                width = elem.get("width")
+                height = elem.get("height")
+                w = Inches(int(width)/96) if width and width.isdigit() else None
+                h = Inches(int(height)/96) if height and height.isdigit() else None
+                doc.add_picture(BytesIO(data), width=w, height=h)
+            return
+        if tag in ("p", "div", "br"):
+            p = doc.add_paragraph()
+            p.paragraph_format.first_line_indent = Inches(0.5)
+            for child in elem.children:
+                process(child, p, fmt)
+            return
+        for child in elem.children:
+            process(child, paragraph, fmt)
+
+    p = doc.add_paragraph()
+    p.paragraph_format.first_line_indent = Inches(0.5)
+    for child in soup.children:
+        process(child, p)
+
+
+def document_content(doc) -> list:
+    """Return paragraph text and formatting with identical adjacent runs joined."""
+    content = []
+    for paragraph in doc.paragraphs:
+        runs = []
+        for run in paragraph.runs:
+            picture = tuple(run.element.xpath('.//a:blip/@r:embed | .//wp:extent/@cx | .//wp:extent/@cy'))
+            key = (run.bold, run.italic, run.underline, picture)
+            if runs and runs[-1][0] == key and not picture:
+                runs[-1][1] += run.text
+            else:
+                runs.append([key, run.text])
+        content.append((paragraph.paragraph_format.first_line_indent, runs))
+    return content
+
+
+def sentence(rng):
+    parts = []
+    for _ in range(rng.randint(6, 20)):
+        word = rng.choice(WORDS)
+        roll = rng.random()
+        if roll < 0.05:
+            word = f'<b>{word}</b>'
+        elif roll < 0.08:
+            word = f'<i>{word} <u>{rng.choice(WORDS)}</u></i>'
+        elif roll < 0.09:
+            word = f'<span style="">{word}</span>'
+        parts.append(word)
+    return ' '.join(parts).capitalize() + '.'
+
+
+def make_chapter(paragraphs: int, seed: int = 1) -> str:
+    rng = random.Random(seed)
+    out = []
+    for i in range(paragraphs):
+        text = ' '.join(sentence(rng) for _ in range(rng.randint(2, 6)))
+        if i % 50 == 25:
+            text += f'<img src="data:image/png;base64,{PIXEL}" width="48" height="48">'
+        if i % 40 == 10:
+            text += '<br>&amp; more &mdash; text'
+        out.append(f'<div>{text}</div>' if i % 7 == 0 else f'<p>{text}</p>')
+        out.append('\n')
+    return ''.join(out)
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    html = make_chapter(paragraphs)
+
+    old = Document()
+    legacy_append(old, html)
+    new = docx_ir.render(docx_ir.parse_html(html))
+    if document_content(old) != document_content(new):
+        sys.exit('Output differs from the legacy walker')
+
+    blocks = docx_ir.parse_html(html)
+    runs = sum(len(b[1]) for b in blocks if b[0] == docx_ir.PARAGRAPH)
+    print(f'{paragraphs} paragraphs, {len(html) / 1024:.0f} KB of HTML, {runs} runs after merging')
+    legacy = best_of(repeat, lambda: legacy_append(Document(), html))
+    parse = best_of(repeat, lambda: docx_ir.parse_html(html))
+    full = best_of(repeat, lambda: docx_ir.render(docx_ir.parse_html(html)))
+    cached = best_of(repeat, lambda: docx_ir.render(blocks))
+    print(f'legacy walker      {legacy * 1000:8.1f} ms')
+    print(f'parse only         {parse * 1000:8.1f} ms')
+    print(f'parse + render     {full * 1000:8.1f} ms  ({legacy / full:.1f}x)')
+    print(f'render cached IR   {cached * 1000:8.1f} ms  ({legacy / cached:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
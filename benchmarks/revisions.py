@@ -0,0 +1,69 @@
+"""Measure the storage and time cost of chapter revision history.
+
+Usage: python benchmarks/revisions.py [saves] [paragraphs]
+
+Autosaves a generated chapter every ten minutes of simulated time for
+``saves`` saves, editing one paragraph (and now and then adding one) each
+time. Prints the time per save, the size of the kept history against
+storing every kept revision in full, and the time to rebuild a revision
+with a cold cache. Exits with an error if any revision does not read back
+exactly.
+"""
+import datetime
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from revision_store import RevisionStore  # noqa: E402
+
+WORDS = 'the of and a to in is was he she it that with for as his her on at by'.split()
+
+
+def paragraph(rng) -> str:
+    return '<p>' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 120))) + '</p>'
+
+
+def main():
+    saves = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    rng = random.Random(3)
+    chapter = [paragraph(rng) for _ in range(paragraphs)]
+    texts = {}
+    start = datetime.datetime.now() - datetime.timedelta(minutes=10 * saves)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, 'revisions.db')
+        store = RevisionStore(db)
+        elapsed = 0.0
+        for i in range(saves):
+            k = rng.randrange(len(chapter))
+            chapter[k] = chapter[k][:-4] + ' ' + rng.choice(WORDS) + '</p>'
+            if i % 40 == 0:
+                chapter.insert(rng.randrange(len(chapter)), paragraph(rng))
+            html = ''.join(chapter)
+            revision = hashlib.sha256(html.encode()).hexdigest()[:32]
+            texts[revision] = html
+            begin = time.perf_counter()
+            store.record('Book/Chapter', html, revision, 0, start + datetime.timedelta(minutes=10 * i))
+            elapsed += time.perf_counter() - begin
+        rows = store.list('Book/Chapter')
+        stored = sum(row[4] for row in rows)
+        full = sum(len(zlib.compress(texts[row[2]].encode())) for row in rows)
+        print(f'{saves} saves of a {len(html) / 1024:.0f} KB chapter: {elapsed / saves * 1000:.2f} ms per save')
+        print(f'{len(rows)} revisions kept, {stored / 1024:.0f} KB stored '
+              f'({full / 1024:.0f} KB as compressed snapshots)')
+        cold = RevisionStore(db)
+        begin = time.perf_counter()
+        for rev_id, _, revision, _, _ in rows:
+            if cold.get('Book/Chapter', rev_id) != texts[revision]:
+                sys.exit(f'Revision {rev_id} does not match')
+        print(f'rebuilding a revision: {(time.perf_counter() - begin) / len(rows) * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Time CalWriter's hot routes on a generated library.
+
+Usage: python benchmarks/routes.py [corpus options] [--repeat N]
+       [--output results.json] [--compare previous.json]
+
+Builds a library with ``benchmarks/corpus.py`` in a temporary data
+directory (see ``--help`` for the corpus options), then times each route
+through the Flask test client and writes the timings as JSON. With
+``--compare`` the medians are printed next to those of an earlier run.
+Environment variables such as ``METADATA_BACKEND`` are passed on to the app.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import corpus  # noqa: E402
+
+
+def measure(func, repeat: int) -> dict:
+    """Call ``func(i)`` ``repeat`` times and summarize the durations in ms."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'runs': repeat,
+        'min_ms': round(min(times), 3),
+        'median_ms': round(statistics.median(times), 3),
+        'mean_ms': round(statistics.fmean(times), 3),
+        'max_ms': round(max(times), 3),
+    }
+
+
+def check(response, *codes):
+    if response.status_code not in (codes or (200,)):
+        raise SystemExit(f'{response.request.path}: unexpected status {response.status_code}')
+    return response
+
+
+def run(args: argparse.Namespace, data_dir: str) -> dict:
+    summary = corpus.generate(data_dir, **corpus.corpus_options(args))
+    os.environ['DATA_DIR'] = data_dir
+    import app as calwriter
+    client = calwriter.app.test_client()
+    book = summary['books'][0]
+    folder = summary['folders'][0]
+    chapter = 'Chapter 001'
+    chapter_url = f'/folder/{folder}/chapter/{chapter}'
+    base_html = calwriter.read_chapter_html(os.path.join(data_dir, folder, chapter))
+    repeat = args.repeat
+    results = {}
+
+    # First requests build caches and indexes; they are timed separately.
+    results['index_cold'] = measure(lambda i: check(client.get('/')), 1)
+    results['search_cold'] = measure(lambda i: check(client.get('/search?q=lantern')), 1)
+    results['index'] = measure(lambda i: check(client.get('/')), repeat)
+    results['folder_children'] = measure(lambda i: check(client.get(f'/folder/{book}/children')), repeat)
+    results['view_folder'] = measure(lambda i: check(client.get(f'/folder/{folder}')), repeat)
+    results['view_chapter'] = measure(lambda i: check(client.get(chapter_url)), repeat)
+    results['view_chapter_gzip'] = measure(
+        lambda i: check(client.get(chapter_url, headers={'Accept-Encoding': 'gzip'})), repeat
+    )
+    results['autosave_chapter'] = measure(
+        lambda i: check(client.post(
+            f'{chapter_url}/autosave', data={'text': base_html + f'<p>Edit {i} of the chapter.</p>'}
+        ), 204),
+        repeat,
+    )
+    results['search'] = measure(
+        lambda i: check(client.get('/search', query_string={'q': corpus.WORDS[i % len(corpus.WORDS)]})),
+        repeat,
+    )
+    results['folder_stats'] = measure(lambda i: check(client.get(f'/folder/{book}/stats')), repeat)
+    chapters = calwriter.list_chapters(folder)
+
+    def rename_all(i):
+        # Renames every chapter of the folder, and back again on the next run.
+        names = [(name, name + ' (draft)') for name in chapters]
+        check(client.post('/batch', json={'operations': [
+            {'op': 'rename_chapter', 'folder': folder, 'name': old, 'new_name': new}
+            for old, new in (names if i % 2 == 0 else [(n, o) for o, n in names])
+        ]}))
+
+    results['batch_rename_chapters'] = measure(rename_all, max(2, repeat - repeat % 2))
+    results['download_combined_docx'] = measure(
+        lambda i: check(client.get(f'/folder/{folder}/combined.docx')), max(1, repeat // 5)
+    )
+    archive = {}
+
+    def export(i):
+        archive['data'] = check(client.get('/export_db')).get_data()
+
+    results['export_db'] = measure(export, max(1, repeat // 5))
+
+    def import_(i):
+        check(client.post(
+            '/import_db',
+            data={'file': (io.BytesIO(archive['data']), 'bench.calwdb')},
+            content_type='multipart/form-data',
+        ), 302)
+
+    results['import_db'] = measure(import_, max(1, repeat // 5))
+    # Save the metrics now, so the background saver has nothing left to
+    # write into the data directory while it is removed.
+    calwriter.metrics.save()
+    return {
+        'version': calwriter.VERSION,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'environment': {
+            key: os.environ[key]
+            for key in ('METADATA_BACKEND', 'CHAPTER_STORAGE', 'SANITIZER', 'DOCX_WORKERS', 'METRICS')
+            if key in os.environ
+        },
+        'corpus': dict(corpus.corpus_options(args), chapters_total=summary['chapters'],
+                       bytes=summary['bytes']),
+        'archive_bytes': len(archive['data']),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(report: dict, previous: dict) -> None:
+    print(f"\n{'route':24} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in report['results'].items():
+        old = previous.get('results', {}).get(name)
+        if old is None:
+            continue
+        before, after = old['median_ms'], result['median_ms']
+        change = f'{after / before:.2f}x' if before else '-'
+        print(f'{name:24} {before:10.2f} {after:10.2f} {change:>8}')
+    if previous.get('corpus') != report['corpus']:
+        print('(the runs used different corpora)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    corpus.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=20, help='runs per route')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    with tempfile.TemporaryDirectory() as data_dir:
+        report = run(args, data_dir)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"{report['corpus']['chapters_total']} chapters, "
+          f"{report['corpus']['bytes'] / 1024 ** 2:.1f} MB, {args.repeat} runs per route\n")
+    for name, result in report['results'].items():
+        print(f"{name:24} median {result['median_ms']:9.2f} ms   min {result['min_ms']:9.2f} ms")
+    print(f'\nWrote {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Check the fast HTML sanitizer against bleach and time both.
+
+Usage: python benchmarks/sanitizer.py [paragraphs] [fuzz-cases]
+
+Runs a fixed corpus of tricky markup, generated editor chapters and random
+mutations of both through every backend, exits with an error if any output
+differs from bleach, and prints timings on a large chapter.
+"""
+import os
+import random
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bleach  # noqa: E402
+
+import sanitizer  # noqa: E402
+
+CORPUS = [
+    '',
+    'plain text',
+    '<p>Hello <b>world</b></p>',
+    '<p style="color:red" class="a b">x</p>',
+    "<p class=a STYLE='x'>y</p>",
+    '<p class>z</p>',
+    '<P CLASS="X">Y</P>',
+    '<p title="t" class="c" id=i>q</p>',
+    '<span class="a" class="b">d</span>',
+    '<p class="a&quot;b">x</p>',
+    "<p class=\"it's\">x</p>",
+    '<p class="a<b>">x</p>',
+    '<p class="a&b">x</p>',
+    'a &amp; b &nbsp; &#123; &#x41; &foo; & c &copy; &lt;&gt;',
+    'a & b &',
+    '&#0; &#xD800; &#1114112; &#65534;',
+    '&copy &amp &nbsp x',
+    'a > b " c \'',
+    'nb\xa0sp',
+    '\t\n x',
+    'a\r\nb\rc',
+    'tab\x0bvt\x0cff\x00nul',
+    '<br><br/><br />',
+    '<hr/><hr>',
+    '</br>',
+    '<img src="/media/' + 'a' * 64 + '.png" width="10" alt="a&amp;b">',
+    '<img src="http://x.com/a?b=1&amp;c=2">',
+    '<img src="http://x.com/a?b=1&c=2">',
+    '<img src="https://example.com/pic.jpg" height=20 style="float:left">',
+    '<img src="javascript:alert(1)">',
+    '<img src=" http://x">',
+    '<img src="data:image/png;base64,AAAA">',
+    '<img src=x/>',
+    '<img alt="">',
+    '<img src="HTTP://X.COM/a">',
+    '<font face="Arial">x</font>',
+    '<font size="4"><span style="">big</span></font>',
+    '<p><font face="Georgia">a</font> b</p>',
+    '<p>a<div>b</div></p>',
+    '<p>a<p>b</p></p>',
+    '<p>a<ul><li>x</li></ul></p>',
+    '<p>a<hr>b</p>',
+    '<b><p>x</p></b>',
+    '<b>a<i>b</b>c</i>',
+    '<b><b><b><b><b>x</b></b></b></b></b>',
+    '<ul><li>a<li>b</ul>',
+    '<ul><li>a<ul><li>b</li></ul></li></ul>',
+    '<li>a<div><li>b</li></div></li>',
+    '<ol><li><p>a</p></li></ol>',
+    '<div><div>a</div>b</div>',
+    '<p>unclosed',
+    '</p>',
+    '<b>x</i>',
+    '<script>a<b</script>',
+    '<style>p {}</style>x',
+    '<x-y>q</x-y>',
+    '<p-x>q</p-x>',
+    '<a href="http://x">link</a>',
+    '<table><tr><td>x</td></tr></table>',
+    '<h1>t</h1>',
+    '<pre>\nx</pre>',
+    '<textarea><b></textarea>',
+    '<!-- c -->x',
+    '<!DOCTYPE html>x',
+    '<?php x ?>',
+    '< p>x',
+    'a < b',
+    '<p a="1"b="2">x</p>',
+    '<p/x>y</p>',
+    '<p/>x',
+    '<span/>x',
+    '<p class="x" / >y</p>',
+    '<p\nclass="x"\t>y</p>',
+    '<sub>2</sub><sup>3</sup><code>c</code><s>s</s>',
+    '<q>q</q><small>s</small><mark>m</mark>',
+    '<em><strong><u>x</u></strong></em>',
+    '<span class="pe-cut">cut</span>',
+    '😀 emoji',
+    'lone \ud800 surrogate',
+]
+
+WORDS = 'the quick brown fox jumps over a lazy dog while rain falls softly on old roofs'.split()
+MEDIA = '<img src="/media/' + '0123456789abcdef' * 4 + '.png" width="120" height="80">'
+
+
+def editor_chapter(paragraphs: int, seed: int = 1) -> str:
+    """Return markup shaped like what the browser editor sends."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(paragraphs):
+        words = []
+        for _ in range(rng.randint(20, 80)):
+            word = rng.choice(WORDS)
+            roll = rng.random()
+            if roll < 0.03:
+                word = f'<b>{word}</b>'
+            elif roll < 0.05:
+                word = f'<i>{word}</i>'
+            elif roll < 0.06:
+                word = f'<span class="pe-pin">{word}</span>'
+            elif roll < 0.07:
+                word = f'<font face="Georgia">{word}</font>'
+            elif roll < 0.08:
+                word = word + '&nbsp;&amp;'
+            elif roll < 0.085:
+                word = f'<span style="font-size: 1.2em;">{word}</span>'
+            words.append(word)
+        text = ' '.join(words)
+        if i % 40 == 20:
+            text += MEDIA
+        if i % 25 == 5:
+            out.append(f'<ul><li>{text}</li><li>two</li></ul>')
+        elif i % 3 == 0:
+            out.append(f'<div>{text}<br></div>')
+        else:
+            out.append(f'<p>{text}</p>')
+        if i % 10 == 0:
+            out.append('<div><br></div>')
+    return ''.join(out)
+
+
+def mutate(rng, html: str) -> str:
+    """Insert, delete or duplicate a few characters of markup."""
+    pieces = ['<', '>', '/', '"', "'", '=', '&', ';', ' ', '\n', 'p', 'b', 'li', '<p>', '</p>',
+              '<b>', '</b>', '<li>', '<br>', '&amp;', '&nbsp;', '<!--', '-->', 'class', '\r']
+    for _ in range(rng.randint(1, 4)):
+        pos = rng.randint(0, len(html))
+        roll = rng.random()
+        if roll < 0.5:
+            html = html[:pos] + rng.choice(pieces) + html[pos:]
+        elif roll < 0.8:
+            html = html[:pos] + html[pos + rng.randint(1, 4):]
+        else:
+            end = min(len(html), pos + rng.randint(1, 20))
+            html = html[:pos] + html[pos:end] + html[pos:]
+    return html
+
+
+def legacy_clean(html: str) -> str:
+    """The original per-call bleach.clean."""
+    return bleach.clean(html, tags=sanitizer.ALLOWED_TAGS, attributes=sanitizer.ALLOWED_ATTRS, strip=True)
+
+
+def check(cases) -> int:
+    """Compare every backend with bleach; return how many took the fast path."""
+    fast_hits = 0
+    for html in cases:
+        expected = legacy_clean(html)
+        for name, clean in sanitizer.BACKENDS.items():
+            got = clean(html)
+            if got != expected:
+                sys.exit(f'{name} differs for {html!r}:\n  bleach: {expected!r}\n  {name}: {got!r}')
+        if sanitizer._clean_fast(html) is not None:
+            fast_hits += 1
+    return fast_hits
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    warnings.simplefilter('ignore')
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    fuzz = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    rng = random.Random(7)
+
+    chapters = [editor_chapter(rng.randint(1, 30), seed) for seed in range(50)]
+    sources = CORPUS + chapters
+    mutated = [mutate(rng, rng.choice(sources)[:400]) for _ in range(fuzz)]
+    for label, cases in (('corpus', CORPUS), ('chapters', chapters), ('mutations', mutated)):
+        hits = check(cases)
+        print(f'{label:10} {len(cases):5} cases identical, {hits} on the fast path')
+
+    html = editor_chapter(paragraphs)
+    if sanitizer._clean_fast(html) is None:
+        sys.exit('Large chapter did not take the fast path')
+    print(f'\n{paragraphs} paragraphs, {len(html) / 1024:.0f} KB')
+    legacy = best_of(3, lambda: legacy_clean(html))
+    cached = best_of(3, lambda: sanitizer.clean_bleach(html))
+    fast = best_of(3, lambda: sanitizer.clean_fast(html))
+    print(f'bleach.clean       {legacy * 1000:8.1f} ms')
+    print(f'reused Cleaner     {cached * 1000:8.1f} ms')
+    print(f'fast sanitizer     {fast * 1000:8.1f} ms  ({legacy / fast:.0f}x)')
+    small = editor_chapter(3)
+    legacy = best_of(3, lambda: [legacy_clean(small) for _ in range(200)]) / 200
+    cached = best_of(3, lambda: [sanitizer.clean_bleach(small) for _ in range(200)]) / 200
+    print(f'\n3-paragraph autosave: bleach.clean {legacy * 1e6:.0f} us, reused Cleaner {cached * 1e6:.0f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Measure CalWriter's cold start.
+
+Usage: python benchmarks/startup.py [corpus options] [--runs N] [--output FILE]
+
+Generates a library with ``benchmarks/corpus.py``, then starts fresh Python
+processes that import the app and serve their first requests through the
+Flask test client, with and without ``PREWARM=1``. Reports the medians of:
+
+- process start to the end of ``import app``, and to the first ``index``
+  response
+- the first chapter ``.docx`` download, the first search and the first
+  chapter save after that
+- resident memory after the import and after those requests
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import corpus  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs in the child process; prints one JSON line.
+CHILD = r"""
+import json, os, sys, time, warnings
+warnings.simplefilter('ignore')
+start = time.perf_counter()
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+def timed(func):
+    begin = time.perf_counter()
+    response = func()
+    assert response.status_code < 400, response.status_code
+    return (time.perf_counter() - begin) * 1000
+
+sys.path.insert(0, os.environ['CALWRITER_ROOT'])
+import app
+result = {'import_ms': (time.perf_counter() - start) * 1000, 'rss_import_mb': rss_mb()}
+client = app.app.test_client()
+timed(lambda: client.get('/'))
+result['first_index_ms'] = (time.perf_counter() - start) * 1000
+chapter = os.environ['CALWRITER_CHAPTER']
+result['first_docx_ms'] = timed(lambda: client.get(chapter + '/chapter.docx'))
+result['first_search_ms'] = timed(lambda: client.get('/search?q=lantern'))
+result['first_save_ms'] = timed(lambda: client.post(chapter + '/autosave', data={'text': '<p>Saved</p>'}))
+result['rss_requests_mb'] = rss_mb()
+print(json.dumps(result))
+"""
+
+
+def run_once(data_dir: str, chapter_url: str, prewarm: bool) -> dict:
+    env = dict(os.environ, DATA_DIR=data_dir, CALWRITER_ROOT=ROOT, CALWRITER_CHAPTER=chapter_url,
+               PREWARM='1' if prewarm else '0')
+    begin = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - begin) * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    corpus.add_arguments(parser)
+    parser.add_argument('--runs', type=int, default=5, help='processes started per mode')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+    report = {'corpus': corpus.corpus_options(args), 'runs': args.runs, 'results': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode, prewarm in (('default', False), ('prewarm', True)):
+            runs = []
+            for _ in range(args.runs):
+                # A fresh copy each time, so caches and databases start cold.
+                data_dir = tempfile.mkdtemp(dir=tmp)
+                summary = corpus.generate(data_dir, **corpus.corpus_options(args))
+                chapter_url = f"/folder/{summary['folders'][0]}/chapter/Chapter 001"
+                runs.append(run_once(data_dir, chapter_url, prewarm))
+            report['results'][mode] = {
+                key: round(statistics.median(run[key] for run in runs), 1) for key in runs[0]
+            }
+    keys = list(report['results']['default'])
+    print(f"{'':18} {'default':>10} {'prewarm':>10}")
+    for key in keys:
+        print(f"{key:18} {report['results']['default'][key]:10.1f} {report['results']['prewarm'][key]:10.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
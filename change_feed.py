@@ -0,0 +1,96 @@
+"""Library change feed for CalWriter.
+
+Structural changes to the library (folders and chapters created, renamed,
+deleted, closed, opened or reordered) are appended to a small table under
+increasing sequence numbers, and readers ask for everything after the last
+number they have seen. Worker processes share the database, so a client
+connected to any of them sees the changes made through all of them.
+Waiters in the process that published a change are woken at once; the
+others notice it on their next poll. Only the newest ``keep`` changes are
+kept, and a reader that fell further behind is told to start over.
+"""
+import json
+import threading
+import time
+
+from sqlite_store import SQLiteStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    change TEXT NOT NULL
+);
+"""
+
+# Seconds between checks for changes published by other processes.
+POLL_INTERVAL = 0.5
+# Old changes are trimmed once every this many publishes.
+TRIM_EVERY = 100
+
+
+class ChangeFeed(SQLiteStore):
+    """Sequence-numbered log of library changes."""
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, path: str, keep: int = 1000):
+        self.keep = keep
+        self._changed = threading.Condition()
+        super().__init__(path)
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        self._changed = threading.Condition()
+
+    def publish(self, action: str, path: str, **data) -> int:
+        """Record a change and return its sequence number."""
+        change = dict(data, action=action, path=path)
+        with self.transaction() as conn:
+            seq = conn.execute(
+                'INSERT INTO changes (ts, change) VALUES (?, ?)', (time.time(), json.dumps(change))
+            ).lastrowid
+            if seq % TRIM_EVERY == 0:
+                conn.execute('DELETE FROM changes WHERE seq <= ?', (seq - self.keep,))
+        with self._changed:
+            self._changed.notify_all()
+        return seq
+
+    def latest(self) -> int:
+        """Return the sequence number of the newest change (0 if none)."""
+        row = self.connection().execute('SELECT max(seq) FROM changes').fetchone()
+        return row[0] or 0
+
+    def since(self, seq: int, limit: int = 200):
+        """Return the changes after ``seq``, oldest first.
+
+        Each change is a dict with ``seq``, ``action`` and ``path`` (plus
+        ``to`` for renames). Returns None when changes after ``seq`` have
+        been trimmed, or ``seq`` is newer than anything in the log, so the
+        reader has to reload its view.
+        """
+        rows = self.connection().execute(
+            'SELECT seq, change FROM changes WHERE seq > ? ORDER BY seq LIMIT ?', (seq, limit)
+        ).fetchall()
+        # Sequence numbers are never reused, so a gap means changes were trimmed.
+        if rows and rows[0][0] != seq + 1:
+            return None
+        if not rows and seq > self.latest():
+            return None
+        return [dict(json.loads(change), seq=number) for number, change in rows]
+
+    def wait(self, seq: int, timeout: float):
+        """Return the changes after ``seq``, waiting up to ``timeout`` seconds for one.
+
+        Returns an empty list on timeout and None as ``since`` does.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            changes = self.since(seq)
+            if changes is None or changes:
+                return changes
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            with self._changed:
+                self._changed.wait(min(remaining, POLL_INTERVAL))
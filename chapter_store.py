@@ -0,0 +1,174 @@
+"""Block layout for CalWriter chapters.
+
+A chapter is normally one ``chapter.html``. In the block layout its HTML is
+split into blocks at top-level element boundaries, each block is stored in
+``.blocks/<hash>.html`` under the hash of its content, and ``chapter.json``
+lists the blocks in order::
+
+    {"revision": "...", "next_id": 4,
+     "blocks": [{"id": 0, "hash": "...", "words": 312}, ...]}
+
+Block boundaries depend only on the elements around them (a scene break, or
+a paragraph whose hash picks it once a block is big enough), so an edit
+leaves the other blocks as they were. A save writes the blocks that are new
+and the manifest, and removes the files no longer listed. Blocks keep their
+``id`` while they are edited in place, and carry their word count, so
+totals and other per-block data need only look at blocks that changed.
+"""
+import difflib
+import json
+import os
+import re
+import zlib
+
+from storage import FileLock
+
+HTML_FILE = 'chapter.html'
+MANIFEST_FILE = 'chapter.json'
+BLOCKS_DIR = '.blocks'
+
+# Blocks end at a top-level element once they hold MIN_BLOCK_CHARS and the
+# element's hash is divisible by SPLIT_MODULUS (about every eighth
+# paragraph), after a scene break (<hr>), and always by MAX_BLOCK_CHARS.
+MIN_BLOCK_CHARS = 1024
+MAX_BLOCK_CHARS = 32 * 1024
+SPLIT_MODULUS = 8
+# Saves of different chapters share this many locks.
+LOCK_STRIPES = 16
+
+_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)[^>]*?(/?)>')
+_VOID = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+
+def split_blocks(html: str) -> list:
+    """Split chapter HTML into blocks; ``''.join(blocks) == html``.
+
+    Input whose tags never return to the top level stays in one block.
+    """
+    blocks = []
+    start = element_start = depth = 0
+    for match in _TAG_RE.finditer(html):
+        closing, name, self_closing = match.groups()
+        if closing:
+            if depth > 1:
+                depth -= 1
+                continue
+            depth = 0
+        elif depth:
+            if not self_closing and name.lower() not in _VOID:
+                depth += 1
+            continue
+        else:
+            element_start = match.start()
+            if not self_closing and name.lower() not in _VOID:
+                depth = 1
+                continue
+        # A top-level element ends here.
+        end = match.end()
+        size = end - start
+        if (
+            (not closing and name.lower() == 'hr')
+            or size >= MAX_BLOCK_CHARS
+            or (size >= MIN_BLOCK_CHARS
+                and zlib.crc32(html[element_start:end].encode('utf-8', 'surrogatepass')) % SPLIT_MODULUS == 0)
+        ):
+            blocks.append(html[start:end])
+            start = end
+    if start < len(html):
+        blocks.append(html[start:])
+    return blocks
+
+
+class BlockStore:
+    """Reads and writes chapters in the block layout through ``journal``."""
+
+    def __init__(self, journal, lock_dir: str, block_hash):
+        self.journal = journal
+        self.block_hash = block_hash
+        self._locks = [FileLock(os.path.join(lock_dir, f'chapter-{i}.lock')) for i in range(LOCK_STRIPES)]
+
+    def lock(self, path: str) -> FileLock:
+        """Return the lock held while the chapter at ``path`` is written."""
+        return self._locks[zlib.crc32(os.path.normpath(path).encode('utf-8', 'surrogatepass')) % LOCK_STRIPES]
+
+    @staticmethod
+    def block_path(path: str, block_hash: str) -> str:
+        return os.path.join(path, BLOCKS_DIR, block_hash + '.html')
+
+    def read_block(self, path: str, block_hash: str) -> str:
+        with open(self.block_path(path, block_hash)) as f:
+            return f.read()
+
+    def read(self, path: str, manifest: dict) -> str:
+        """Return the chapter HTML listed by ``manifest``.
+
+        If a save removed some of its blocks meanwhile, the chapter is read
+        again from its current manifest.
+        """
+        try:
+            return ''.join(self.read_block(path, entry['hash']) for entry in manifest['blocks'])
+        except FileNotFoundError:
+            with self.lock(path):
+                manifest = self._load_manifest(path)
+                if manifest is None:
+                    raise
+                return ''.join(self.read_block(path, entry['hash']) for entry in manifest['blocks'])
+
+    @staticmethod
+    def _load_manifest(path: str):
+        try:
+            with open(os.path.join(path, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return manifest if isinstance(manifest, dict) else None
+
+    @staticmethod
+    def _assign_ids(old: list, hashes: list, next_id: int):
+        """Give each new block the id of the old block it replaces, if any."""
+        ids = [None] * len(hashes)
+        matcher = difflib.SequenceMatcher(None, [entry['hash'] for entry in old], hashes, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag in ('equal', 'replace'):
+                for k in range(min(i2 - i1, j2 - j1)):
+                    ids[j1 + k] = old[i1 + k]['id']
+        for j, block_id in enumerate(ids):
+            if block_id is None:
+                ids[j] = next_id
+                next_id += 1
+        return ids, next_id
+
+    def write(self, path: str, html: str, revision: str, count_words) -> dict:
+        """Store ``html`` as the chapter at ``path`` and return its manifest.
+
+        Only blocks that are not stored yet are written; ``count_words`` is
+        called for those alone.
+        """
+        blocks = split_blocks(html)
+        hashes = [self.block_hash(block) for block in blocks]
+        with self.lock(path):
+            previous = self._load_manifest(path) or {}
+            old = previous.get('blocks', [])
+            known = {entry['hash']: entry for entry in old}
+            ids, next_id = self._assign_ids(old, hashes, previous.get('next_id', 0))
+            entries = []
+            files = {}
+            for block, block_hash, block_id in zip(blocks, hashes, ids):
+                if block_hash in known:
+                    words = known[block_hash]['words']
+                else:
+                    words = count_words(block)
+                    files[self.block_path(path, block_hash)] = block.encode('utf-8')
+                entries.append({'id': block_id, 'hash': block_hash, 'words': words})
+            manifest = {'revision': revision, 'next_id': next_id, 'blocks': entries}
+            # The blocks come first, so a torn write leaves the old manifest
+            # pointing at files that are all still there.
+            files[os.path.join(path, MANIFEST_FILE)] = json.dumps(manifest).encode('utf-8')
+            self.journal.write_many(list(files.items()))
+            keep = {block_hash + '.html' for block_hash in hashes}
+            blocks_dir = os.path.join(path, BLOCKS_DIR)
+            # An empty chapter writes no blocks, so the directory may be missing.
+            for name in os.listdir(blocks_dir) if os.path.isdir(blocks_dir) else []:
+                if name.endswith('.html') and name not in keep:
+                    os.remove(os.path.join(blocks_dir, name))
+        return manifest
@@ -0,0 +1,96 @@
+"""Gzip for CalWriter request and response bodies.
+
+``GzipRequests`` is WSGI middleware that inflates request bodies sent with
+``Content-Encoding: gzip`` before the application reads them, refusing
+bodies that inflate past a limit. ``compress_response`` gzips a finished
+response for clients that accept it.
+"""
+import gzip
+import io
+import zlib
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/plain', 'application/json')
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class GzipRequests:
+    """Inflate gzip request bodies of at most ``max_bytes`` (uncompressed)."""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding != 'gzip':
+            return self.app(environ, start_response)
+        try:
+            body = self._inflate(environ['wsgi.input'], environ.get('CONTENT_LENGTH'))
+        except ValueError as e:
+            return self._error(start_response, *e.args)
+        environ = dict(environ)
+        del environ['HTTP_CONTENT_ENCODING']
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ.pop('HTTP_TRANSFER_ENCODING', None)
+        environ['wsgi.input_terminated'] = True
+        return self.app(environ, start_response)
+
+    def _inflate(self, stream, content_length) -> bytes:
+        remaining = int(content_length) if content_length else None
+        inflater = zlib.decompressobj(wbits=31)
+        parts = []
+        size = 0
+        while remaining is None or remaining > 0:
+            chunk = stream.read(READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            try:
+                data = inflater.decompress(chunk, self.max_bytes - size + 1)
+            except zlib.error:
+                raise ValueError('400 Bad Request', 'Invalid gzip body')
+            size += len(data)
+            if size > self.max_bytes:
+                raise ValueError('413 Request Entity Too Large', 'Request body too large')
+            parts.append(data)
+        if not inflater.eof:
+            raise ValueError('400 Bad Request', 'Invalid gzip body')
+        return b''.join(parts)
+
+    @staticmethod
+    def _error(start_response, status: str, message: str):
+        body = message.encode('utf-8')
+        start_response(status, [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+
+def compress_response(response, accept_encodings, min_bytes: int, level: int):
+    """Gzip ``response`` in place if it is worth it and the client accepts it."""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < min_bytes:
+        return response
+    response.vary.add('Accept-Encoding')
+    if not accept_encodings.quality('gzip'):
+        return response
+    response.set_data(gzip.compress(data, compresslevel=level, mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    # The compressed body is a different representation of the same
+    # content, so a strong validator becomes a weak one.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,197 @@
+"""HTML to DOCX conversion for CalWriter chapters.
+
+Chapter HTML is parsed once into a small intermediate form: a list of
+blocks, each either a paragraph of ``(text, bold, italic, underline)`` runs
+or an image (inline bytes, or the name of a file in the asset store).
+Adjacent runs with the same formatting are merged. The blocks are plain
+tuples, so they can be cached or sent to another process, and rendered
+into a new or existing python-docx ``Document``.
+
+The conversion keeps the behaviour of the original BeautifulSoup walker:
+``p``, ``div`` and ``br`` each start a new paragraph, images become their
+own paragraph, and text that follows a block element continues the
+paragraph that was open before it.
+
+python-docx is only imported once something is rendered, so processes that
+just parse chapters (such as the conversion workers) never load it.
+"""
+import base64
+import os
+import re
+from copy import deepcopy
+from html.parser import HTMLParser
+from io import BytesIO
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from docx.document import Document
+
+PARAGRAPH = 'p'
+IMAGE = 'img'
+
+BLOCK_TAGS = ('p', 'div', 'br')
+# Elements html.parser (and BeautifulSoup) treat as having no content.
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr',
+}
+PLAIN = (False, False, False)
+# Images already moved to the asset store are referenced by file name.
+ASSET_SRC = re.compile(r'(?:^|/)media/([0-9a-f]{64}\.\w+)$')
+
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+# Paragraph and run elements built once through python-docx and copied for
+# every block; Document.add_paragraph rescans the whole body on each call.
+_templates = {}
+
+
+def _pixels(value):
+    return int(value) if value and value.isdigit() else None
+
+
+class _ChapterParser(HTMLParser):
+    """Collect blocks while tracking the open elements and their formatting."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        root = []
+        self.blocks = [(PARAGRAPH, root)]
+        self.stack = [(None, PLAIN, root)]
+
+    def handle_starttag(self, tag, attrs):
+        _, (bold, italic, underline), runs = self.stack[-1]
+        if tag == 'img':
+            self._image({name: value or '' for name, value in attrs})
+            return
+        if tag in ('strong', 'b'):
+            bold = True
+        elif tag in ('em', 'i'):
+            italic = True
+        elif tag == 'u':
+            underline = True
+        if tag in BLOCK_TAGS:
+            runs = []
+            self.blocks.append((PARAGRAPH, runs))
+        if tag not in VOID_TAGS:
+            self.stack.append((tag, (bold, italic, underline), runs))
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i][0] == tag:
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data):
+        if data:
+            _, fmt, runs = self.stack[-1]
+            runs.append((data,) + fmt)
+
+    handle_comment = handle_data
+
+    def _image(self, attrs):
+        src = attrs.get('src', '')
+        asset = ASSET_SRC.search(src)
+        if asset:
+            source = asset.group(1)
+        elif src.startswith('data:image/'):
+            source = base64.b64decode(src.split(',', 1)[1])
+        else:
+            return
+        self.blocks.append((IMAGE, source, _pixels(attrs.get('width')), _pixels(attrs.get('height'))))
+
+
+def _merge_runs(runs: list) -> tuple:
+    merged = []
+    for run in runs:
+        if merged and merged[-1][1:] == run[1:]:
+            merged[-1] = (merged[-1][0] + run[0],) + run[1:]
+        else:
+            merged.append(run)
+    return tuple(merged)
+
+
+def parse_html(html: str) -> list:
+    """Convert chapter HTML into a list of paragraph and image blocks."""
+    parser = _ChapterParser()
+    parser.feed(html)
+    parser.close()
+    return [
+        (PARAGRAPH, _merge_runs(block[1])) if block[0] == PARAGRAPH else block
+        for block in parser.blocks
+    ]
+
+
+def _template(fmt=None):
+    """Return a prototype ``w:p`` (``fmt`` None) or ``w:r`` element."""
+    element = _templates.get(fmt)
+    if element is None:
+        from docx.oxml import OxmlElement
+        from docx.shared import Inches
+        from docx.text.paragraph import Paragraph
+        paragraph = Paragraph(OxmlElement('w:p'), None)
+        if fmt is None:
+            paragraph.paragraph_format.first_line_indent = Inches(0.5)
+            element = paragraph._p
+        else:
+            run = paragraph.add_run()
+            run.bold, run.italic, run.underline = fmt
+            element = run._r
+        _templates[fmt] = element
+    return element
+
+
+def _set_text(r, text: str, text_element) -> None:
+    """Set the text of a new run, writing plain text as a single ``w:t``.
+
+    ``text_element`` is a prototype ``w:t`` element.
+    """
+    if '\t' in text or '\n' in text or '\r' in text:
+        r.text = text
+        return
+    t = deepcopy(text_element)
+    t.text = text
+    if len(text.strip()) < len(text):
+        t.set(XML_SPACE, 'preserve')
+    r.append(t)
+
+
+def render(blocks: list, doc: 'Document' = None, asset_dir: str = None) -> 'Document':
+    """Append ``blocks`` to ``doc`` (a new document by default) and return it.
+
+    Stored images are read from ``asset_dir``; missing ones are skipped.
+    """
+    from docx import Document
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    from docx.shared import Inches
+
+    if doc is None:
+        doc = Document()
+    text_element = OxmlElement('w:t')
+    body = doc.element.body
+    sect_pr = body.find(qn('w:sectPr'))
+    for block in blocks:
+        if block[0] == IMAGE:
+            _, source, width, height = block
+            if isinstance(source, bytes):
+                source = BytesIO(source)
+            else:
+                source = os.path.join(asset_dir or '', source)
+                if not os.path.isfile(source):
+                    continue
+            doc.add_picture(
+                source,
+                width=Inches(width / 96) if width is not None else None,
+                height=Inches(height / 96) if height is not None else None,
+            )
+            continue
+        p = deepcopy(_template())
+        for run in block[1]:
+            r = deepcopy(_template(run[1:]))
+            _set_text(r, run[0], text_element)
+            p.append(r)
+        if sect_pr is None:
+            body.append(p)
+        else:
+            sect_pr.addprevious(p)
+    return doc
@@ -0,0 +1,20 @@
+"""Gunicorn settings for serving CalWriter in production.
+
+``gunicorn app:app`` picks this file up from the working directory. The
+app is imported once in the master process (recovering the write journal
+there) and forked into worker processes, each serving requests from a pool
+of threads. On SIGTERM workers finish the requests they are handling, for
+up to ``GRACEFUL_TIMEOUT`` seconds, before exiting.
+"""
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', min(4, os.cpu_count() or 1)))
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread'
+preload_app = True
+# Combined DOCX exports and imports of large archives can take a while.
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
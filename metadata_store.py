@@ -0,0 +1,233 @@
+"""SQLite storage for CalWriter library metadata.
+
+Keeps folder ordering, the open/closed lists and book attributes (color,
+author, description) in one WAL-mode database instead of the small JSON and
+text files scattered through the data directory.
+"""
+import json
+import os
+
+from sqlite_store import SQLiteStore, like_prefix
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS item_order (
+    folder TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (folder, kind, position)
+);
+CREATE TABLE IF NOT EXISTS state_list (
+    list TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (list, position)
+);
+CREATE INDEX IF NOT EXISTS state_list_value ON state_list (list, value);
+CREATE TABLE IF NOT EXISTS book_attr (
+    folder TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (folder, key)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Files migrated into the database, relative to the data directory.
+STATE_LISTS = {
+    'open_books': 'open_books.json',
+    'closed_folders': 'closed_folders.json',
+    'closed_chapters': 'closed_chapters.json',
+}
+ATTR_FILES = {
+    'description': 'description.txt',
+    'author': 'author.txt',
+    'color': 'color.txt',
+}
+
+
+def _prefix_filter(column: str):
+    return f"({column} = ? OR {column} LIKE ? ESCAPE '\\')"
+
+
+class MetadataStore(SQLiteStore):
+    """Thread-safe access to the metadata database.
+
+    Every write bumps a generation counter so cached listings can be
+    validated against it.
+    """
+
+    SCHEMA = SCHEMA
+
+    def before_commit(self, conn) -> None:
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('generation', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def generation(self) -> str:
+        row = self.connection().execute(
+            "SELECT value FROM meta WHERE key = 'generation'"
+        ).fetchone()
+        return row[0] if row else '0'
+
+    # Ordering -------------------------------------------------------------
+
+    def get_order(self, folder: str) -> dict:
+        order = {'folders': [], 'chapters': []}
+        rows = self.connection().execute(
+            'SELECT kind, name FROM item_order WHERE folder = ? ORDER BY kind, position',
+            (folder,),
+        )
+        for kind, name in rows:
+            order.setdefault(kind, []).append(name)
+        return order
+
+    def set_order(self, folder: str, order: dict) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM item_order WHERE folder = ?', (folder,))
+            for kind in ('folders', 'chapters'):
+                conn.executemany(
+                    'INSERT INTO item_order (folder, kind, position, name) VALUES (?, ?, ?, ?)',
+                    [(folder, kind, i, name) for i, name in enumerate(order.get(kind, []))],
+                )
+
+    # Open/closed lists ----------------------------------------------------
+
+    def get_list(self, name: str):
+        """Return the stored list, or ``None`` if it was never saved."""
+        conn = self.connection()
+        if conn.execute('SELECT 1 FROM meta WHERE key = ?', (f'list:{name}',)).fetchone() is None:
+            return None
+        rows = conn.execute(
+            'SELECT value FROM state_list WHERE list = ? ORDER BY position', (name,)
+        )
+        return [r[0] for r in rows]
+
+    def contains(self, name: str, value: str) -> bool:
+        row = self.connection().execute(
+            'SELECT 1 FROM state_list WHERE list = ? AND value = ?', (name, value)
+        ).fetchone()
+        return row is not None
+
+    def set_list(self, name: str, values: list) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM state_list WHERE list = ?', (name,))
+            conn.executemany(
+                'INSERT INTO state_list (list, position, value) VALUES (?, ?, ?)',
+                [(name, i, v) for i, v in enumerate(values)],
+            )
+            conn.execute(
+                'INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', (f'list:{name}', '1')
+            )
+
+    # Book attributes ------------------------------------------------------
+
+    def get_attr(self, folder: str, key: str) -> str:
+        row = self.connection().execute(
+            'SELECT value FROM book_attr WHERE folder = ? AND key = ?', (folder, key)
+        ).fetchone()
+        return row[0] if row else ''
+
+    def get_attrs(self, key: str) -> dict:
+        """Return ``{folder: value}`` for one attribute across the library."""
+        rows = self.connection().execute('SELECT folder, value FROM book_attr WHERE key = ?', (key,))
+        return dict(rows.fetchall())
+
+    def set_attr(self, folder: str, key: str, value: str) -> None:
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO book_attr (folder, key, value) VALUES (?, ?, ?) '
+                'ON CONFLICT(folder, key) DO UPDATE SET value = excluded.value',
+                (folder, key, value),
+            )
+
+    # Structural changes ---------------------------------------------------
+
+    def rename_prefix(self, old: str, new: str) -> None:
+        """Move ordering and attributes stored under ``old`` to ``new``."""
+        with self.transaction() as conn:
+            for table in ('item_order', 'book_attr'):
+                conn.execute(
+                    f'UPDATE {table} SET folder = ? || substr(folder, ?) '
+                    f'WHERE {_prefix_filter("folder")}',
+                    (new, len(old) + 1, old, like_prefix(old)),
+                )
+
+    def delete_prefix(self, path: str) -> None:
+        with self.transaction() as conn:
+            for table in ('item_order', 'book_attr'):
+                conn.execute(
+                    f'DELETE FROM {table} WHERE {_prefix_filter("folder")}',
+                    (path, like_prefix(path)),
+                )
+
+    # Migration ------------------------------------------------------------
+
+    def is_migrated(self) -> bool:
+        row = self.connection().execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone()
+        return row is not None
+
+    def migrate_from_files(self, data_dir: str, force: bool = False, only=None) -> None:
+        """Import metadata files from ``data_dir`` into the database.
+
+        Runs once unless ``force`` is set; ``only`` limits the import to a set
+        of paths relative to ``data_dir``. The files themselves are left in
+        place so the file backend can still be used.
+        """
+        if self.is_migrated() and not force:
+            return
+
+        def wanted(folder, filename):
+            return only is None or '/'.join(p for p in (folder, filename) if p) in only
+
+        with self.transaction() as conn:
+            for name, filename in STATE_LISTS.items():
+                values = _read_json(os.path.join(data_dir, filename))
+                if isinstance(values, list) and wanted('', filename):
+                    self.set_list(name, values)
+            for root, dirs, files in os.walk(data_dir):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                rel = os.path.relpath(root, data_dir)
+                folder = '' if rel == '.' else rel.replace(os.sep, '/')
+                if 'order.json' in files and wanted(folder, 'order.json'):
+                    order = _read_json(os.path.join(root, 'order.json'))
+                    if isinstance(order, dict):
+                        self.set_order(folder, order)
+                for key, filename in ATTR_FILES.items():
+                    if filename in files and folder and wanted(folder, filename):
+                        with open(os.path.join(root, filename)) as f:
+                            value = f.read()
+                        self.set_attr(folder, key, value.strip() if key == 'color' else value)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', '1')")
+
+    def merge_database(self, path: str) -> None:
+        """Copy every metadata row from another database file into this one."""
+        self.connection().execute('ATTACH DATABASE ? AS incoming', (path,))
+        try:
+            with self.transaction() as conn:
+                conn.execute(
+                    'DELETE FROM item_order WHERE folder IN (SELECT folder FROM incoming.item_order)'
+                )
+                conn.execute('INSERT OR REPLACE INTO item_order SELECT * FROM incoming.item_order')
+                conn.execute(
+                    'DELETE FROM state_list WHERE list IN (SELECT list FROM incoming.state_list)'
+                )
+                conn.execute('INSERT OR REPLACE INTO state_list SELECT * FROM incoming.state_list')
+                conn.execute('INSERT OR REPLACE INTO book_attr SELECT * FROM incoming.book_attr')
+                conn.execute(
+                    "INSERT OR IGNORE INTO meta SELECT * FROM incoming.meta WHERE key LIKE 'list:%'"
+                )
+        finally:
+            self.connection().execute('DETACH DATABASE incoming')
+
+
+def _read_json(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
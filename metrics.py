@@ -0,0 +1,315 @@
+"""Request metrics for CalWriter.
+
+Every request's duration is added to a latency histogram for its endpoint,
+and the work done while handling it is counted by kind:
+
+- ``fs``: filesystem calls, seen through Python's audit hooks (opening
+  files, listing directories, and creating, renaming or removing files)
+- ``json``: JSON files parsed
+- ``html``: HTML parsed into a tree (plain text and DOCX conversion)
+- ``sanitize``: chapter HTML sanitized
+- ``docx``: DOCX documents built
+
+The totals are rendered in the Prometheus text format, and the breakdown
+of a single request can be sent as a ``Server-Timing`` header.
+
+Each worker process counts on its own, and a background thread saves its
+totals to ``directory`` every second while they change (and once more at
+exit), so any worker can report the sum over all of them. The totals of
+workers that have exited are added to ``retired.json``, so the summed
+counters never go down when workers are replaced.
+"""
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from storage import FileLock, replace_file
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+KINDS = ('fs', 'json', 'html', 'sanitize', 'docx')
+# Audit events counted as filesystem calls.
+FS_EVENTS = frozenset({
+    'open', 'os.listdir', 'os.scandir', 'os.mkdir', 'os.rmdir', 'os.remove',
+    'os.rename', 'os.truncate', 'os.utime', 'os.chmod', 'os.link', 'os.symlink',
+    'shutil.copyfile', 'shutil.copytree', 'shutil.move', 'shutil.rmtree',
+})
+SAVE_INTERVAL = 1.0
+RETIRED_FILE = 'retired.json'
+
+
+def _labels(**labels) -> str:
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _as_snapshot(latency: dict, requests: dict, operations: dict) -> dict:
+    """Return totals in the JSON form workers save."""
+    return {
+        'latency': [[*key, values] for key, values in latency.items()],
+        'requests': [[*key, count] for key, count in requests.items()],
+        'operations': [[*key, values] for key, values in operations.items()],
+    }
+
+
+def _combine(snapshots: list):
+    """Add up saved snapshots into ``(latency, requests, operations)`` dicts."""
+    latency, requests, operations = {}, {}, {}
+    for snapshot in snapshots:
+        for *key, values in snapshot['latency']:
+            total = latency.setdefault(tuple(key), [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        for *key, count in snapshot['requests']:
+            requests[tuple(key)] = requests.get(tuple(key), 0) + count
+        for *key, (count, spent) in snapshot['operations']:
+            total = operations.setdefault(tuple(key), [0, 0.0])
+            total[0] += count
+            total[1] += spent
+    return latency, requests, operations
+
+
+class Metrics:
+    """Per-endpoint latency and operation counts for one process."""
+
+    def __init__(self, directory: str = None, enabled: bool = True):
+        # Worker liveness is checked with signals, so totals are only shared
+        # between processes on POSIX systems.
+        self.directory = directory if os.name == 'posix' else None
+        self.enabled = enabled
+        self._retired_lock = FileLock(os.path.join(self.directory, 'retired.lock')) if self.directory else None
+        self._reset()
+        if enabled:
+            sys.addaudithook(self._audit)
+            os.register_at_fork(after_in_child=self._reset)
+            atexit.register(self._save_at_exit)
+
+    def _reset(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # (endpoint, method) -> [bucket counts..., +Inf count, sum]
+        self._latency = {}
+        # (endpoint, method, status) -> requests
+        self._requests = {}
+        # (endpoint, kind) -> [count, seconds]
+        self._operations = {}
+        self._dirty = False
+        self._saver = None
+
+    def _audit(self, event: str, args) -> None:
+        if event in FS_EVENTS:
+            ops = getattr(self._local, 'ops', None)
+            if ops is not None:
+                ops['fs'][0] += 1
+
+    @contextmanager
+    def _timed(self, kind: str, count: int):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ops = getattr(self._local, 'ops', None)
+            if ops is not None:
+                entry = ops[kind]
+                entry[0] += count
+                entry[1] += time.perf_counter() - start
+
+    def timed(self, kind: str, count: int = 1):
+        """Context manager counting ``count`` operations of ``kind`` and their time."""
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(kind, count)
+
+    def measure(self, kind: str):
+        """Decorator counting every call of a function as an operation of ``kind``."""
+        def decorate(func):
+            if not self.enabled:
+                return func
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self._timed(kind, 1):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def start_request(self) -> None:
+        if self.enabled:
+            self._local.start = time.perf_counter()
+            self._local.ops = {kind: [0, 0.0] for kind in KINDS}
+
+    def finish_request(self, endpoint: str, method: str, status: int):
+        """Record the current request and return its ``(seconds, operations)``."""
+        ops = getattr(self._local, 'ops', None)
+        if ops is None:
+            return None
+        seconds = time.perf_counter() - self._local.start
+        self._local.ops = None
+        with self._lock:
+            latency = self._latency.setdefault((endpoint, method), [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    latency[i] += 1
+            latency[-2] += 1
+            latency[-1] += seconds
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for kind, (count, spent) in ops.items():
+                if count:
+                    entry = self._operations.setdefault((endpoint, kind), [0, 0.0])
+                    entry[0] += count
+                    entry[1] += spent
+            self._dirty = True
+            if self.directory and self._saver is None:
+                self._saver = threading.Thread(target=self._save_loop, name='metrics', daemon=True)
+                self._saver.start()
+        return seconds, ops
+
+    def _save_loop(self) -> None:
+        while True:
+            time.sleep(SAVE_INTERVAL)
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError:
+                    pass
+
+    def _save_at_exit(self) -> None:
+        if self.directory and self._dirty:
+            try:
+                self.save()
+            except OSError:
+                pass
+
+    @staticmethod
+    def server_timing(seconds: float, ops: dict) -> str:
+        """Return a ``Server-Timing`` header value for one request."""
+        parts = []
+        for kind, (count, spent) in ops.items():
+            if not count:
+                continue
+            if kind == 'fs':
+                parts.append(f'fs;desc="{count} calls"')
+            else:
+                parts.append(f'{kind};dur={spent * 1000:.2f};desc="{count}x"')
+        parts.append(f'total;dur={seconds * 1000:.2f}')
+        return ', '.join(parts)
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            self._dirty = False
+            return _as_snapshot(self._latency, self._requests, self._operations)
+
+    def save(self) -> None:
+        """Write this process's totals for the other workers to read."""
+        if not self.directory:
+            return
+        data = json.dumps(self._snapshot()).encode('utf-8')
+        os.makedirs(self.directory, exist_ok=True)
+        replace_file(os.path.join(self.directory, f'{os.getpid()}.json'), data)
+
+    def _snapshots(self) -> list:
+        """Return the totals of every worker, this one and exited ones included."""
+        snapshots = [self._snapshot()]
+        if not self.directory:
+            return snapshots
+        self.save()
+        # Held while reading, so no worker is retired between reading its
+        # file and reading retired.json (counting it twice, or not at all).
+        with self._retired_lock:
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                return snapshots
+            for name in names:
+                pid, ext = os.path.splitext(name)
+                if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    os.kill(int(pid), 0)
+                except ProcessLookupError:
+                    try:
+                        self._retire(path)
+                    except OSError:
+                        pass
+                    continue
+                except PermissionError:
+                    pass
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+            try:
+                with open(os.path.join(self.directory, RETIRED_FILE)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return snapshots
+
+    def _retire(self, path: str) -> None:
+        """Add the totals saved by an exited worker to ``retired.json``."""
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except ValueError:
+            snapshot = None
+        if snapshot is not None:
+            try:
+                with open(retired_path) as f:
+                    retired = [json.load(f)]
+            except (OSError, ValueError):
+                retired = []
+            total = _as_snapshot(*_combine(retired + [snapshot]))
+            replace_file(retired_path, json.dumps(total).encode('utf-8'))
+        os.remove(path)
+
+    def render(self) -> str:
+        """Return the totals of all workers in the Prometheus text format."""
+        latency, requests, operations = _combine(self._snapshots())
+
+        lines = [
+            '# HELP calwriter_request_duration_seconds Time from receiving a request '
+            'to starting its response.',
+            '# TYPE calwriter_request_duration_seconds histogram',
+        ]
+        for (endpoint, method), values in sorted(latency.items()):
+            for bound, count in zip((*BUCKETS, '+Inf'), values):
+                labels = _labels(endpoint=endpoint, method=method, le=bound)
+                lines.append(f'calwriter_request_duration_seconds_bucket{labels} {count}')
+            labels = _labels(endpoint=endpoint, method=method)
+            lines.append(f'calwriter_request_duration_seconds_sum{labels} {values[-1]:.6f}')
+            lines.append(f'calwriter_request_duration_seconds_count{labels} {values[-2]}')
+        lines += [
+            '# HELP calwriter_requests_total Requests by endpoint and status code.',
+            '# TYPE calwriter_requests_total counter',
+        ]
+        for (endpoint, method, status), count in sorted(requests.items()):
+            labels = _labels(endpoint=endpoint, method=method, status=status)
+            lines.append(f'calwriter_requests_total{labels} {count}')
+        lines += [
+            '# HELP calwriter_operations_total Filesystem calls, JSON loads, HTML parses, '
+            'sanitizer runs and DOCX builds while handling requests.',
+            '# TYPE calwriter_operations_total counter',
+        ]
+        for (endpoint, kind), (count, _) in sorted(operations.items()):
+            lines.append(f'calwriter_operations_total{_labels(endpoint=endpoint, kind=kind)} {count}')
+        lines += [
+            '# HELP calwriter_operation_seconds_total Time spent in timed operations '
+            'while handling requests.',
+            '# TYPE calwriter_operation_seconds_total counter',
+        ]
+        for (endpoint, kind), (_, spent) in sorted(operations.items()):
+            if kind != 'fs':
+                lines.append(
+                    f'calwriter_operation_seconds_total{_labels(endpoint=endpoint, kind=kind)} {spent:.6f}'
+                )
+        return '\n'.join(lines) + '\n'
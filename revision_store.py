@@ -0,0 +1,314 @@
+"""Chapter revision history for CalWriter.
+
+Saved chapter versions are kept in one WAL-mode database. A revision is
+stored either as a full snapshot or as a zlib-compressed delta against the
+revision before it. A new snapshot starts once a chain reaches
+``MAX_CHAIN`` deltas or its deltas outweigh the snapshot, which bounds the
+work needed to rebuild any revision.
+
+Saves within the same ``interval`` replace each other, and older history
+is thinned: every revision from the last day is kept, one per hour for the
+week before and one per day after that. The revision following a removed
+one is re-encoded against the removed revision's base.
+"""
+import datetime
+import difflib
+import json
+import threading
+import zlib
+from collections import OrderedDict
+
+from sqlite_store import SQLiteStore, like_prefix
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revisions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    words INTEGER NOT NULL,
+    base INTEGER,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS revisions_path ON revisions (path, ts);
+CREATE INDEX IF NOT EXISTS revisions_base ON revisions (base);
+"""
+
+# A revision and the revisions it is built on, nearest first.
+CHAIN_QUERY = """
+WITH RECURSIVE chain (id, base, data) AS (
+    SELECT id, base, data FROM revisions WHERE id = ?
+    UNION ALL
+    SELECT r.id, r.base, r.data FROM revisions r JOIN chain c ON r.id = c.base
+)
+SELECT id, base, data FROM chain
+"""
+
+MAX_CHAIN = 200
+# (age, bucket length) in seconds: revisions older than ``age`` are thinned
+# to the newest one per bucket.
+RETENTION = ((7 * 86400, 86400), (86400, 3600))
+# How often a chapter's history is thinned.
+PRUNE_EVERY = 3600
+# Deltas are computed between pieces of markup ending with one of these
+# tags, usually whole paragraphs of the sanitized (lower-case) HTML.
+PIECE_ENDS = ('</p', '</div', '</li', '</ul', '</ol', '<br', '<br/', '<br /')
+TEXT_CACHE_SIZE = 64
+
+
+def _pieces(text: str) -> list:
+    pieces = []
+    start = end = 0
+    for part in text.split('>'):
+        end += len(part) + 1
+        if part.endswith(PIECE_ENDS):
+            pieces.append(text[start:end])
+            start = end
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def make_delta(base: str, text: str) -> list:
+    """Return ops rebuilding ``text`` from ``base``.
+
+    Each op is either ``[start, end]``, a slice of ``base``, or a string to
+    insert.
+    """
+    a = _pieces(base)
+    b = _pieces(text)
+    # Edits are usually local; only the part between the common head and
+    # tail goes through difflib.
+    head = 0
+    limit = min(len(a), len(b))
+    while head < limit and a[head] == b[head]:
+        head += 1
+    tail = 0
+    while tail < limit - head and a[-1 - tail] == b[-1 - tail]:
+        tail += 1
+    offsets = [0]
+    for piece in a:
+        offsets.append(offsets[-1] + len(piece))
+    ops = []
+    if head:
+        ops.append([0, offsets[head]])
+    matcher = difflib.SequenceMatcher(None, a[head:len(a) - tail], b[head:len(b) - tail])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([offsets[head + i1], offsets[head + i2]])
+        elif j1 < j2:
+            inserted = ''.join(b[head + j1:head + j2])
+            if ops and isinstance(ops[-1], str):
+                ops[-1] += inserted
+            else:
+                ops.append(inserted)
+    if tail:
+        ops.append([offsets[len(a) - tail], offsets[len(a)]])
+    return ops
+
+
+def apply_delta(base: str, ops: list) -> str:
+    return ''.join(base[op[0]:op[1]] if isinstance(op, list) else op for op in ops)
+
+
+def _pack(value) -> bytes:
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def _unpack(data: bytes):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def _timestamp(ts: str) -> float:
+    return datetime.datetime.fromisoformat(ts).timestamp()
+
+
+class RevisionStore(SQLiteStore):
+    """Thread-safe access to the revision database."""
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, path: str, interval: int = 60):
+        self.interval = interval
+        self._texts = OrderedDict()
+        self._texts_lock = threading.Lock()
+        self._pruned = {}
+        super().__init__(path)
+
+    def _remember(self, rev_id: int, text: str) -> None:
+        with self._texts_lock:
+            self._texts[rev_id] = text
+            self._texts.move_to_end(rev_id)
+            while len(self._texts) > TEXT_CACHE_SIZE:
+                self._texts.popitem(last=False)
+
+    def _text(self, conn, rev_id: int) -> str:
+        """Rebuild the text of revision ``rev_id``."""
+        with self._texts_lock:
+            text = self._texts.get(rev_id)
+        if text is not None:
+            return text
+        chain = conn.execute(CHAIN_QUERY, (rev_id,)).fetchall()
+        text = _unpack(chain[-1][2])
+        for _, _, data in reversed(chain[:-1]):
+            text = apply_delta(text, _unpack(data))
+        self._remember(rev_id, text)
+        return text
+
+    def _encode(self, conn, base, text: str):
+        """Return ``(base, data)`` for storing ``text`` after revision ``base``.
+
+        ``text`` becomes a delta against ``base`` unless that chain is full,
+        in which case it becomes a new snapshot.
+        """
+        if base is not None:
+            delta = _pack(make_delta(self._text(conn, base), text))
+            length, total, snapshot = conn.execute(
+                f'SELECT count(*), sum(length(data)), '
+                f'sum(CASE WHEN base IS NULL THEN length(data) END) FROM ({CHAIN_QUERY})',
+                (base,),
+            ).fetchone()
+            if length < MAX_CHAIN and total - snapshot + len(delta) <= snapshot:
+                return base, delta
+        return None, _pack(text)
+
+    def record(self, path: str, text: str, revision: str, words: int,
+               when: datetime.datetime = None, replace: bool = True) -> None:
+        """Add ``text`` as the newest revision of the chapter at ``path``.
+
+        ``revision`` is the content hash of ``text``. Unless ``replace`` is
+        false, a save in the same ``interval`` as the previous revision
+        replaces it.
+        """
+        when = when or datetime.datetime.now()
+        ts = when.isoformat(timespec='seconds')
+        with self.transaction() as conn:
+            last = conn.execute(
+                'SELECT id, ts, hash, base FROM revisions WHERE path = ? '
+                'ORDER BY ts DESC, id DESC LIMIT 1',
+                (path,),
+            ).fetchone()
+            base = None
+            if last:
+                if last[2] == revision:
+                    return
+                base = last[0]
+                same_interval = replace and self.interval and (
+                    int(_timestamp(last[1]) // self.interval) == int(when.timestamp() // self.interval)
+                )
+                if same_interval and not self._has_children(conn, last[0]):
+                    conn.execute('DELETE FROM revisions WHERE id = ?', (last[0],))
+                    base = last[3]
+            base, data = self._encode(conn, base, text)
+            cursor = conn.execute(
+                'INSERT INTO revisions (path, ts, hash, words, base, data) VALUES (?, ?, ?, ?, ?, ?)',
+                (path, ts, revision, words, base, data),
+            )
+            self._remember(cursor.lastrowid, text)
+            if when.timestamp() - self._pruned.get(path, 0) >= PRUNE_EVERY:
+                self._prune(conn, path, when.timestamp())
+                self._pruned[path] = when.timestamp()
+
+    def _has_children(self, conn, rev_id: int) -> bool:
+        row = conn.execute('SELECT 1 FROM revisions WHERE base = ? LIMIT 1', (rev_id,)).fetchone()
+        return row is not None
+
+    def _prune(self, conn, path: str, now: float) -> None:
+        """Thin out old revisions of one chapter according to ``RETENTION``."""
+        rows = conn.execute(
+            'SELECT id, ts FROM revisions WHERE path = ? ORDER BY ts DESC, id DESC', (path,)
+        ).fetchall()
+        seen = set()
+        for rev_id, ts in rows[1:]:
+            moment = _timestamp(ts)
+            for age, step in RETENTION:
+                if now - moment > age:
+                    key = (step, int(moment // step))
+                    if key in seen:
+                        self._remove(conn, rev_id)
+                    seen.add(key)
+                    break
+
+    def _remove(self, conn, rev_id: int) -> None:
+        """Delete a revision, re-encoding the revisions built on it."""
+        base = conn.execute('SELECT base FROM revisions WHERE id = ?', (rev_id,)).fetchone()[0]
+        children = conn.execute('SELECT id FROM revisions WHERE base = ?', (rev_id,)).fetchall()
+        for (child,) in children:
+            text = self._text(conn, child)
+            new_base, data = self._encode(conn, base, text)
+            conn.execute('UPDATE revisions SET base = ?, data = ? WHERE id = ?', (new_base, data, child))
+        conn.execute('DELETE FROM revisions WHERE id = ?', (rev_id,))
+        with self._texts_lock:
+            self._texts.pop(rev_id, None)
+
+    def has_history(self, path: str) -> bool:
+        row = self.connection().execute(
+            'SELECT 1 FROM revisions WHERE path = ? LIMIT 1', (path,)
+        ).fetchone()
+        return row is not None
+
+    def list(self, path: str) -> list:
+        """Return ``(id, ts, hash, words, stored bytes)`` rows, newest first."""
+        return self.connection().execute(
+            'SELECT id, ts, hash, words, length(data) FROM revisions '
+            'WHERE path = ? ORDER BY ts DESC, id DESC',
+            (path,),
+        ).fetchall()
+
+    def get(self, path: str, rev_id: int):
+        """Return the text of revision ``rev_id`` of ``path``, or ``None``."""
+        conn = self.connection()
+        row = conn.execute(
+            'SELECT 1 FROM revisions WHERE id = ? AND path = ?', (rev_id, path)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._text(conn, rev_id)
+
+    def rename_prefix(self, old: str, new: str) -> None:
+        """Move the history of chapters below ``old`` to ``new``."""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE revisions SET path = ? || substr(path, ?) "
+                "WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                (new, len(old) + 1, old, like_prefix(old)),
+            )
+
+    def delete_prefix(self, path: str) -> None:
+        """Drop the history of removed chapters."""
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM revisions WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                (path, like_prefix(path)),
+            )
+
+    def merge_database(self, path: str) -> None:
+        """Add revisions from another database that are not already here."""
+        conn = self.connection()
+        conn.execute('ATTACH DATABASE ? AS incoming', (path,))
+        try:
+            with self.transaction() as conn:
+                ids = {}
+                rows = conn.execute(
+                    'SELECT id, path, ts, hash, words, base, data FROM incoming.revisions ORDER BY id'
+                ).fetchall()
+                for rev_id, rev_path, ts, revision, words, base, data in rows:
+                    existing = conn.execute(
+                        'SELECT id FROM revisions WHERE path = ? AND ts = ? AND hash = ?',
+                        (rev_path, ts, revision),
+                    ).fetchone()
+                    if existing:
+                        ids[rev_id] = existing[0]
+                        continue
+                    if base is not None:
+                        if base not in ids:
+                            continue
+                        base = ids[base]
+                    cursor = conn.execute(
+                        'INSERT INTO revisions (path, ts, hash, words, base, data) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (rev_path, ts, revision, words, base, data),
+                    )
+                    ids[rev_id] = cursor.lastrowid
+        finally:
+            self.connection().execute('DETACH DATABASE incoming')
@@ -0,0 +1,206 @@
+"""HTML sanitizers for chapter text.
+
+``clean_bleach`` runs bleach with a reusable ``Cleaner`` per thread.
+``clean_fast`` is a single-pass tokenizer for the markup the editor
+produces: it re-serializes input that uses CalWriter's small tag set in
+well-formed nesting, and hands anything it cannot prove bleach would treat
+the same way (comments, misnested or unclosed tags, unknown entities,
+unusual URLs, ...) to ``clean_bleach``. Both produce identical output.
+"""
+import re
+import threading
+from html.entities import html5 as _html5_entities
+
+ALLOWED_TAGS = [
+    "b", "strong", "i", "em", "u", "p", "br", "div", "ul", "ol", "li", "hr",
+    "span", "img"
+]
+ALLOWED_ATTRS = {
+    "*": ["class", "style"],
+    "img": ["src", "alt", "width", "height", "style"]
+}
+
+_local = threading.local()
+
+
+def clean_bleach(html: str) -> str:
+    """Sanitize ``html`` with bleach."""
+    cleaner = getattr(_local, 'cleaner', None)
+    if cleaner is None:
+        import warnings
+        import bleach
+        from bleach.sanitizer import NoCssSanitizerWarning
+        with warnings.catch_warnings():
+            # Style values are dropped; that is the intended behaviour.
+            warnings.simplefilter('ignore', NoCssSanitizerWarning)
+            cleaner = bleach.Cleaner(tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRS, strip=True)
+        _local.cleaner = cleaner
+    return cleaner.clean(html)
+
+
+# Fast path ------------------------------------------------------------------
+
+_VOID = {'br', 'hr', 'img'}
+# Disallowed tags that bleach strips without html5lib restructuring the
+# tree around them, as long as they are properly nested.
+_INERT = {
+    'font', 'sub', 'sup', 'small', 'big', 's', 'strike', 'mark', 'code', 'tt',
+    'abbr', 'cite', 'q', 'kbd', 'samp', 'var',
+}
+# Start tags that implicitly close an open <p>.
+_CLOSES_P = {'p', 'div', 'ul', 'ol', 'li', 'hr'}
+_SPECIAL = {'p', 'div', 'ul', 'ol', 'li'}
+_FORMATTING = {'b', 'i', 'u', 'strong', 'em', 'font', 'big', 'small', 's', 'strike', 'tt', 'code'}
+_TAG_ATTRS = {
+    tag: set(ALLOWED_ATTRS['*']) | set(ALLOWED_ATTRS.get(tag, []))
+    for tag in ALLOWED_TAGS
+}
+
+# Only space, tab and newline count as whitespace; input with other control
+# characters never reaches the tokenizer.
+_TOKEN_RE = re.compile(
+    r'([^<]+)'
+    r'|<(/?)([a-zA-Z][a-zA-Z0-9]*)'
+    r'((?:[ \t\n]+[^ \t\n"\'<>/=`]+(?:[ \t\n]*=[ \t\n]*(?:"[^"]*"|\'[^\']*\'|[^ \t\n"\'=<>`]+))?)*)'
+    r'[ \t\n]*(/?)>'
+)
+_ATTR_RE = re.compile(
+    r'([^ \t\n"\'<>/=`]+)(?:[ \t\n]*=[ \t\n]*(?:"([^"]*)"|\'([^\']*)\'|([^ \t\n"\'=<>`]+)))?'
+)
+_BAD_CHAR_RE = re.compile(r'[\x00-\x08\x0b-\x1f\x7f-\x9f\ud800-\udfff\ufdd0-\ufdef\ufffe\uffff]')
+_ENTITY_RE = re.compile(r'#([0-9]{1,6});|#[xX]([0-9a-fA-F]{1,6});|([a-zA-Z][a-zA-Z0-9]*);')
+_SAFE_VALUE_RE = re.compile(r'[^&<>"]*')
+_SAFE_SRC_RE = re.compile(
+    r'/media/[0-9a-f]{64}\.[a-z]+|https?://[A-Za-z0-9][A-Za-z0-9._~:/?#\[\]@!$()*+,;=%-]*'
+)
+
+
+def _valid_codepoint(code: int) -> bool:
+    return code in (9, 10) or 0x20 <= code < 0x7f or 0xa0 <= code < 0xd800 or 0xe000 <= code <= 0xfffd
+
+
+def _escape_text(text: str):
+    """Return ``text`` escaped as bleach would, or ``None`` if unsure.
+
+    Known character references are kept, an ``&`` followed by whitespace
+    becomes ``&amp;`` and anything else involving ``&`` is left to bleach.
+    """
+    if '&' in text:
+        pieces = text.split('&')
+        for i in range(1, len(pieces)):
+            piece = pieces[i]
+            if not piece or piece[0] in ' \t\n':
+                pieces[i] = 'amp;' + piece
+                continue
+            match = _ENTITY_RE.match(piece)
+            if match is None:
+                return None
+            decimal, hexadecimal, name = match.groups()
+            if name is not None:
+                if name + ';' not in _html5_entities:
+                    return None
+            elif not _valid_codepoint(int(decimal) if decimal else int(hexadecimal, 16)):
+                return None
+        text = '&'.join(pieces)
+    return text.replace('>', '&gt;')
+
+
+def _clean_attrs(tag: str, raw: str):
+    """Return serialized allowed attributes, or ``None`` if unsure."""
+    allowed = _TAG_ATTRS.get(tag, ())
+    seen = set()
+    out = []
+    for match in _ATTR_RE.finditer(raw):
+        name = match.group(1).lower()
+        if name in seen:
+            continue
+        seen.add(name)
+        if name not in allowed:
+            continue
+        if name == 'style':
+            out.append(' style=""')
+            continue
+        value = match.group(2)
+        if value is None:
+            value = match.group(3)
+        if value is None:
+            value = match.group(4) or ''
+        if not _SAFE_VALUE_RE.fullmatch(value):
+            return None
+        if name == 'src' and not _SAFE_SRC_RE.fullmatch(value):
+            return None
+        out.append(f' {name}="{value}"')
+    return ''.join(out)
+
+
+def _clean_fast(html: str):
+    """Sanitize well-formed editor markup, or return ``None``."""
+    if _BAD_CHAR_RE.search(html):
+        return None
+    out = []
+    stack = []
+    pos = 0
+    length = len(html)
+    while pos < length:
+        match = _TOKEN_RE.match(html, pos)
+        if match is None:
+            return None
+        pos = match.end()
+        text, closing, tag, attrs, self_closing = match.groups()
+        if text is not None:
+            text = _escape_text(text)
+            if text is None:
+                return None
+            out.append(text)
+            continue
+        tag = tag.lower()
+        allowed = tag in _TAG_ATTRS
+        if not allowed and tag not in _INERT:
+            return None
+        if closing:
+            if attrs or self_closing or not stack or stack[-1][0] != tag:
+                return None
+            stack.pop()
+            if allowed:
+                out.append(f'</{tag}>')
+            continue
+        if self_closing and tag not in _VOID:
+            return None
+        if tag in _CLOSES_P and any(t == 'p' for t, _ in stack):
+            return None
+        if tag == 'li':
+            for open_tag, _ in reversed(stack):
+                if open_tag == 'li':
+                    return None
+                if open_tag in _SPECIAL and open_tag not in ('div', 'p'):
+                    break
+        if allowed:
+            cleaned = _clean_attrs(tag, attrs)
+            if cleaned is None:
+                return None
+            out.append(f'<{tag}{cleaned}>')
+        if tag in _VOID:
+            continue
+        if tag in _FORMATTING and sum(1 for item in stack if item == (tag, attrs)) >= 3:
+            return None
+        stack.append((tag, attrs))
+    if stack:
+        return None
+    return ''.join(out)
+
+
+def clean_fast(html: str) -> str:
+    """Sanitize ``html``, using bleach only for markup the fast path rejects."""
+    result = _clean_fast(html)
+    return result if result is not None else clean_bleach(html)
+
+
+BACKENDS = {'bleach': clean_bleach, 'fast': clean_fast}
+
+
+def get_sanitizer(name: str):
+    """Return the sanitizer function called ``name``."""
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown sanitizer {name!r}; expected one of {", ".join(BACKENDS)}')
@@ -0,0 +1,185 @@
+"""Persistent full-text index for CalWriter search.
+
+Chapter text, notes, descriptions and authors are stored in an SQLite FTS5
+table. Save routes only mark documents as dirty; they are re-read and
+indexed right before the next query, so autosaves stay cheap.
+"""
+import re
+import sqlite3
+
+from sqlite_store import SQLiteStore, like_prefix
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    book TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    chapter TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    UNIQUE (folder, chapter, kind)
+);
+CREATE INDEX IF NOT EXISTS entries_book ON entries (book);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(
+    body, tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS dirty (
+    folder TEXT NOT NULL,
+    chapter TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (folder, chapter, kind)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Markers placed around matches in snippets; they never occur in text.
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+
+def fts_available() -> bool:
+    try:
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE VIRTUAL TABLE t USING fts5(a)')
+        conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def build_query(text: str) -> str:
+    """Translate a search box query into an FTS5 expression.
+
+    Quoted text becomes a phrase query; bare words must all match and also
+    match longer words starting with them.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        if phrase.strip():
+            terms.append('"' + phrase.strip() + '"')
+        elif word:
+            word = word.replace('"', '')
+            if word:
+                terms.append('"' + word + '"*')
+    return ' '.join(terms)
+
+
+class SearchIndex(SQLiteStore):
+    """Thread-safe access to the search database."""
+
+    SCHEMA = SCHEMA
+
+    def is_built(self) -> bool:
+        row = self.connection().execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def mark_dirty(self, folder: str, chapter: str, kind: str) -> None:
+        """Queue a document to be re-read before the next search."""
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO dirty (folder, chapter, kind) VALUES (?, ?, ?)',
+                (folder, chapter, kind),
+            )
+
+    def dirty(self) -> list:
+        return self.connection().execute('SELECT folder, chapter, kind FROM dirty').fetchall()
+
+    def update(self, folder: str, chapter: str, kind: str, text) -> None:
+        """Store ``text`` for a document, or remove it when ``text`` is None."""
+        with self.transaction() as conn:
+            row = conn.execute(
+                'SELECT id FROM entries WHERE folder = ? AND chapter = ? AND kind = ?',
+                (folder, chapter, kind),
+            ).fetchone()
+            if row:
+                conn.execute('DELETE FROM docs WHERE rowid = ?', (row[0],))
+            if text is None:
+                if row:
+                    conn.execute('DELETE FROM entries WHERE id = ?', (row[0],))
+            else:
+                if row:
+                    doc_id = row[0]
+                else:
+                    doc_id = conn.execute(
+                        'INSERT INTO entries (book, folder, chapter, kind) VALUES (?, ?, ?, ?)',
+                        (folder.split('/')[0], folder, chapter, kind),
+                    ).lastrowid
+                conn.execute('INSERT INTO docs (rowid, body) VALUES (?, ?)', (doc_id, text))
+            conn.execute(
+                'DELETE FROM dirty WHERE folder = ? AND chapter = ? AND kind = ?',
+                (folder, chapter, kind),
+            )
+
+    def rebuild(self, documents) -> int:
+        """Replace the whole index with ``(folder, chapter, kind, text)`` tuples."""
+        count = 0
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM docs')
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM dirty')
+            for folder, chapter, kind, text in documents:
+                self.update(folder, chapter, kind, text)
+                count += 1
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+        return count
+
+    def invalidate(self) -> None:
+        """Force a full rebuild before the next search."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM meta WHERE key = 'built'")
+
+    def rename_prefix(self, old: str, new: str) -> None:
+        """Point documents at ``old`` (a folder or chapter path) to ``new``."""
+        new_folder, _, new_chapter = new.rpartition('/')
+        with self.transaction() as conn:
+            for table in ('entries', 'dirty'):
+                conn.execute(
+                    f"UPDATE {table} SET folder = ?, chapter = ? "
+                    f"WHERE chapter != '' AND folder || '/' || chapter = ?",
+                    (new_folder, new_chapter, old),
+                )
+                conn.execute(
+                    f"UPDATE {table} SET folder = ? || substr(folder, ?) "
+                    f"WHERE folder = ? OR folder LIKE ? ESCAPE '\\'",
+                    (new, len(old) + 1, old, like_prefix(old)),
+                )
+            conn.execute("UPDATE entries SET book = substr(folder, 1, instr(folder || '/', '/') - 1)")
+
+    def delete_prefix(self, path: str) -> None:
+        where = (
+            "(chapter != '' AND folder || '/' || chapter = ?) "
+            "OR folder = ? OR folder LIKE ? ESCAPE '\\'"
+        )
+        params = (path, path, like_prefix(path))
+        with self.transaction() as conn:
+            conn.execute(f'DELETE FROM docs WHERE rowid IN (SELECT id FROM entries WHERE {where})', params)
+            conn.execute(f'DELETE FROM entries WHERE {where}', params)
+            conn.execute(f'DELETE FROM dirty WHERE {where}', params)
+
+    def search(self, query: str, book: str = '', limit: int = 100) -> list:
+        """Return ranked matches as dicts with a highlighted ``snippet``."""
+        expression = build_query(query)
+        if not expression:
+            return []
+        sql = (
+            'SELECT e.folder, e.chapter, e.kind, '
+            f"snippet(docs, 0, '{MATCH_START}', '{MATCH_END}', '…', 16) "
+            'FROM docs JOIN entries e ON e.id = docs.rowid '
+            'WHERE docs MATCH ?'
+        )
+        params = [expression]
+        if book:
+            sql += ' AND e.book = ?'
+            params.append(book)
+        sql += ' ORDER BY bm25(docs) LIMIT ?'
+        params.append(limit)
+        try:
+            rows = self.connection().execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            return []
+        return [
+            {'folder': folder, 'chapter': chapter, 'type': kind, 'snippet': snippet}
+            for folder, chapter, kind, snippet in rows
+        ]
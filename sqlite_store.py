@@ -0,0 +1,70 @@
+"""Shared plumbing for CalWriter's SQLite databases."""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+def like_prefix(path: str) -> str:
+    """Return a LIKE pattern (escaped with ``\\``) for paths below ``path``."""
+    escaped = path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '/%'
+
+
+class SQLiteStore:
+    """Thread-safe access to one WAL-mode database.
+
+    Each thread gets its own connection. Subclasses set ``SCHEMA`` and may
+    override ``before_commit`` to add statements to every write.
+    """
+
+    SCHEMA = ''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.register_at_fork(after_in_child=self._after_fork)
+        self.connection().executescript(self.SCHEMA)
+
+    def _after_fork(self) -> None:
+        # Connections must not be used across fork; children open their own.
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        """Close this thread's connection; the next use opens a new one."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Run a block of statements as one write transaction."""
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            self.before_commit(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def before_commit(self, conn: sqlite3.Connection) -> None:
+        pass
+
+    def checkpoint(self) -> None:
+        """Fold the WAL back into the main database file."""
+        self.connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
@@ -67,11 +67,410 @@ function toggleTree(el) {
         if (path) {
             const collapsed = li.classList.contains('collapsed');
             localStorage.setItem('collapsed:' + path, collapsed ? '1' : '0');
+            if (!collapsed) loadTreeChildren(li);
         }
     }
 }
+
+// The sidebar tree is loaded one level at a time from
+// /folder/<path>/children as folders are expanded. Each level is kept in
+// sessionStorage with its ETag: a cached level is shown at once and then
+// revalidated. Books start expanded and sub-folders collapsed until the
+// reader toggles them.
+function isTreeExpanded(li) {
+    const state = localStorage.getItem('collapsed:' + li.dataset.path);
+    if (state === null) return li.classList.contains('book-root');
+    return state === '0';
+}
+
+function renderTreeChildren(li, data) {
+    const ul = li.querySelector(':scope > ul');
+    ul.innerHTML = '';
+    data.folders.filter(f => !f.closed).forEach(f => {
+        const item = document.createElement('li');
+        item.className = 'tree-item';
+        item.dataset.path = data.path + '/' + f.name;
+        const line = document.createElement('div');
+        line.className = 'item-line';
+        if (f.children) {
+            item.classList.add('collapsible');
+            const toggle = document.createElement('span');
+            toggle.className = 'toggle';
+            toggle.addEventListener('click', () => toggleTree(toggle));
+            line.appendChild(toggle);
+        }
+        const link = document.createElement('a');
+        link.href = '/folder/' + item.dataset.path;
+        link.textContent = f.name;
+        line.appendChild(link);
+        item.appendChild(line);
+        ul.appendChild(item);
+        if (f.children) {
+            item.appendChild(document.createElement('ul'));
+            if (isTreeExpanded(item)) {
+                loadTreeChildren(item);
+            } else {
+                item.classList.add('collapsed');
+            }
+        }
+    });
+    data.chapters.filter(c => !c.closed).forEach(c => {
+        const item = document.createElement('li');
+        item.className = 'tree-item chapter-item';
+        const link = document.createElement('a');
+        link.href = `/folder/${data.path}/chapter/${c.name}`;
+        link.textContent = c.name;
+        item.appendChild(link);
+        ul.appendChild(item);
+    });
+    const toggle = li.querySelector(':scope > .item-line > .toggle');
+    if (toggle) toggle.style.display = ul.children.length ? '' : 'none';
+}
+
+async function loadTreeChildren(li) {
+    if (li.dataset.loaded) return;
+    li.dataset.loaded = '1';
+    const path = li.dataset.path;
+    const key = 'tree:' + path;
+    let cached = null;
+    try {
+        cached = JSON.parse(sessionStorage.getItem(key));
+    } catch (e) {}
+    if (cached) renderTreeChildren(li, cached.data);
+    try {
+        const url = '/folder/' + path.split('/').map(encodeURIComponent).join('/') + '/children';
+        const resp = await fetch(url, {
+            headers: cached && cached.etag ? {'If-None-Match': cached.etag} : {}
+        });
+        if (resp.status === 304 || !resp.ok) return;
+        const data = await resp.json();
+        try {
+            sessionStorage.setItem(key, JSON.stringify({etag: resp.headers.get('ETag'), data}));
+        } catch (e) {}
+        if (!cached || JSON.stringify(cached.data) !== JSON.stringify(data)) {
+            renderTreeChildren(li, data);
+        }
+    } catch (e) {
+        if (!cached) delete li.dataset.loaded;
+    }
+}
+function newBookItem(name) {
+    const li = document.createElement('li');
+    li.className = 'tree-item collapsible book-root';
+    li.dataset.path = name;
+    const line = document.createElement('div');
+    line.className = 'item-line';
+    const toggle = document.createElement('span');
+    toggle.className = 'toggle';
+    toggle.addEventListener('click', () => toggleTree(toggle));
+    const link = document.createElement('a');
+    link.href = '/folder/' + name;
+    link.textContent = name;
+    line.appendChild(toggle);
+    line.appendChild(link);
+    li.appendChild(line);
+    li.appendChild(document.createElement('ul'));
+    if (isTreeExpanded(li)) {
+        loadTreeChildren(li);
+    } else {
+        li.classList.add('collapsed');
+    }
+    return li;
+}
+
+async function refreshBooks() {
+    const tree = document.querySelector('#sidebar .tree');
+    if (!tree) return;
+    const resp = await fetch('/books/children').catch(() => null);
+    if (!resp || !resp.ok) return;
+    const data = await resp.json();
+    const items = {};
+    tree.querySelectorAll(':scope > li[data-path]').forEach(li => {
+        items[li.dataset.path] = li;
+    });
+    data.folders.filter(f => !f.closed).forEach(f => {
+        tree.appendChild(items[f.name] || newBookItem(f.name));
+        delete items[f.name];
+    });
+    Object.values(items).forEach(li => li.remove());
+}
+
+// Reloads one level of the sidebar ('' is the list of books), if it is
+// shown. Changes from a batch arrive together, so levels are collected for
+// a moment and each is fetched once.
+const pendingTreeLevels = new Set();
+
+function refreshTreeLevel(path) {
+    if (!pendingTreeLevels.size) setTimeout(reloadTreeLevels, 50);
+    pendingTreeLevels.add(path);
+}
+
+function reloadTreeLevels() {
+    pendingTreeLevels.forEach(path => {
+        sessionStorage.removeItem('tree:' + path);
+        if (path === '') {
+            refreshBooks();
+            return;
+        }
+        const li = document.querySelector(`#sidebar li[data-path="${CSS.escape(path)}"]`);
+        if (li && li.dataset.loaded) {
+            delete li.dataset.loaded;
+            loadTreeChildren(li);
+        }
+    });
+    pendingTreeLevels.clear();
+}
+
+function refreshTree() {
+    Object.keys(sessionStorage).filter(key => key.startsWith('tree:')).forEach(key => {
+        sessionStorage.removeItem(key);
+    });
+    refreshBooks();
+    document.querySelectorAll('#sidebar li[data-loaded]').forEach(li => {
+        delete li.dataset.loaded;
+        loadTreeChildren(li);
+    });
+}
+
+// Library changes made in any window (folders and chapters created,
+// renamed, deleted, closed, opened or reordered) arrive from /changes as
+// server-sent events. One tab per browser, the one holding a Web Lock,
+// keeps the connection and passes the changes on to the others over a
+// BroadcastChannel; without those APIs every tab connects on its own.
+// Each tab then reloads the sidebar levels involved and fixes up its
+// tabs and links.
+function startChangeFeed() {
+    if (document.body.dataset.changeSeq === undefined || typeof EventSource === 'undefined') return;
+    let seq = Number(document.body.dataset.changeSeq);
+    const channel = typeof BroadcastChannel !== 'undefined' ? new BroadcastChannel('calwriter-changes') : null;
+    const receive = change => {
+        if (change.action !== 'reset' && change.seq <= seq) return;
+        seq = change.seq;
+        applyChange(change);
+    };
+    // A page shown from the browser cache may be behind the feed, and
+    // tabs that are not connected only hear of changes from now on.
+    fetch('/changes?timeout=0&since=' + seq)
+        .then(r => r.json())
+        .then(data => {
+            if (data.reset) receive({action: 'reset', seq: data.seq});
+            else data.changes.forEach(receive);
+        })
+        .catch(() => {});
+    const connect = () => new Promise(() => {
+        const source = new EventSource('/changes?since=' + seq);
+        const relay = change => {
+            if (channel) channel.postMessage(change);
+            receive(change);
+        };
+        source.addEventListener('message', e => relay(JSON.parse(e.data)));
+        source.addEventListener('reset', e => relay({action: 'reset', seq: Number(e.lastEventId)}));
+    });
+    if (channel && navigator.locks) {
+        channel.addEventListener('message', e => receive(e.data));
+        navigator.locks.request('calwriter-changes', connect);
+    } else {
+        connect();
+    }
+}
+
+function parentPath(path) {
+    const i = path.lastIndexOf('/');
+    return i === -1 ? '' : path.slice(0, i);
+}
+
+// Returns `path` with the prefix `from` replaced by `to`, or null if it is
+// not `from` or below it.
+function movedPath(path, from, to) {
+    if (path === from) return to;
+    if (path.startsWith(from + '/')) return to + path.slice(from.length);
+    return null;
+}
+
+function changeUrl(change, path) {
+    if (change.type !== 'chapter') return '/folder/' + path;
+    return `/folder/${parentPath(path)}/chapter/${path.slice(path.lastIndexOf('/') + 1)}`;
+}
+
+function updateOpenTabs(update) {
+    const tabs = update(JSON.parse(localStorage.getItem('open_tabs') || '[]'));
+    localStorage.setItem('open_tabs', JSON.stringify(tabs));
+    if (currentTab) syncTabs();
+}
+
+function applyChange(change) {
+    if (change.action === 'reset' || change.type === 'library') {
+        refreshTree();
+        return;
+    }
+    if (change.action === 'reordered') {
+        refreshTreeLevel(change.path);
+        return;
+    }
+    const parent = parentPath(change.path);
+    refreshTreeLevel(parent);
+    // The parent's own entry may gain or lose its toggle.
+    if (parent) refreshTreeLevel(parentPath(parent));
+    if (change.to && parentPath(change.to) !== parent) {
+        refreshTreeLevel(parentPath(change.to));
+        if (parentPath(change.to)) refreshTreeLevel(parentPath(parentPath(change.to)));
+    }
+    if (change.action === 'renamed' || change.action === 'moved') {
+        followRename(change);
+    } else if (change.action === 'deleted' || (change.action === 'closed' && change.type === 'folder' && !parent)) {
+        if (change.action === 'deleted') leaveDeletedPage(change);
+        updateOpenTabs(tabs => tabs.filter(t => movedPath(`${t.folder}/${t.name}`, change.path, '') === null));
+    }
+}
+
+function followRename(change) {
+    const from = changeUrl(change, change.path);
+    const to = changeUrl(change, change.to);
+    const move = value => {
+        const url = new URL(value, location.href);
+        let moved = null;
+        try {
+            moved = movedPath(decodeURIComponent(url.pathname), from, to);
+        } catch (e) {}
+        if (url.origin !== location.origin || moved === null) return null;
+        url.pathname = moved;
+        return url.pathname + url.search + url.hash;
+    };
+    const here = move(location.href);
+    if (here) history.replaceState(history.state, '', here);
+    ['href', 'action', 'data-save-url', 'data-delta-url'].forEach(attr => {
+        document.querySelectorAll(`#main [${attr}]`).forEach(el => {
+            const moved = move(el.getAttribute(attr));
+            if (moved) el.setAttribute(attr, moved);
+        });
+    });
+    if (!parentPath(change.path) && window.bookColors) {
+        window.bookColors[change.to] = window.bookColors[change.path];
+    }
+    if (currentTab) {
+        const moved = movedPath(`${currentTab.folder}/${currentTab.name}`, change.path, change.to);
+        if (moved !== null) {
+            currentTab.folder = parentPath(moved);
+            currentTab.name = moved.slice(moved.lastIndexOf('/') + 1);
+            currentTab.container.dataset.folder = currentTab.folder;
+            currentTab.container.dataset.chapter = currentTab.name;
+            const title = document.querySelector('#chapter_area h1');
+            if (title) title.textContent = `${currentTab.folder} / ${currentTab.name}`;
+        }
+    }
+    updateOpenTabs(tabs => tabs.map(t => {
+        const moved = movedPath(`${t.folder}/${t.name}`, change.path, change.to);
+        if (moved === null) return t;
+        return Object.assign({}, t, {folder: parentPath(moved), name: moved.slice(moved.lastIndexOf('/') + 1)});
+    }));
+}
+
+// Stops saving into a deleted chapter; pages other than the editor move up
+// to the parent folder. The editor moves on when its tab is closed.
+function leaveDeletedPage(change) {
+    let here = null;
+    try {
+        here = movedPath(decodeURIComponent(location.pathname), changeUrl(change, change.path), '');
+    } catch (e) {}
+    if (here === null) return;
+    document.querySelectorAll('#chapter_editor, #notes_editor').forEach(el => {
+        el.dataset.conflict = '1';
+    });
+    if (!currentTab) {
+        const parent = parentPath(change.path);
+        window.location.href = parent ? '/folder/' + parent : '/';
+    }
+}
+
 function prepareChapter() {
-    document.getElementById('chapter_text').value = document.getElementById('chapter_editor').innerHTML;
+    const editor = document.getElementById('chapter_editor');
+    document.getElementById('chapter_text').value = editor.innerHTML;
+    document.getElementById('chapter_revision').value = editor.dataset.revision || '';
+}
+
+// Saves send the stored revision they started from (data-revision) as
+// If-Match. A 409 "conflict" means another window saved in the meantime,
+// so autosave stops instead of overwriting that work.
+function ifMatch(element) {
+    return element.dataset.revision ? {'If-Match': '"' + element.dataset.revision + '"'} : {};
+}
+
+function updateRevision(element, resp) {
+    const etag = resp.headers.get('ETag');
+    if (etag) element.dataset.revision = etag.replace(/^W\//, '').replace(/"/g, '');
+}
+
+async function isConflict(resp) {
+    if (resp.status !== 409) return false;
+    const data = await resp.clone().json().catch(() => ({}));
+    return data.error === 'conflict';
+}
+
+function reportConflict(element, what) {
+    if (element.dataset.conflict) return;
+    element.dataset.conflict = '1';
+    alert(`This ${what} was changed in another window. Reload the page to get the latest version; changes made here are no longer saved.`);
+}
+
+// Text and revision of the last autosave the server accepted. Later saves
+// only send the changed range against it.
+const autosaveState = {base: null, revision: null, pending: Promise.resolve()};
+
+function diffText(oldText, newText) {
+    const minLen = Math.min(oldText.length, newText.length);
+    let start = 0;
+    while (start < minLen && oldText.charCodeAt(start) === newText.charCodeAt(start)) start++;
+    let oldEnd = oldText.length;
+    let newEnd = newText.length;
+    while (oldEnd > start && newEnd > start &&
+           oldText.charCodeAt(oldEnd - 1) === newText.charCodeAt(newEnd - 1)) {
+        oldEnd--;
+        newEnd--;
+    }
+    return [start, oldEnd, newText.slice(start, newEnd)];
+}
+
+// Uploads of at least this many characters are gzipped where the browser
+// supports CompressionStream; the server inflates them.
+const COMPRESS_MIN_CHARS = 1024;
+
+async function compressBody(body, headers) {
+    if (body.length < COMPRESS_MIN_CHARS || typeof CompressionStream === 'undefined') return body;
+    const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+    headers['Content-Encoding'] = 'gzip';
+    return new Response(stream).blob();
+}
+
+async function postAutosave(url, payload, editor) {
+    const headers = Object.assign({ 'Content-Type': 'application/json' }, ifMatch(editor));
+    const body = await compressBody(JSON.stringify(payload), headers);
+    return fetch(url, {method: 'POST', headers, body});
+}
+
+function autosaveChapter(editor) {
+    autosaveState.pending = autosaveState.pending.then(async () => {
+        const url = editor.dataset.deltaUrl;
+        const text = editor.innerHTML;
+        if (text === autosaveState.base || editor.dataset.conflict) return;
+        let resp;
+        if (autosaveState.revision !== null) {
+            resp = await postAutosave(url, {
+                base: autosaveState.revision,
+                ops: [diffText(autosaveState.base, text)]
+            }, editor);
+        }
+        if (!resp || (resp.status === 409 && !await isConflict(resp))) {
+            resp = await postAutosave(url, {text: text}, editor);
+        }
+        if (await isConflict(resp)) {
+            reportConflict(editor, 'chapter');
+        } else if (resp.ok) {
+            const data = await resp.json();
+            autosaveState.base = text;
+            autosaveState.revision = data.revision;
+            updateRevision(editor, resp);
+        }
+    }).catch(() => {});
 }
 
 function updateWordCount() {
@@ -121,9 +520,10 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         });
     });
-    document.querySelectorAll('#sidebar .tree-item').forEach(li => {
-        const path = li.dataset.path;
-        if (path && localStorage.getItem('collapsed:' + path) === '1') {
+    document.querySelectorAll('#sidebar .tree > .tree-item').forEach(li => {
+        if (isTreeExpanded(li)) {
+            loadTreeChildren(li);
+        } else {
             li.classList.add('collapsed');
         }
     });
@@ -133,15 +533,7 @@ document.addEventListener('DOMContentLoaded', () => {
         editor.addEventListener('input', () => {
             updateWordCount();
             clearTimeout(timeout);
-            timeout = setTimeout(() => {
-                fetch(editor.dataset.saveUrl, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded'
-                    },
-                    body: new URLSearchParams({text: editor.innerHTML})
-                });
-            }, 1000);
+            timeout = setTimeout(() => autosaveChapter(editor), 1000);
         });
         updateWordCount();
     }
@@ -156,16 +548,26 @@ document.addEventListener('DOMContentLoaded', () => {
     const notes = document.getElementById('notes_editor');
     if (notes) {
         let timeout;
+        let pending = Promise.resolve();
         notes.addEventListener('input', () => {
             clearTimeout(timeout);
             timeout = setTimeout(() => {
-                fetch(notes.dataset.saveUrl, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded'
-                    },
-                    body: new URLSearchParams({notes: notes.value})
-                });
+                // One save at a time, so each carries the previous revision.
+                pending = pending.then(async () => {
+                    if (notes.dataset.conflict) return;
+                    const resp = await fetch(notes.dataset.saveUrl, {
+                        method: 'POST',
+                        headers: Object.assign({
+                            'Content-Type': 'application/x-www-form-urlencoded'
+                        }, ifMatch(notes)),
+                        body: new URLSearchParams({notes: notes.value})
+                    });
+                    if (await isConflict(resp)) {
+                        reportConflict(notes, 'note');
+                    } else if (resp.ok) {
+                        updateRevision(notes, resp);
+                    }
+                }).catch(() => {});
             }, 500);
         });
     }
@@ -201,18 +603,23 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     setupTabs();
+    startChangeFeed();
 
     document.querySelectorAll('.sortable').forEach(ul => {
         enableDragSort(ul);
     });
 });
 
+// The chapter shown on this page, once setupTabs has run.
+let currentTab = null;
+
 function setupTabs() {
     const tabsEl = document.getElementById('chapter_tabs');
     if (!tabsEl) return;
     const currentFolder = tabsEl.dataset.folder;
     const currentChapter = tabsEl.dataset.chapter;
     const currentType = tabsEl.dataset.type || 'chapter';
+    currentTab = {container: tabsEl, folder: currentFolder, name: currentChapter, type: currentType};
     let tabs = JSON.parse(localStorage.getItem('open_tabs') || '[]');
     const existing = tabs.find(t => t.folder === currentFolder && t.name === currentChapter && t.type === currentType);
     if (!existing) {
@@ -223,24 +630,33 @@ function setupTabs() {
         sortTabs(tabs);
     }
     renderTabs(tabsEl, tabs, currentFolder, currentChapter, currentType);
+    // Another window may have changed the tabs because a chapter was
+    // renamed; wait a moment so this page can follow the rename first.
+    let timeout;
     window.addEventListener('storage', (e) => {
         if (e.key === 'open_tabs') {
-            const updated = JSON.parse(e.newValue || '[]');
-            const stillOpen = updated.some(t => t.folder === currentFolder && t.name === currentChapter && t.type === currentType);
-            if (!stillOpen) {
-                if (updated.length) {
-                    const next = updated[updated.length - 1];
-                    window.location.href = `/folder/${next.folder}/chapter/${next.name}`;
-                } else {
-                    window.location.href = '/';
-                }
-                return;
-            }
-            renderTabs(tabsEl, updated, currentFolder, currentChapter, currentType);
+            clearTimeout(timeout);
+            timeout = setTimeout(syncTabs, 200);
         }
     });
 }
 
+function syncTabs() {
+    const {container, folder, name, type} = currentTab;
+    const tabs = JSON.parse(localStorage.getItem('open_tabs') || '[]');
+    const stillOpen = tabs.some(t => t.folder === folder && t.name === name && t.type === type);
+    if (!stillOpen) {
+        if (tabs.length) {
+            const next = tabs[tabs.length - 1];
+            window.location.href = `/folder/${next.folder}/chapter/${next.name}`;
+        } else {
+            window.location.href = '/';
+        }
+        return;
+    }
+    renderTabs(container, tabs, folder, name, type);
+}
+
 
 function enableTabDrag(container, tabs, currentFolder, currentChapter, currentType) {
     let dragging;
@@ -0,0 +1,324 @@
+"""Crash-safe file writes for CalWriter.
+
+Each write is appended to a write-ahead journal, the journal is fsynced, and
+only then is the target file replaced through a temporary file and a rename.
+Writers that arrive while an fsync is running wait for the next one, so a
+burst of saves shares a single fsync (group commit). The replaced files are
+not synced individually; after a crash, ``recover`` rewrites them from the
+journal. Once the journal grows past a limit it is checkpointed: the files it
+covers and the folders holding them are flushed to disk and the journal
+emptied.
+
+Several processes can share one journal. Writers hold a shared ``flock``
+from appending a record until the file is replaced. A checkpoint needs the
+exclusive lock, so it never empties the journal under another process's
+write in progress. Every process also holds a shared lock on
+``journal.lock`` for as long as it uses the journal; recovery only replays
+the journal when it can lock that file exclusively, so it never rewrites a
+file with a record another process is still committing.
+
+``FileLock`` serializes read-modify-write sequences across threads and
+processes.
+"""
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
+LOCK_SH = fcntl.LOCK_SH if fcntl else 0
+LOCK_EX = fcntl.LOCK_EX if fcntl else 0
+LOCK_NB = fcntl.LOCK_NB if fcntl else 0
+LOCK_UN = fcntl.LOCK_UN if fcntl else 0
+
+MAGIC = b'CWJ1'
+# magic, name length, data length, CRC32 of name + data
+HEADER = struct.Struct('>4sIQI')
+
+
+def replace_file(path: str, data: bytes) -> None:
+    """Replace ``path`` with ``data`` so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def sync_path(path: str) -> None:
+    """fsync the file or folder at ``path``, if it still exists."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # removed since, or a folder on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """Write-ahead journal for files below ``root``."""
+
+    def __init__(self, directory: str, root: str, checkpoint_bytes: int = 8 * 1024 * 1024):
+        self.directory = directory
+        self.root = root
+        self.path = os.path.join(directory, 'journal.log')
+        self.checkpoint_bytes = checkpoint_bytes
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self) -> None:
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._fd = None
+        self._users_fd = None
+        self._appended = 0
+        self._durable = 0
+        self._syncing = False
+        self._active = 0
+        self._size = 0
+
+    def _after_fork(self) -> None:
+        # A forked worker needs its own descriptor: flock belongs to the open
+        # file, so an inherited one would share the parent's lock.
+        for fd in (self._fd, self._users_fd):
+            if fd is not None:
+                os.close(fd)
+        self._reset()
+
+    def _open(self) -> int:
+        if self._fd is None:
+            if self._users_fd is None:
+                self._open_users(LOCK_SH)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        return self._fd
+
+    def _open_users(self, operation: int) -> None:
+        """Open and lock ``journal.lock``, held while this process uses the journal."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, 'journal.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl:
+            try:
+                fcntl.flock(fd, operation)
+            except BaseException:
+                os.close(fd)
+                raise
+        self._users_fd = fd
+
+    def _flock(self, operation: int) -> None:
+        if fcntl:
+            fcntl.flock(self._fd, operation)
+
+    def write(self, path: str, data: bytes) -> None:
+        """Durably replace ``path`` with ``data``."""
+        self.write_many([(path, data)])
+
+    def write_many(self, files: list) -> None:
+        """Durably replace several ``(path, data)`` files with one fsync.
+
+        Files are journaled and replaced in order.
+        """
+        records = []
+        for path, data in files:
+            name = os.path.relpath(path, self.root).replace(os.sep, '/').encode('utf-8')
+            crc = zlib.crc32(data, zlib.crc32(name))
+            records.append(HEADER.pack(MAGIC, len(name), len(data), crc) + name + data)
+        record = b''.join(records)
+        with self._lock:
+            fd = self._open()
+            if self._active == 0:
+                self._flock(LOCK_SH)
+            self._active += 1
+            try:
+                os.write(fd, record)
+                self._size += len(record)
+                self._appended += 1
+                self._wait_durable(fd, self._appended)
+            except BaseException:
+                self._release()
+                raise
+        try:
+            for path, data in files:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                replace_file(path, data)
+        finally:
+            with self._lock:
+                self._release()
+
+    def _wait_durable(self, fd: int, seq: int) -> None:
+        """Block until record ``seq`` is synced, syncing it if nobody is."""
+        while self._durable < seq:
+            if self._syncing:
+                self._synced.wait()
+                continue
+            self._syncing = True
+            target = self._appended
+            self._lock.release()
+            try:
+                os.fsync(fd)
+            finally:
+                self._lock.acquire()
+                self._syncing = False
+                self._synced.notify_all()
+            self._durable = max(self._durable, target)
+
+    def _release(self) -> None:
+        self._active -= 1
+        if self._active == 0:
+            if self._size >= self.checkpoint_bytes:
+                self._checkpoint(blocking=False)
+            self._flock(LOCK_UN)
+            self._synced.notify_all()
+
+    def _checkpoint(self, blocking: bool) -> bool:
+        """Flush written files and empty the journal (lock held, no writes active)."""
+        fd = self._open()
+        try:
+            self._flock(LOCK_EX if blocking else LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            return False
+        try:
+            self._sync_files(fd)
+            os.ftruncate(fd, 0)
+            os.fsync(fd)
+            self._size = 0
+        finally:
+            self._flock(LOCK_UN)
+        return True
+
+    def _sync_files(self, fd: int) -> None:
+        """fsync the files named in the journal and every folder above them."""
+        paths = set()
+        root = os.path.normpath(self.root)
+        for name, _ in self._records(fd):
+            path = os.path.join(root, *name.split('/'))
+            while path != root and path not in paths:
+                paths.add(path)
+                path = os.path.dirname(path)
+        paths.add(root)
+        # Deepest first, so each folder is synced after the entries in it.
+        for path in sorted(paths, key=lambda p: -p.count(os.sep)):
+            sync_path(path)
+
+    def checkpoint(self) -> None:
+        """Empty the journal once every file it covers is on disk."""
+        with self._lock:
+            while self._active:
+                self._synced.wait()
+            if os.path.exists(self.path):
+                self._checkpoint(blocking=True)
+
+    def recover(self) -> int:
+        """Rewrite files from a journal left behind by a crash.
+
+        Records are applied in order, so each file ends up with its last
+        journaled content. Records for folders that no longer exist (renamed
+        or deleted since) and a torn final record are skipped. Nothing is
+        replayed while another process uses the journal. Returns the number
+        of records applied.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        with self._lock:
+            if self._users_fd is not None:
+                return 0
+            try:
+                self._open_users(LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                # Another process uses the journal, and may be between
+                # appending a record and replacing its file.
+                self._open_users(LOCK_SH)
+                return 0
+            fd = self._open()
+            self._flock(LOCK_EX)
+            try:
+                applied = 0
+                for name, data in self._records(fd):
+                    path = os.path.join(self.root, *name.split('/'))
+                    if os.path.isdir(os.path.dirname(path)):
+                        replace_file(path, data)
+                        applied += 1
+                if applied:
+                    self._sync_files(fd)
+                os.ftruncate(fd, 0)
+                os.fsync(fd)
+                self._size = 0
+            finally:
+                self._flock(LOCK_UN)
+                if fcntl:
+                    fcntl.flock(self._users_fd, LOCK_SH)
+        return applied
+
+    def _records(self, fd: int):
+        with open(os.dup(fd), 'rb') as f:
+            f.seek(0)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                magic, name_len, data_len, crc = HEADER.unpack(header)
+                if magic != MAGIC:
+                    return
+                name = f.read(name_len)
+                data = f.read(data_len)
+                if len(name) < name_len or len(data) < data_len:
+                    return
+                if zlib.crc32(data, zlib.crc32(name)) != crc:
+                    return
+                name = name.decode('utf-8')
+                if name.startswith('../') or os.path.isabs(name):
+                    continue
+                yield name, data
+
+
+class FileLock:
+    """Exclusive advisory lock on ``path``, re-entrant within a thread.
+
+    Threads of one process are serialized by an ``RLock`` and processes by
+    ``flock`` on the lock file, which is created when first needed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._rlock = threading.RLock()
+        self._fd = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl:
+                    try:
+                        fcntl.flock(fd, LOCK_EX)
+                    except BaseException:
+                        os.close(fd)
+                        raise
+            except BaseException:
+                self._rlock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            # Closing the descriptor releases the flock.
+            os.close(self._fd)
+            self._fd = None
+        self._rlock.release()
@@ -0,0 +1,213 @@
+"""Word-count history for CalWriter statistics.
+
+Every chapter save that changes the word count appends a row to an
+append-only ledger. The same transaction adds the change to day, week and
+month rollups for the chapter and each folder above it, so the stats page
+reads a handful of rows instead of parsing chapters.
+"""
+import datetime
+
+from sqlite_store import SQLiteStore, like_prefix
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY,
+    ts TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    delta INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    target TEXT
+);
+CREATE INDEX IF NOT EXISTS ledger_ts ON ledger (ts, path);
+CREATE TABLE IF NOT EXISTS chapter_words (
+    path TEXT PRIMARY KEY,
+    words INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollup (
+    period TEXT NOT NULL,
+    path TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    words INTEGER NOT NULL,
+    PRIMARY KEY (period, path, bucket)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+PERIODS = ('day', 'week', 'month')
+
+
+def bucket(period: str, day: datetime.date) -> str:
+    """Return the rollup key for ``day``: ISO date, ISO week or month."""
+    if period == 'week':
+        year, week, _ = day.isocalendar()
+        return f'{year}-W{week:02d}'
+    if period == 'month':
+        return day.strftime('%Y-%m')
+    return day.isoformat()
+
+
+def _ancestors(path: str) -> list:
+    """Return ``path`` and every folder above it."""
+    parts = path.split('/')
+    return ['/'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+
+
+class WordCountLedger(SQLiteStore):
+    """Thread-safe access to the word-count database."""
+
+    SCHEMA = SCHEMA
+
+    def is_seeded(self) -> bool:
+        row = self.connection().execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone()
+        return row is not None
+
+    def seed(self, chapters) -> None:
+        """Record a baseline for ``(path, words, when)`` of existing chapters.
+
+        Chapters already known to the ledger are skipped. Baselines are
+        credited to ``when``, normally the chapter's modification time.
+        """
+        with self.transaction() as conn:
+            for path, words, when in chapters:
+                known = conn.execute('SELECT 1 FROM chapter_words WHERE path = ?', (path,)).fetchone()
+                if not known:
+                    self._append(conn, 'baseline', path, words, words, when)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', '1')")
+
+    def record(self, path: str, words: int, when: datetime.datetime = None) -> int:
+        """Store the new word count of a chapter and return the change."""
+        when = when or datetime.datetime.now()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT words FROM chapter_words WHERE path = ?', (path,)).fetchone()
+            delta = words - (row[0] if row else 0)
+            if delta or not row:
+                self._append(conn, 'save', path, delta, words, when)
+        return delta
+
+    def _append(self, conn, kind, path, delta, words, when) -> None:
+        conn.execute(
+            'INSERT INTO ledger (ts, kind, path, delta, total) VALUES (?, ?, ?, ?, ?)',
+            (when.isoformat(timespec='seconds'), kind, path, delta, words),
+        )
+        conn.execute(
+            'INSERT INTO chapter_words (path, words) VALUES (?, ?) '
+            'ON CONFLICT(path) DO UPDATE SET words = excluded.words',
+            (path, words),
+        )
+        if delta:
+            self._add_rollups(conn, path, delta, when.date())
+
+    def _add_rollups(self, conn, path, delta, day) -> None:
+        conn.executemany(
+            'INSERT INTO rollup (period, path, bucket, words) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(period, path, bucket) DO UPDATE SET words = words + excluded.words',
+            [
+                (period, p, bucket(period, day), delta)
+                for period in PERIODS
+                for p in _ancestors(path)
+            ],
+        )
+
+    def rename_prefix(self, old: str, new: str) -> None:
+        """Move totals and rollups stored under ``old`` to ``new``."""
+        params = (new, len(old) + 1, old, like_prefix(old))
+        where = "path = ? OR path LIKE ? ESCAPE '\\'"
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO ledger (ts, kind, path, delta, total, target) VALUES (?, ?, ?, 0, 0, ?)',
+                (datetime.datetime.now().isoformat(timespec='seconds'), 'rename', old, new),
+            )
+            for table in ('chapter_words', 'rollup'):
+                conn.execute(f'UPDATE {table} SET path = ? || substr(path, ?) WHERE {where}', params)
+
+    def delete_prefix(self, path: str) -> None:
+        """Drop totals for removed chapters; folder history is kept."""
+        params = (path, like_prefix(path))
+        where = "path = ? OR path LIKE ? ESCAPE '\\'"
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO ledger (ts, kind, path, delta, total) VALUES (?, ?, ?, 0, 0)',
+                (datetime.datetime.now().isoformat(timespec='seconds'), 'delete', path),
+            )
+            conn.execute(f'DELETE FROM chapter_words WHERE {where}', params)
+            conn.execute(f'DELETE FROM rollup WHERE {where}', params)
+
+    def total(self, folder: str) -> int:
+        """Return the current word count of every chapter below ``folder``."""
+        row = self.connection().execute(
+            "SELECT COALESCE(SUM(words), 0) FROM chapter_words WHERE path LIKE ? ESCAPE '\\'",
+            (like_prefix(folder),),
+        ).fetchone()
+        return row[0]
+
+    def series(self, period: str, path: str, since: str = '') -> dict:
+        """Return ``{bucket: words}`` for ``path`` from bucket ``since`` on."""
+        rows = self.connection().execute(
+            'SELECT bucket, words FROM rollup WHERE period = ? AND path = ? AND bucket >= ? '
+            'ORDER BY bucket',
+            (period, path, since),
+        )
+        return dict(rows.fetchall())
+
+    def merge_database(self, path: str) -> None:
+        """Add another ledger's history and totals to this one.
+
+        Ledger rows not already present are appended, current totals are
+        taken from the incoming database and all rollups are rebuilt.
+        """
+        conn = self.connection()
+        conn.execute('ATTACH DATABASE ? AS incoming', (path,))
+        try:
+            with self.transaction() as conn:
+                conn.execute(
+                    'INSERT INTO ledger (ts, kind, path, delta, total, target) '
+                    'SELECT ts, kind, path, delta, total, target FROM incoming.ledger i '
+                    'WHERE NOT EXISTS (SELECT 1 FROM ledger l WHERE l.ts = i.ts AND l.kind = i.kind '
+                    'AND l.path = i.path AND l.delta = i.delta AND l.total = i.total)'
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO chapter_words SELECT * FROM incoming.chapter_words'
+                )
+                self._rebuild_rollups(conn)
+        finally:
+            self.connection().execute('DETACH DATABASE incoming')
+
+    def _rebuild_rollups(self, conn) -> None:
+        """Recompute every rollup from the ledger.
+
+        Each change is credited to the path it ended up at after later
+        renames, and not to folders that were deleted afterwards.
+        """
+        rows = conn.execute(
+            'SELECT ts, kind, path, delta, target FROM ledger ORDER BY ts DESC, id DESC'
+        ).fetchall()
+        events = []
+        totals = {}
+        for ts, kind, path, delta, target in rows:
+            if kind in ('rename', 'delete'):
+                events.append((kind, path, target))
+                continue
+            if not delta:
+                continue
+            depth = path.count('/') + 1
+            for event, old, new in reversed(events):
+                if path == old or path.startswith(old + '/'):
+                    if event == 'rename':
+                        path = new + path[len(old):]
+                    else:
+                        depth = min(depth, old.count('/'))
+            day = datetime.datetime.fromisoformat(ts).date()
+            paths = [p for p in _ancestors(path) if p.count('/') < depth]
+            for period in PERIODS:
+                for p in paths:
+                    key = (period, p, bucket(period, day))
+                    totals[key] = totals.get(key, 0) + delta
+        conn.execute('DELETE FROM rollup')
+        conn.executemany(
+            'INSERT INTO rollup (period, path, bucket, words) VALUES (?, ?, ?, ?)',
+            [key + (words,) for key, words in totals.items()],
+        )